@@ -1,165 +1,3050 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+"""
+Small, allocation free statistics used by the Controller to report on its own timing while the robot is running.
+"""
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+
+# Upper bounds (in seconds) of the histogram buckets, from 50us to 1s. Everything above goes in the last bucket.
+DEFAULT_BOUNDS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def log_bounds(low, high, per_decade):
+    """
+    Log spaced bucket bounds, for histograms that need a finer resolution than DEFAULT_BOUNDS
+    @param low: First upper bound, in seconds
+    @param high: Last upper bound, in seconds
+    @param per_decade: Number of buckets per power of ten
+    """
+    bounds = []
+    i = 0
+    while True:
+        bound = low * 10 ** (i / float(per_decade))
+        if bound > high * 1.0001:
+            return tuple(bounds)
+        bounds.append(bound)
+        i += 1
+
+
+# 10 buckets per decade from 10us to 2s, i.e. about 26% resolution on the percentiles
+LATENCY_BOUNDS = log_bounds(0.00001, 2.0, 10)
+
+
+class Histogram():
+    """
+    Fixed buckets histogram of durations. Adding a value does not allocate, so it can stay on in production runs.
+    Meant to be written by a single thread and read by any other.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        """
+        @param bounds: Sorted upper bounds of the buckets, in seconds
+        """
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        Records one value
+        @param value: The duration to record, in seconds
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket containing the p-th percentile (the max for the overflow bucket)
+        @param p: Percentile between 0 and 100
+        @return: The estimate, or None if nothing got recorded
+        """
+        if self.count == 0:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def snapshot(self):
+        """
+        @return: A dict copy of the current state, safe to keep around or print
+        """
+        return {"count": self.count, "mean": self.mean(), "max": self.max,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+                "bounds": list(self.bounds), "counts": list(self.counts)}
+
+
+class TickStats():
+    """
+    Statistics of the Controller periodic scheduler: how late every tick started (jitter), how long the check phase took
+    and how many ticks overran their period
+    """
+
+    def __init__(self, period):
+        """
+        @param period: The period of the scheduler, in seconds
+        """
+        self.period = period
+        self.jitter = Histogram()
+        self.check_duration = Histogram()
+        self.ticks = 0
+        self.overruns = 0
+
+    def reset(self):
+        self.jitter.reset()
+        self.check_duration.reset()
+        self.ticks = 0
+        self.overruns = 0
+
+    def worst_case_reaction(self):
+        """
+        Worst observed time between a sensor change and the end of the check pass that sees it: a full period plus the
+        worst jitter plus the slowest check phase
+        """
+        return self.period + self.jitter.max + self.check_duration.max
+
+    def snapshot(self):
+        return {"period": self.period, "ticks": self.ticks, "overruns": self.overruns,
+                "worst_case_reaction": self.worst_case_reaction(),
+                "jitter": self.jitter.snapshot(), "check_duration": self.check_duration.snapshot()}
+
+
+class PreemptionRecorder():
+    """
+    Measures, for every pair of (preempted behavior, preempting behavior), the time from the higher priority check()
+    returning True to:
+    - suppress: the old behavior suppress() being called
+    - suppressed: that suppress() returning
+    - stop: the motor stop being issued (only if motor_stopped is hooked to the motor, e.g. Motor.stop_hooks)
+    - action: the new behavior action() starting
+    """
+
+    STAGES = ("suppress", "suppressed", "stop", "action")
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.pairs = {}
+        self._pending = None  # (histograms of the pair, trigger time, index of the new behavior)
+        self._stop_pending = False
+
+    def triggered(self, old_behavior, new_behavior, new_index):
+        """
+        Called by the controller as soon as it decided that new_behavior preempts old_behavior
+        """
+        now = time.perf_counter()
+        pair = (type(old_behavior).__name__, type(new_behavior).__name__)
+        histograms = self.pairs.get(pair)
+        if histograms is None:
+            histograms = {stage: Histogram(self.bounds) for stage in self.STAGES}
+            self.pairs[pair] = histograms
+        self._pending = (histograms, now, new_index)
+        self._stop_pending = True
+
+    def _record(self, stage):
+        pending = self._pending
+        if pending is not None:
+            pending[0][stage].add(time.perf_counter() - pending[1])
+
+    def suppress_called(self):
+        self._record("suppress")
+
+    def suppress_returned(self):
+        self._record("suppressed")
+
+    def motor_stopped(self):
+        """
+        Hook for the motor stop. Only the first stop after a trigger counts
+        """
+        if self._stop_pending:
+            self._stop_pending = False
+            self._record("stop")
+
+    def action_started(self, index):
+        pending = self._pending
+        if pending is not None and pending[2] == index:
+            self._record("action")
+            self._pending = None
+
+    def reset(self):
+        self.pairs = {}
+        self._pending = None
+
+    def report(self):
+        """
+        @return: {"Old->New": {stage: {"count", "p50", "p95", "p99", "max"}}} in seconds
+        """
+        report = {}
+        for (old, new), histograms in self.pairs.items():
+            report[old + "->" + new] = {stage: {"count": h.count, "p50": h.percentile(50), "p95": h.percentile(95),
+                                                "p99": h.percentile(99), "max": h.max}
+                                        for stage, h in histograms.items()}
+        return report
+
+
+class BehaviorProfile():
+    """
+    Timing counters of a single behavior, filled by the Profiler wrappers
+    """
+
+    def __init__(self):
+        self.check_calls = 0
+        self.check_time = 0.0
+        self.check_max = 0.0
+        self.true_calls = 0
+        self.true_time = 0.0
+        self.false_time = 0.0
+        self.action_calls = 0
+        self.action_time = 0.0
+        self.action_max = 0.0
+
+    def snapshot(self):
+        return dict(self.__dict__)
+
+
+class Profiler():
+    """
+    Wraps the check() and action() of behaviors to count calls and measure their wall time. The wrappers are instance
+    attributes shadowing the methods, so unwrapping a behavior gives it back its original methods and profiling costs
+    nothing while it is off.
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        self._originals = {}
+
+    def wrap(self, behavior):
+        """
+        Starts profiling a behavior (nothing happens if it is already profiled)
+        """
+        if behavior in self._originals:
+            return
+        self._originals[behavior] = (behavior.__dict__.get("check"), behavior.__dict__.get("action"))
+        profile = self.profiles.get(behavior)
+        if profile is None:
+            profile = self.profiles[behavior] = BehaviorProfile()
+        perf_counter = time.perf_counter
+        check, action = behavior.check, behavior.action
+
+        def profiled_check():
+            start = perf_counter()
+            result = check()
+            elapsed = perf_counter() - start
+            profile.check_calls += 1
+            profile.check_time += elapsed
+            if elapsed > profile.check_max:
+                profile.check_max = elapsed
+            if result:
+                profile.true_calls += 1
+                profile.true_time += elapsed
+            else:
+                profile.false_time += elapsed
+            return result
+
+        def _account_action(elapsed):
+            profile.action_calls += 1
+            profile.action_time += elapsed
+            if elapsed > profile.action_max:
+                profile.action_max = elapsed
+
+        if asyncio.iscoroutinefunction(action):
+            async def profiled_action():
+                start = perf_counter()
+                try:
+                    return await action()
+                finally:
+                    _account_action(perf_counter() - start)
+        else:
+            def profiled_action():
+                start = perf_counter()
+                try:
+                    return action()
+                finally:
+                    _account_action(perf_counter() - start)
+
+        behavior.check = profiled_check
+        behavior.action = profiled_action
+
+    def unwrap(self, behavior):
+        """
+        Stops profiling a behavior, keeping what was measured so far
+        """
+        originals = self._originals.pop(behavior, None)
+        if originals is None:
+            return
+        for name, original in zip(("check", "action"), originals):
+            if original is None:
+                del behavior.__dict__[name]
+            else:
+                behavior.__dict__[name] = original
+
+    def unwrap_all(self):
+        for behavior in list(self._originals):
+            self.unwrap(behavior)
+
+    def reset(self):
+        for profile in self.profiles.values():
+            profile.__init__()
+
+    def report(self, behaviors):
+        """
+        @param behaviors: The behaviors to report on, in priority order
+        @return: A list with one dict per behavior, with its counters and the share of the total check time it took
+        """
+        total_check_time = sum([profile.check_time for profile in self.profiles.values()]) or 1.0
+        report = []
+        for priority, behavior in enumerate(behaviors):
+            profile = self.profiles.get(behavior, BehaviorProfile())
+            entry = profile.snapshot()
+            entry.update({"priority": priority, "name": type(behavior).__name__,
+                          "check_share": profile.check_time / total_check_time,
+                          "check_mean": profile.check_time / profile.check_calls if profile.check_calls else None})
+            report.append(entry)
+        return report
+
+
+class DecisionTrace():
+    """
+    Fixed size ring buffer of the arbitration decisions, kept in preallocated arrays so recording a decision does not
+    allocate nor format anything and can stay on in production runs. Once full, the oldest decisions get overwritten.
+
+    Every entry holds the time, the index of the behavior that won (None when nothing runs anymore), the index of the
+    previously active one and flags telling whether the previous one got suppressed, and whether its action completed,
+    got preempted or ran over its time budget.
+    """
+
+    SUPPRESSED = 1
+    COMPLETED = 2
+    PREEMPTED = 4
+    OVERRUN = 8
+
+    def __init__(self, size=1024):
+        """
+        @param size: Number of decisions kept
+        """
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.winners = array("h", [0]) * size
+        self.previous = array("h", [0]) * size
+        self.flags = array("B", [0]) * size
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, timestamp, winner, previous, flags=0):
+        """
+        @param timestamp: When the decision was taken, in seconds
+        @param winner: Index of the behavior taking control, or None
+        @param previous: Index of the behavior that had control, or None
+        @param flags: SUPPRESSED, COMPLETED and PREEMPTED or-ed together
+        """
+        i = self.count % self.size
+        self.times[i] = timestamp
+        self.winners[i] = -1 if winner is None else winner
+        self.previous[i] = -1 if previous is None else previous
+        self.flags[i] = flags
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def entries(self):
+        """
+        @return: The kept decisions, oldest first, as (time, winner, previous, flags) tuples
+        """
+        count, size = self.count, self.size
+        entries = []
+        for n in range(max(0, count - size), count):
+            i = n % size
+            winner, previous = self.winners[i], self.previous[i]
+            entries.append((self.times[i], None if winner < 0 else winner, None if previous < 0 else previous,
+                            self.flags[i]))
+        return entries
+
+    def dump(self, path, names=None):
+        """
+        Writes the kept decisions to a CSV file, oldest first
+        @param path: The file to write
+        @param names: Optional behavior names by priority index, written next to the indexes
+        """
+        def label(index):
+            if index is None:
+                return ""
+            if names is not None and index < len(names):
+                return "{}:{}".format(index, names[index])
+            return str(index)
+
+        with open(path, "w") as f:
+            f.write("# decisions {} kept {} dropped {}\n".format(self.count, len(self), self.count - len(self)))
+            f.write("time,winner,previous,suppressed,outcome\n")
+            for timestamp, winner, previous, flags in self.entries():
+                outcome = "completed" if flags & self.COMPLETED else "preempted" if flags & self.PREEMPTED \
+                    else "overrun" if flags & self.OVERRUN else ""
+                f.write("{:.6f},{},{},{},{}\n".format(timestamp, label(winner), label(previous),
+                                                      int(bool(flags & self.SUPPRESSED)), outcome))
+
+
+import asyncio
+import threading
+import time
+
+# Resources a behavior can ask for, see Behavior.resources and ChannelController
+RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS = "drive", "arm", "sound", "leds"
+ALL_RESOURCES = (RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS)
+
+
+class SystemClock():
+    """
+    The real time, used on the robot. Monotonic, so a change of the system time does not move the timers
+    """
+    lockstep = False
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock():
+    """
+    Simulated time for lockstep runs. Time only moves when sleep() or advance() is called, by steps of quantum seconds,
+    and after every step the listeners run (the lockstep Controller arbitrates there). Simulated motors advance it while
+    they are polled, so a whole mission runs single threaded, faster than real time and always the same way.
+    """
+    lockstep = True
+
+    def __init__(self, start=0.0, quantum=0.01):
+        """
+        @param start: Initial time, in seconds
+        @param quantum: Size of a time step, in seconds
+        """
+        self.now = start
+        self.quantum = quantum
+        self.listeners = []
+        self._notifying = False
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds=None):
+        """
+        Moves the time forward, one quantum at a time, running the listeners after every step
+        @param seconds: How much to move, a single quantum by default
+        """
+        end = self.now + (self.quantum if seconds is None else seconds)
+        while True:
+            self.now = min(self.now + self.quantum, end)
+            if not self._notifying:  # a listener moving the time does not call the listeners again
+                self._notifying = True
+                try:
+                    for listener in self.listeners:
+                        listener()
+                finally:
+                    self._notifying = False
+            if self.now >= end:
+                break
+
+
+class Clock():
+    """
+    The clock used by the behaviors and the generated code (CLOCK.time(), CLOCK.sleep()). It forwards to a SystemClock
+    unless a simulation installs a VirtualClock with use(), in which case Controller.start() runs in lockstep.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def use(self, source):
+        self.source = source
+
+    @property
+    def lockstep(self):
+        return self.source.lockstep
+
+    def time(self):
+        return self.source.time()
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+
+CLOCK = Clock(SystemClock())
+
+
+class Behavior(object):
+    """
+    This is an abstract class. Should embody an specific behavior belonging to a robot. Each Behavior must define three
+    things and should be implemented by the user:
+    1. check: Under what circumcises should this behavior take control.
+    2. action: What should this behavior do while it has control.
+    3. suppress: Should give up control immediately when this method is called. Will be called when a behavior with a
+    higher priority wants to take control.
+
+    A behavior can also declare in depends_on the keys of the Readings its check() reads. When the Controller tracks
+    readings, such a check is skipped (counted as False) as long as none of those keys changed since its last evaluation.
+    Checks that also depend on time (timeouts, delays) must set time_based so they are evaluated at every pass anyway.
+
+    With a ChannelController, resources declares what the action uses (RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS), so
+    behaviors that do not share any resource can run at the same time.
+
+    The Controller does not evaluate a behavior for cooldown seconds after its action returned (completed or
+    suppressed), nor for refractory seconds after it took control, so a noisy trigger can not make it fire again and
+    again. Its check() is simply not called during these windows.
+
+    A behavior can declare a time budget for its action: when the action runs longer (e.g. waiting for a motor that never
+    reports done), the Controller suppresses it, counts an overrun and goes on with the arbitration.
+
+    A behavior can also declare max_age: when the Controller tracks readings and one of the depends_on readings was
+    acquired longer ago than that (e.g. the bluetooth link stalled), its check() is not called and the behavior does
+    not take control until fresh values arrive. An action already running is not affected. Safety behaviors can not
+    react meanwhile, so a StaleGuard with a higher priority should stop the robot for as long as that lasts.
+    """
+
+    depends_on = None  # keys of the readings check() reads, None means it is evaluated at every pass
+    time_based = False
+    resources = None  # resources the action uses, None means all of them
+    cooldown = 0.0  # seconds, counted from the end of the action
+    refractory = 0.0  # seconds, counted from the moment the behavior took control
+    budget = None  # seconds the action may run, None for no limit
+    max_age = None  # seconds after which the depends_on readings are stale, None for no limit
+
+    def check(self):
+        """
+        Method to check whether if this behavior should be started or not.
+        @return: Should return a true value if this behavior should take control or not
+        """
+        raise NotImplementedError("Should have implemented this")
+
+    def action(self):
+        """
+        The code in action should represent what the behavior should do while it's active. When this method returns
+        the action is complete and the robot should be in a complete safe state, ie the motors are shut down and such,
+        so the next behavior can take safely take control of the robot
+        """
+        raise NotImplementedError("Should have implemented this")
+
+    def suppress(self):
+        """
+        Should immediately cause the behavior to exits it execution and put the state in safe mode. In other words it
+        should cause the action() method to stop it's execution
+        """
+        raise NotImplementedError("Should have implemented this")
+
+
+class StaleGuard(Behavior):
+    """
+    Takes control while some readings are stale (e.g. none arrived yet at startup, or the bluetooth link stalled) and
+    keeps the robot still until they are fresh again. Added before the safety behaviors skipped on the same readings
+    (see Behavior.max_age), so the lower priority ones can not drive blind while nothing watches the cliff or the edges.
+    """
+    time_based = True
+
+    def __init__(self, readings, keys, max_age, halt, resources=None, poll=0.01, clock=CLOCK):
+        """
+        @param readings: The Readings to look at, e.g. READINGS_DICT
+        @param keys: The readings the safety behaviors depend on
+        @param max_age: Seconds after which they are stale, the max_age of the safety behaviors
+        @param halt: Called when taking control, e.g. MOTOR.stop
+        @param resources: What to hold with a ChannelController, e.g. (RES_DRIVE,), None for everything
+        @param poll: How often (seconds) the readings are looked at while holding
+        @param clock: Clock the ages are measured on
+        """
+        Behavior.__init__(self)
+        self.readings = readings
+        self.keys = tuple(keys)
+        self.max_age = max_age
+        self.halt = halt
+        self.resources = resources
+        self.poll = poll
+        self.clock = clock
+        self.suppressed = False
+        self.halts = 0  # times it stopped the robot
+
+    def check(self):
+        return self.readings.age(self.keys, self.clock.time()) > self.max_age
+
+    def action(self):
+        """
+        Stops the robot and holds control until the readings are fresh again
+        """
+        self.suppressed = False
+        self.halts += 1
+        self.halt()
+        while not self.suppressed and self.check():
+            self.clock.sleep(self.poll)
+        return not self.suppressed
+
+    def suppress(self):
+        self.suppressed = True
+
+
+class Controller():
+    """
+    Runs the main subsumption logic. Controls which behavior will run based on their priority and if they want to become
+    active or not. Works as a scheduler, where only one behavior can be active at a time and who is active is decided by
+    the sensor data and their priority. The previous active behavior gets suppressed when a behavior with a higher
+    priority wants to run.
+
+    There is two usages in this class. One is to make the class take care of scheduler itself, by calling the start()
+    method. The other is to take care of the scheduler by yourself, by using the step() method
+
+    When started with start(), the behaviors are checked by a separate thread. By default that thread re-checks them in a
+    busy loop; with event_driven=True it only wakes up when notify() is called or when max_wait expires; with a period it
+    runs one pass per period and keeps jitter/overrun statistics in tick_stats.
+
+    A long lived controller can run several missions in a row: swap() replaces the mission behaviors while keeping the
+    first ones (e.g. the safety behaviors and their state), and with persistent=True the checker thread keeps running
+    between two start() calls instead of being respawned.
+
+    With compile_checks=True the arbitration pass is a function generated for the current behaviors, with their checks
+    unrolled in priority order (see _compile()). It is rebuilt when the behaviors change through add(), remove(),
+    update(), swap() or profiling, but it holds the check methods bound when it got built, so it does not suit behaviors
+    replacing their own check method afterwards.
+    """
+
+    def __init__(self, return_when_no_action, event_driven=False, max_wait=0.05, period=None, readings=None,
+                 measure_preemption=False, profile=False, clock=CLOCK, persistent=False, trace_size=0,
+                 compile_checks=False):
+        """
+        Initialize the object. Notice the subsumption module is not bound to a specific brick, the behaviors are. This
+        makes it possible to have a subsumption module responsible for multiple bricks at the same time, if desirable.
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param event_driven: If True the checker thread sleeps until notify() is called or max_wait seconds passed,
+        instead of re-checking the behaviors in a busy loop
+        @param max_wait: Deadline (in seconds) after which the checker runs a pass even if nobody notified it
+        @param period: If given (in seconds, e.g. 0.01 for 100 Hz) the checker runs at this fixed rate instead, sleeping
+        for what is left of each period. Takes precedence over event_driven
+        @param readings: The Readings the behaviors depend on. If given, the checks of behaviors declaring depends_on are
+        only evaluated again when one of their readings changed
+        @param measure_preemption: If True, self.preemption records the latency from a higher priority check to the
+        suppression of the old behavior and the start of the new action. Hook self.preemption.motor_stopped to the motor
+        (see Motor.stop_hooks) to also get the time to the motor stop
+        @param profile: Start with profiling on, see enable_profiling()
+        @param clock: Clock of the behaviors. When it is a lockstep clock (a VirtualClock, or CLOCK using one), start()
+        runs run_lockstep() instead of the threads
+        @param persistent: If True, start() returning (because no behavior wants to run) leaves the checker thread
+        running, so the next start() (e.g. after a swap()) reuses it. Only stop() ends it
+        @param trace_size: Number of arbitration decisions kept in self.trace (see dump_trace()), e.g. 1024. None are kept
+        by default
+        @param compile_checks: Whether to run the arbitration pass through a generated function instead of a loop (off by
+        default, see above)
+        """
+        self.behaviors = []
+        self.wait_object = threading.Event()
+        self.active_behavior_index = None
+
+        self._running = True
+        self._stopped = False
+        self._return_when_no_action = return_when_no_action
+        self.persistent = persistent
+        self._checker = None
+        self._lock = threading.RLock()  # serializes the arbitration passes and swap()
+        self.event_driven = event_driven
+        self.max_wait = max_wait
+        self._activated = threading.Event()  # wakes the idle action loop in event driven mode
+        self.period = period
+        self.tick_stats = TickStats(period) if period is not None else None
+        self.readings = readings
+        self._check_stamps = {}  # behavior -> readings stamp at its last False check
+        self._cooling = {}  # behavior -> time until which it is not evaluated
+        self.cooldown_skips = {}  # behavior -> number of checks skipped because of its cooldown or refractory window
+        self.stale_skips = {}  # behavior -> number of checks skipped because its readings were too old
+        self._action_start = None  # when the action of the active behavior started
+        self.overruns = {}  # behavior -> number of times its action ran over its budget or its handover
+        self.preemption = PreemptionRecorder() if measure_preemption else None
+        self.profiler = Profiler()
+        self.profiling = False
+        self.clock = clock
+        self.trace = DecisionTrace(trace_size) if trace_size else None
+        self.compile_checks = compile_checks
+        self._compiled = None  # (plain, tracked) arbitration functions for the current behaviors, built on demand
+        if profile:
+            self.enable_profiling()
+
+        self.callback = lambda x: 0
+
+    def add(self, behavior):
+        """
+        Add a behavior to the behavior module. The order decide which priority they have. First > Second
+        @type behavior: Behavior
+        """
+        self.behaviors.append(behavior)
+        if self.profiling:
+            self.profiler.wrap(behavior)
+        self._compiled = None
+
+    def remove(self, index):
+        old_behavior = self.behaviors[index]
+        del self.behaviors[index]
+        if self.profiling:
+            self.profiler.unwrap(old_behavior)
+        self._compiled = None
+        if self.active_behavior_index == index:  # stop the old one if the new one overrides it
+            old_behavior.suppress()
+            self.active_behavior_index = None
+
+    def update(self, behavior, index):
+        old_behavior = self.behaviors[index]
+        self.behaviors[index] = behavior
+        if self.profiling:
+            self.profiler.unwrap(old_behavior)
+            self.profiler.wrap(behavior)
+        self._compiled = None
+        if self.active_behavior_index == index:  # stop the old one if the new one overrides it
+            old_behavior.suppress()
+
+    def swap(self, behaviors, keep=0):
+        """
+        Replaces the behaviors after the first keep ones with the given ones, in a single step with respect to the
+        arbitration passes. The kept behaviors are untouched (same objects, same state, same priority), an active
+        behavior that is swapped out gets suppressed. Meant to go from one mission to the next without rebuilding the
+        controller; with the AsyncController call it between two start().
+        @param behaviors: The new behaviors, in priority order, coming after the kept ones
+        @param keep: How many of the current highest priority behaviors to keep
+        """
+        with self._lock:
+            old_behaviors = self.behaviors[keep:]
+            self.behaviors = self.behaviors[:keep] + list(behaviors)
+            for behavior in old_behaviors:
+                self._cooling.pop(behavior, None)
+            if self.profiling:
+                for behavior in old_behaviors:
+                    self.profiler.unwrap(behavior)
+                for behavior in behaviors:
+                    self.profiler.wrap(behavior)
+            self._compiled = None
+            self._swapped_out(old_behaviors, keep)
+            self.invalidate()
+        self.notify()
+
+    def _swapped_out(self, old_behaviors, keep):
+        if self.active_behavior_index is not None and self.active_behavior_index >= keep:
+            old_behaviors[self.active_behavior_index - keep].suppress()
+            if self.trace is not None:
+                self.trace.record(self.clock.time(), None, self.active_behavior_index,
+                                  DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+            self.active_behavior_index = None
+            self.callback(self.active_behavior_index)
+
+    def enable_profiling(self):
+        """
+        Wraps the check() and action() of every behavior to record call counts, cumulative and max wall time, and the
+        time spent in checks returning True vs False. Behaviors added later are wrapped too.
+        """
+        self.profiling = True
+        for behavior in self.behaviors:
+            self.profiler.wrap(behavior)
+        self._compiled = None
+
+    def disable_profiling(self):
+        """
+        Gives the behaviors back their original methods. What was recorded stays available in profile_report()
+        """
+        self.profiling = False
+        self.profiler.unwrap_all()
+        self._compiled = None
+
+    def profile_report(self):
+        """
+        @return: One dict per behavior in priority order, see Profiler.report
+        """
+        return self.profiler.report(self.behaviors)
+
+    def dump_trace(self, path):
+        """
+        Writes the last arbitration decisions to a CSV file, see DecisionTrace.dump. The names written next to the
+        indexes are the ones of the current behaviors, so dump before a swap()
+        @param path: The file to write
+        """
+        if self.trace is not None:
+            self.trace.dump(path, [type(behavior).__name__ for behavior in self.behaviors])
+
+    def cooldown_report(self):
+        """
+        @return: One dict per behavior in priority order, with its windows, whether it is cooling down right now (and
+        for how long) and how many of its checks got skipped so far
+        """
+        now = self.clock.time()
+        report = []
+        for priority, behavior in enumerate(self.behaviors):
+            remaining = max(0.0, self._cooling.get(behavior, now) - now)
+            report.append({"priority": priority, "name": type(behavior).__name__, "cooldown": behavior.cooldown,
+                           "refractory": behavior.refractory, "cooling": remaining > 0, "remaining": remaining,
+                           "skipped": self.cooldown_skips.get(behavior, 0)})
+        return report
+
+    def stale_report(self):
+        """
+        @return: One dict per behavior in priority order, with its max_age, the age of its oldest reading right now and
+        how many of its checks got skipped so far because of stale readings
+        """
+        now = self.clock.time()
+        report = []
+        for priority, behavior in enumerate(self.behaviors):
+            age = None
+            if self.readings is not None and behavior.depends_on:
+                age = self.readings.age(behavior.depends_on, now)
+            report.append({"priority": priority, "name": type(behavior).__name__, "max_age": behavior.max_age,
+                           "age": age, "stale": behavior.max_age is not None and age is not None and age > behavior.max_age,
+                           "skipped": self.stale_skips.get(behavior, 0)})
+        return report
+
+    def step(self):
+        """
+        Find the next active behavior and runs it.
+        @return: Returns whether it got to run any behavior or not
+        """
+        behavior = self.find_next_active_behavior()
+        if behavior is not None:
+            self.behaviors[behavior].action()
+            self.invalidate()
+            return True
+        return False
+
+    def find_next_active_behavior(self):
+        """
+        Finds the next behavior that wants to run, if any
+        @return: Next runnable behavior if any
+        @rtype: int
+        """
+        if self.compile_checks:
+            compiled = self._compiled
+            if compiled is None:
+                compiled = self._compiled = self._compile()
+            return compiled[1]() if self.readings is not None or self._cooling else compiled[0]()
+        if self.readings is not None or self._cooling:
+            return self._find_next_active_behavior_tracked()
+        for priority, behavior in enumerate(self.behaviors):
+            if behavior.check():
+                return priority
+        return None
+
+    def _compile(self):
+        """
+        Generates the arbitration passes for the current behaviors: one calling their check() directly, one going
+        through _check() (readings tracking and cooldowns). The checks are unrolled in priority order and bound as closure
+        variables, so a pass does no iteration, no attribute lookup and no index bookkeeping, e.g. for two behaviors:
+
+            def plain():
+                if c0(): return 0
+                if c1(): return 1
+                return None
+
+        @return: (plain, tracked) functions returning the index of the first behavior that wants to run, or None
+        """
+        n = len(self.behaviors)
+        names = ", ".join(["c{0}, b{0}".format(i) for i in range(n)] + ["check"])
+        lines = ["def make(args):", "    {}, = args".format(names), "    def plain():"]  # no 255 arguments limit
+        lines += ["        if c{0}(): return {0}".format(i) for i in range(n)]
+        lines += ["        return None", "    def tracked():"]
+        lines += ["        if check(b{0}): return {0}".format(i) for i in range(n)]
+        lines += ["        return None", "    return plain, tracked"]
+        namespace = {}
+        exec(compile("\n".join(lines), "<arbitration of {} behaviors>".format(n), "exec"), namespace)
+        args = []
+        for behavior in self.behaviors:
+            args += [behavior.check, behavior]
+        return namespace["make"](args + [self._check])
+
+    def overrun_report(self):
+        """
+        @return: One dict per behavior in priority order, with its budget and how many times its action overran it
+        """
+        return [{"priority": priority, "name": type(behavior).__name__, "budget": behavior.budget,
+                 "overruns": self.overruns.get(behavior, 0)} for priority, behavior in enumerate(self.behaviors)]
+
+    def _over_budget(self, behavior, start):
+        """
+        Whether an action that started at start ran over the budget of its behavior, counting the overrun if so
+        """
+        budget = behavior.budget
+        if budget is None or start is None or self.clock.time() - start <= budget:
+            return False
+        self.overruns[behavior] = self.overruns.get(behavior, 0) + 1
+        return True
+
+    def _watchdog(self):
+        """
+        Suppresses the active behavior if its action ran over its budget, so the pass can pick another one
+        """
+        index = self.active_behavior_index
+        if index is not None and self._over_budget(self.behaviors[index], self._action_start):
+            self._action_start = None
+            self.behaviors[index].suppress()
+            if self.trace is not None:
+                self.trace.record(self.clock.time(), None, index, DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+            self.active_behavior_index = None
+            self.invalidate()
+            self.callback(self.active_behavior_index)
+
+    def _find_next_active_behavior_tracked(self):
+        for priority, behavior in enumerate(self.behaviors):
+            if self._check(behavior):
+                return priority
+        return None
+
+    def _check(self, behavior):
+        """
+        The check() of a behavior, skipped (counted as False) while it cools down, if its readings are stale, or if they
+        did not change
+        """
+        cooling = self._cooling
+        if cooling and behavior in cooling:
+            if self.clock.time() < cooling[behavior]:
+                self.cooldown_skips[behavior] = self.cooldown_skips.get(behavior, 0) + 1
+                return False
+            del cooling[behavior]
+        if self.readings is None:
+            return behavior.check()
+        max_age = behavior.max_age
+        if max_age is not None and behavior.depends_on and \
+                self.readings.age(behavior.depends_on, self.clock.time()) > max_age:
+            self.stale_skips[behavior] = self.stale_skips.get(behavior, 0) + 1
+            return False
+        return self._tracked_check(behavior)
+
+    def _cool_down(self, behavior, seconds):
+        """
+        Keeps a behavior from being evaluated for the given time (a longer window already running is kept)
+        """
+        if seconds:
+            until = self.clock.time() + seconds
+            if until > self._cooling.get(behavior, until - 1):
+                self._cooling[behavior] = until
+
+    def _tracked_check(self, behavior):
+        """
+        The check() of a behavior, skipped (counted as False) if it last returned False and none of its readings changed
+        """
+        depends_on = behavior.depends_on
+        if depends_on is None or behavior.time_based:
+            return behavior.check()
+
+        stamps = self._check_stamps
+        stamp = self.readings.stamp(depends_on)
+        if stamps.get(behavior) == stamp:  # inputs unchanged since the last False, still False
+            return False
+        if behavior.check():
+            stamps.pop(behavior, None)
+            return True
+        stamps[behavior] = stamp
+        return False
+
+    def invalidate(self):
+        """
+        Forget which checks could be skipped, so every behavior is evaluated again at the next pass. Done automatically
+        whenever the active behavior changes or an action ends, since behaviors reset their own state at those points.
+        """
+        self._check_stamps.clear()
+
+    def _find_and_set_new_active_behavior(self):
+        with self._lock:
+            self._watchdog()
+            new_behavior_priority = self.find_next_active_behavior()
+            if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
+                if self.active_behavior_index is not None:
+                    old_behavior = self.behaviors[self.active_behavior_index]
+                    if self.preemption is not None:
+                        self.preemption.triggered(old_behavior, self.behaviors[new_behavior_priority], new_behavior_priority)
+                        self.preemption.suppress_called()
+                    old_behavior.suppress()
+                    if self.preemption is not None:
+                        self.preemption.suppress_returned()
+                if new_behavior_priority != self.active_behavior_index:
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), new_behavior_priority, self.active_behavior_index,
+                                          0 if self.active_behavior_index is None
+                                          else DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self.active_behavior_index = new_behavior_priority
+                if new_behavior_priority is not None:
+                    new_behavior = self.behaviors[new_behavior_priority]
+                    self._cool_down(new_behavior, new_behavior.refractory)
+                    self._activated.set()
+
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+
+    def _start(self):  # run the action methods
+        """
+        Starts finding and running behaviors, suppressing the old behaviors when new behaviors with higher priority
+        wants to run.
+        """
+        self._running = True
+        self._find_and_set_new_active_behavior()  # force do it ourselves once to find the right one
+        self._start_checker()
+
+        while self._running:
+            if self.active_behavior_index is not None:
+                running_behavior = self.active_behavior_index
+                if self.preemption is not None:
+                    self.preemption.action_started(running_behavior)
+                behavior = self.behaviors[running_behavior]
+                self._action_start = self.clock.time()
+                behavior.action()
+                with self._lock:
+                    self._cool_down(behavior, behavior.cooldown)
+                    if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
+                        self._completed(running_behavior)
+                        self._find_and_set_new_active_behavior()
+
+            elif self._return_when_no_action:
+                break
+
+            elif self.event_driven or self.period is not None:  # nothing to run, sleep until the checker activates something
+                self._activated.wait(self.max_wait)
+                self._activated.clear()
+
+        #Nothing more to do, so we are shutting down
+        self._running = False
+
+    def _completed(self, index):
+        if self.trace is not None:
+            self.trace.record(self.clock.time(), None, index, DecisionTrace.COMPLETED)
+        self.active_behavior_index = None
+        self.invalidate()
+
+    def _start_checker(self):
+        self._stopped = False
+        if self._checker is not None and self._checker.is_alive():  # persistent, still running from the last start()
+            return
+        checker = self._periodically_find_new_active_behavior if self.period is not None \
+            else self._continuously_find_new_active_behavior
+        thread = threading.Thread(name="Continuous behavior checker", target=checker, args=())
+        thread.daemon = True
+        self._checker = thread
+        thread.start()
+
+    def _checking(self):
+        """
+        Whether the checker thread should go on
+        """
+        return self._running or (self.persistent and not self._stopped)
+
+    def run_lockstep(self, until=None):
+        """
+        Runs the behaviors on the calling thread only, against the virtual time of self.clock. Arbitration happens at
+        every step of the clock: while an action waits (on a simulated motor or a CLOCK.sleep) the time moves, the
+        behaviors are checked and the action gets suppressed exactly as the checker thread would do, but always at the
+        same virtual instants. Only one action runs at a time, whatever the Controller type.
+        @param until: Virtual time at which to give up (e.g. to bound a CI run), None to run until done or stopped
+        """
+        clock = self.clock.source if isinstance(self.clock, Clock) else self.clock
+        listener = self._lockstep_pass
+        clock.listeners.append(listener)
+        self._running = True
+        try:
+            Controller._find_and_set_new_active_behavior(self)
+            while self._running and (until is None or clock.time() < until):
+                if self.active_behavior_index is not None:
+                    running_behavior = self.active_behavior_index
+                    if self.preemption is not None:
+                        self.preemption.action_started(running_behavior)
+                    behavior = self.behaviors[running_behavior]
+                    self._action_start = self.clock.time()
+                    self._lockstep_action(behavior)
+                    self._cool_down(behavior, behavior.cooldown)
+                    if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
+                        self._completed(running_behavior)
+                        Controller._find_and_set_new_active_behavior(self)
+
+                elif self._return_when_no_action:
+                    break
+
+                else:
+                    clock.advance()
+        finally:
+            clock.listeners.remove(listener)
+            self._running = False
+
+    def _lockstep_action(self, behavior):
+        return behavior.action()
+
+    def _lockstep_pass(self):
+        if self._running:
+            Controller._find_and_set_new_active_behavior(self)  # single action semantics, even for subclasses
+
+    def start(self, run_in_thread=False):
+        if self.clock.lockstep:
+            self.run_lockstep()
+        elif run_in_thread:
+            thread = threading.Thread(name="Subsumption Thread",
+                                      target=self._start, args=())
+            thread.daemon = True
+            thread.start()
+        else:
+            self._start()
+
+    def stop(self):
+        self._running = False
+        self._stopped = True
+        self.wait_object.set()
+        if self.active_behavior_index is not None:
+            self.behaviors[self.active_behavior_index].suppress()
+
+    def notify(self):
+        """
+        Signal that new sensor data is available (or that a behavior changed its state), so the checker thread runs an
+        arbitration pass right away. Safe to call from any thread, e.g. from a BluetoothConnection listener.
+        """
+        self.wait_object.set()
+
+    def _continuously_find_new_active_behavior(self):
+        while self._checking():
+            if self.event_driven:
+                self.wait_object.wait(self.max_wait)
+                self.wait_object.clear()
+            self._find_and_set_new_active_behavior()
+
+    def _periodically_find_new_active_behavior(self):
+        """
+        Runs one arbitration pass every period. When a pass takes longer than the period, the missed ticks are dropped
+        and counted as an overrun instead of being run back to back.
+        """
+        stats, clock = self.tick_stats, self.clock
+        next_tick = clock.time()
+        while self._checking():
+            start = clock.time()
+            stats.jitter.add(abs(start - next_tick))
+            self._find_and_set_new_active_behavior()
+            end = clock.time()
+            stats.check_duration.add(end - start)
+            stats.ticks += 1
+
+            next_tick += self.period
+            if end > next_tick:
+                stats.overruns += 1
+                next_tick = end
+            else:
+                clock.sleep(next_tick - end)
+
+    def __str__(self):
+        return str(self.behaviors)
+
+
+class ChannelController(Controller):
+    """
+    Controller arbitrating per resource instead of allowing a single active behavior. Going through the behaviors by
+    priority, a behavior that wants to run gets its resources if no higher priority behavior holds or took one of them;
+    a lower priority active behavior holding one of them gets suppressed. Every active behavior runs its action in its
+    own thread, so e.g. a speech can go on while another behavior drives.
+
+    The action of a behavior only starts once the behaviors it preempted (or its own previous run) returned from their
+    action, so the cleanup of the old one (e.g. a MOTOR.stop() in _reset) can not cut the new one. An action still
+    running handover seconds after its suppression (e.g. blocked in a motor call) counts as an overrun, on_stuck is
+    called on it and the new action starts anyway.
+    """
+
+    def __init__(self, return_when_no_action, handover=1.0, on_stuck=None, **kwargs):
+        """
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param handover: Seconds a starting action waits for the actions it preempted to return
+        @param on_stuck: Called with a preempted behavior whose action did not return within handover, e.g. to stop the
+        motors it is blocked on
+        @param kwargs: Same options as Controller
+        """
+        Controller.__init__(self, return_when_no_action, **kwargs)
+        self.handover = handover
+        self.on_stuck = on_stuck
+        self.active_behaviors = set()  # behaviors currently holding their resources
+        self._threads = {}  # behavior -> thread running its action, until the action returns
+        self._action_starts = {}  # behavior -> when its running action started
+        self._changed = threading.Event()
+
+    @staticmethod
+    def resources_of(behavior):
+        return ALL_RESOURCES if behavior.resources is None else behavior.resources
+
+    def step(self):
+        """
+        Runs one arbitration pass and waits for the started actions to return.
+        @return: Returns whether it got to run any behavior or not
+        """
+        started = self._find_and_set_new_active_behavior()
+        for thread in list(self._threads.values()):
+            thread.join()
+        return bool(started)
+
+    def _swapped_out(self, old_behaviors, keep):
+        for index, behavior in enumerate(old_behaviors):
+            if behavior in self.active_behaviors:
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, keep + index,
+                                      DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+        active_behavior_index = min([self.behaviors.index(b) for b in self.active_behaviors]) \
+            if self.active_behaviors else None
+        if active_behavior_index != self.active_behavior_index:
+            self.active_behavior_index = active_behavior_index
+            self.callback(self.active_behavior_index)
+
+    def _find_and_set_new_active_behavior(self):
+        """
+        One arbitration pass over all the resources
+        @return: The indexes of the behaviors started by this pass
+        """
+        started = []
+        with self._lock:
+            self._watchdog()
+            claimed = set()
+            for priority, behavior in enumerate(self.behaviors):
+                resources = self.resources_of(behavior)
+                if behavior in self.active_behaviors:
+                    if claimed.isdisjoint(resources):
+                        claimed.update(resources)
+                    else:  # a higher priority behavior took one of its resources
+                        self.active_behaviors.discard(behavior)
+                        if self.preemption is not None:
+                            self.preemption.suppress_called()
+                        behavior.suppress()
+                        if self.preemption is not None:
+                            self.preemption.suppress_returned()
+                    continue
+
+                if not claimed.isdisjoint(resources) or not self._check(behavior):
+                    continue
+                claimed.update(resources)
+                if self.preemption is not None or self.trace is not None:
+                    preempted = None  # the lower priority active behavior giving up its resources, if any
+                    for active in self.active_behaviors:
+                        if not set(self.resources_of(active)).isdisjoint(resources):
+                            preempted = active
+                            break
+                    if self.preemption is not None and preempted is not None:
+                        self.preemption.triggered(preempted, behavior, priority)
+                    if self.trace is not None:
+                        if preempted is None:
+                            self.trace.record(self.clock.time(), priority, None)
+                        else:
+                            self.trace.record(self.clock.time(), priority, self.behaviors.index(preempted),
+                                              DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self._cool_down(behavior, behavior.refractory)
+                self._start_action(behavior, priority)
+                started.append(priority)
+
+            if started:
+                self.invalidate()
+            active_behavior_index = min([self.behaviors.index(b) for b in self.active_behaviors]) \
+                if self.active_behaviors else None
+            if active_behavior_index != self.active_behavior_index:
+                self.active_behavior_index = active_behavior_index
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+        return started
+
+    def _watchdog(self):
+        for behavior, start in list(self._action_starts.items()):
+            if behavior in self.active_behaviors and self._over_budget(behavior, start):
+                del self._action_starts[behavior]
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, self.behaviors.index(behavior),
+                                      DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                self.invalidate()
+
+    def _start_action(self, behavior, priority):
+        resources = self.resources_of(behavior)
+        wait_for = [(other, thread) for other, thread in self._threads.items()
+                    if other is behavior or not set(self.resources_of(other)).isdisjoint(resources)]
+        thread = threading.Thread(name="Action " + type(behavior).__name__, target=self._run_action,
+                                  args=(behavior, priority, wait_for))
+        thread.daemon = True
+        self.active_behaviors.add(behavior)
+        self._threads[behavior] = thread
+        thread.start()
+
+    def _run_action(self, behavior, priority, wait_for):
+        try:
+            for other, thread in wait_for:
+                thread.join(self.handover)
+                if thread.is_alive():  # it ignores its suppression
+                    with self._lock:
+                        self.overruns[other] = self.overruns.get(other, 0) + 1
+                        if self.trace is not None and other in self.behaviors:  # not swapped out meanwhile
+                            self.trace.record(self.clock.time(), None, self.behaviors.index(other),
+                                              DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                    if self.on_stuck is not None:
+                        self.on_stuck(other)
+            if behavior in self.active_behaviors:  # could have been preempted while waiting
+                if self.preemption is not None:
+                    self.preemption.action_started(priority)
+                self._action_starts[behavior] = self.clock.time()
+                behavior.action()
+        finally:
+            with self._lock:
+                if self._threads.get(behavior) is threading.current_thread():
+                    self._action_starts.pop(behavior, None)
+                self._cool_down(behavior, behavior.cooldown)
+                if self._threads.get(behavior) is threading.current_thread():
+                    del self._threads[behavior]
+                if behavior in self.active_behaviors:  # means the action got completed the old fashion way
+                    self.active_behaviors.discard(behavior)
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), None, priority, DecisionTrace.COMPLETED)
+            self._changed.set()
+            self.wait_object.set()
+
+    def _start(self):
+        """
+        Starts arbitrating, and waits until stop() is called (or until nothing runs, if return_when_no_action)
+        """
+        self._running = True
+        self._find_and_set_new_active_behavior()  # force do it ourselves once to find the right ones
+        self._start_checker()
+
+        while self._running:
+            if not self._threads and self._return_when_no_action:
+                self._find_and_set_new_active_behavior()
+                if not self._threads:
+                    break
+            self._changed.wait(self.max_wait)
+            self._changed.clear()
+
+        #Nothing more to do, so we are shutting down
+        self._running = False
+
+    def stop(self):
+        self._running = False
+        self._stopped = True
+        self.wait_object.set()
+        self._changed.set()
+        with self._lock:
+            for behavior in list(self.active_behaviors):
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+
+
+class AsyncBehavior(Behavior):
+    """
+    Behavior whose action() is a coroutine, to be run by an AsyncController. Instead of spinning until the motors are
+    done, the action awaits (see wait_motor and wait_until), so the controller can keep checking the other behaviors on
+    the same thread. Suppression is the cancellation of the action task: the action gets a CancelledError at its current
+    await and should put the robot in a safe state (e.g. in a finally clause) before letting it propagate.
+    """
+
+    async def action(self):
+        raise NotImplementedError("Should have implemented this")
+
+    def suppress(self):
+        """
+        Not needed, the AsyncController cancels the action instead
+        """
+        pass
+
+
+async def wait_motor(motor, poll=0.01):
+    """
+    Waits for a motor to complete its current movement, without blocking the other coroutines
+    @param motor: Anything with an is_running property (Motor, ArmMotor)
+    @param poll: How often (seconds) the motor is polled. In lockstep, polling a simulated motor moves the virtual time
+    instead, so the loop is only yielded to
+    """
+    while motor.is_running:
+        await asyncio.sleep(0 if CLOCK.lockstep else poll)
+
+
+async def wait_until(predicate, poll=0.01):
+    """
+    Waits until predicate() returns a true value, e.g. until a new message arrived on the bluetooth connection
+    @param predicate: Function without arguments to poll
+    @param poll: How often (seconds) the predicate is polled. In lockstep, the virtual time moves by one quantum instead
+    """
+    while not predicate():
+        if CLOCK.lockstep:
+            CLOCK.source.advance()
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(poll)
+
+
+async def run_sync_action(behavior):
+    """
+    Adapter to run the action() of a plain Behavior from an AsyncController. The action runs in the loop executor
+    (it blocks, so it needs its own thread) and cancelling this coroutine calls the behavior suppress() and waits for
+    the action to return, as the threaded Controller would.
+    @param behavior: The synchronous behavior
+    @return: What the action returned
+    """
+    future = asyncio.get_event_loop().run_in_executor(None, behavior.action)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        behavior.suppress()
+        await future
+        raise
+
+
+class AsyncController(Controller):
+    """
+    Controller running on a single asyncio event loop instead of the checker and action threads. Arbitration runs at
+    every notify() or every max_wait seconds; the active action runs as a task on the same loop and is cancelled when a
+    behavior with a higher priority wants to take control.
+
+    AsyncBehavior actions are awaited directly. The actions of plain Behavior subclasses go through run_sync_action, so
+    they still work (in an executor thread) and can be migrated one by one.
+    """
+
+    def __init__(self, return_when_no_action, max_wait=0.01, readings=None, measure_preemption=False):
+        """
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param max_wait: Deadline (in seconds) after which an arbitration pass runs even if nobody notified the controller
+        @param readings: See Controller
+        @param measure_preemption: See Controller. Suppression is measured as the cancellation of the action task
+        """
+        Controller.__init__(self, return_when_no_action, event_driven=True, max_wait=max_wait, readings=readings,
+                            measure_preemption=measure_preemption)
+        self.loop = None
+        self._wake = None
+        self._task = None
+        self._lockstep_index = None  # index of the behavior whose action task runs, in lockstep
+
+    def step(self):
+        """
+        Find the next active behavior and runs it to completion on a new event loop.
+        @return: Returns whether it got to run any behavior or not
+        """
+        behavior = self.find_next_active_behavior()
+        if behavior is not None:
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._run_action(behavior))
+            finally:
+                loop.close()
+            self.invalidate()
+            return True
+        return False
+
+    async def _run_action(self, index):
+        behavior = self.behaviors[index]
+        if self.preemption is not None:
+            self.preemption.action_started(index)
+        self._action_start = self.clock.time()
+        try:
+            if asyncio.iscoroutinefunction(behavior.action):
+                return await behavior.action()
+            return await run_sync_action(behavior)
+        finally:
+            self._cool_down(behavior, behavior.cooldown)
+
+    async def _cancel_active(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+    def _on_action_done(self, task):
+        self._wake.set()
+
+    async def _arbitrate(self):
+        """
+        Coroutine version of Controller._start: one arbitration pass per wake up
+        """
+        self._running = True
+        self._wake = asyncio.Event()
+        while self._running:
+            if self._task is not None and self._task.done():  # the action got completed the old fashion way
+                task, self._task = self._task, None
+                task.result()  # raises what the action raised, as the threaded controller would
+                self._completed(self.active_behavior_index)
+
+            index = self.active_behavior_index
+            if index is not None and self._over_budget(self.behaviors[index], self._action_start):
+                self._action_start = None
+                await self._cancel_active()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, index, DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                self.active_behavior_index = None
+                self.invalidate()
+
+            new_behavior_priority = self.find_next_active_behavior()
+            if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
+                if self.active_behavior_index is not None:
+                    if self.preemption is not None:
+                        self.preemption.triggered(self.behaviors[self.active_behavior_index],
+                                                  self.behaviors[new_behavior_priority], new_behavior_priority)
+                        self.preemption.suppress_called()
+                    await self._cancel_active()
+                    if self.preemption is not None:
+                        self.preemption.suppress_returned()
+                if new_behavior_priority != self.active_behavior_index:
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), new_behavior_priority, self.active_behavior_index,
+                                          0 if self.active_behavior_index is None
+                                          else DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self.active_behavior_index = new_behavior_priority
+                if new_behavior_priority is not None:
+                    self._cool_down(self.behaviors[new_behavior_priority], self.behaviors[new_behavior_priority].refractory)
+                    self._task = asyncio.ensure_future(self._run_action(new_behavior_priority))
+                    self._task.add_done_callback(self._on_action_done)
+
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+
+            if self.active_behavior_index is None and self._return_when_no_action:
+                break
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+        #Nothing more to do, so we are shutting down
+        await self._cancel_active()
+        self._running = False
+
+    def run_lockstep(self, until=None):
+        """
+        Runs the behaviors on the calling thread only, against the virtual time of self.clock, as Controller.run_lockstep
+        does. The coroutine actions run as tasks on a private event loop and a preemption cancels the task, at its
+        current await. They should wait with wait_motor and wait_until, asyncio.sleep waiting for the real time
+        @param until: Virtual time at which to give up, None to run until done or stopped
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            Controller.run_lockstep(self, until)
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def _lockstep_action(self, behavior):
+        if not asyncio.iscoroutinefunction(behavior.action):
+            return behavior.action()
+        self._task = self.loop.create_task(behavior.action())
+        self._lockstep_index = self.active_behavior_index
+        try:
+            return self.loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            return False
+        finally:
+            self._task = None
+
+    def _lockstep_pass(self):
+        Controller._lockstep_pass(self)
+        if self._task is not None and self.active_behavior_index != self._lockstep_index:  # preempted
+            self._task.cancel()
+
+    def _start(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._arbitrate())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def _call_in_loop(self, callback):
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(callback)
+
+    def stop(self):
+        self._running = False
+        self._call_in_loop(self._wake_up)
+
+    def notify(self):
+        """
+        Signal that new sensor data is available, so an arbitration pass runs right away. Safe to call from any thread.
+        """
+        self._call_in_loop(self._wake_up)
+
+    def _wake_up(self):
+        if self._wake is not None:
+            self._wake.set()
+
+
+"""
+Shared sensor readings of a brick. Kept free of ev3dev2 imports so the controller and its benchmarks can use it off the
+brick too.
+"""
+
+
+class Readings(dict):
+    """
+    Drop-in replacement for the plain READINGS_DICT. Keeps a version counter per key that is bumped every time the value
+    of that key changes, plus a global version bumped on every change, so the Controller can skip the checks of the
+    behaviors whose inputs did not change since their last evaluation.
+
+    It also keeps when every reading was last acquired (on the clock of the behaviors, monotonic), so the Controller can
+    tell stale readings apart (see Behavior.max_age), and the gaps between acquisitions of every reading.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.versions = dict.fromkeys(self, 0)
+        self.version = 0
+        self.clock = CLOCK
+        self.stamps = dict.fromkeys(self)  # key -> acquisition time of its value, None if never acquired
+        self._gaps = {}  # key -> [acquisitions, sum of the gaps, longest gap]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, stamp=None):
+        """
+        Stores a freshly acquired value
+        @param stamp: When it was acquired, now by default
+        """
+        if stamp is None:
+            stamp = self.clock.time()
+        previous = self.stamps.get(key)
+        if previous is not None and stamp > previous:
+            gaps = self._gaps.get(key)
+            if gaps is None:
+                gaps = self._gaps[key] = [0, 0.0, 0.0]
+            gap = stamp - previous
+            gaps[0] += 1
+            gaps[1] += gap
+            if gap > gaps[2]:
+                gaps[2] = gap
+        self.stamps[key] = stamp
+        if key not in self or dict.__getitem__(self, key) != value:
+            dict.__setitem__(self, key, value)
+            self.touch(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def touch(self, key):
+        """
+        Marks a reading as changed even if its value is the same, so the behaviors depending on it get checked again
+        @param key: The reading to mark
+        """
+        self.versions[key] = self.versions.get(key, 0) + 1
+        self.version += 1
+
+    def stamp(self, keys):
+        """
+        @param keys: The readings to look at
+        @return: A number that changes whenever one of the given readings changes
+        """
+        versions = self.versions
+        return sum([versions.get(key, 0) for key in keys])
+
+    def age(self, keys, now=None):
+        """
+        @param keys: The readings to look at
+        @param now: The current time, read from the clock by default
+        @return: Seconds since the oldest of the given readings was acquired, infinite if one never was
+        """
+        if now is None:
+            now = self.clock.time()
+        stamps = self.stamps
+        oldest = now
+        for key in keys:
+            stamp = stamps.get(key)
+            if stamp is None:
+                return float("inf")
+            if stamp < oldest:
+                oldest = stamp
+        return now - oldest
+
+    def age_report(self):
+        """
+        @return: {key: {"age", "gaps", "mean_gap", "max_gap"}}, age being None for the readings never acquired and the
+        gaps the times between two acquisitions
+        """
+        now = self.clock.time()
+        report = {}
+        for key in self:
+            stamp = self.stamps.get(key)
+            count, total, longest = self._gaps.get(key, (0, 0.0, 0.0))
+            report[key] = {"age": None if stamp is None else now - stamp, "gaps": count,
+                           "mean_gap": total / count if count else None, "max_gap": longest}
+        return report
+
+
+"""
+Streaming filters for the sensor values, applied to every sample before it is published in the readings, so a single
+mis-read does not fire a whole maneuver. Each filter takes a raw sample and returns the filtered value in O(1), on
+buffers allocated once, and they can be chained (FilterChain):
+
+    MajorityFilter: the value most of the last n samples agree on (color sensors)
+    HysteresisFilter: a value only crosses a threshold once it is past it by a margin (ultrasonic sensors)
+    DwellFilter: a new value only gets through after it held for a minimum time
+
+Every filter counts the spurious activations it prevented: the excursions of the raw samples away from the filtered
+value that ended without the filtered value ever following them.
+
+Kept free of ev3dev2 imports so it can be used by the sensor process and the benchmarks off the brick.
+"""
+
+
+class Filter():
+    """
+    Base class of the filters: keeps the filtered value and counts the prevented activations. Subclasses implement
+    _filter(sample), returning the new filtered value, and may override _state(value), what the behaviors act on (the
+    value itself by default)
+    """
+
+    def __init__(self, initial=None):
+        """
+        @param initial: The filtered value before the first sample
+        """
+        self.value = initial
+        self.prevented = 0
+        self._excursion = False
+
+    def __call__(self, sample):
+        """
+        @param sample: The raw sample
+        @return: The filtered value
+        """
+        state = self._state
+        previous = state(self.value)
+        value = self._filter(sample)
+        self.value = value
+        current = state(value)
+        if current != previous:
+            self._excursion = False  # followed, late or not
+        elif state(sample) != current:
+            self._excursion = True
+        elif self._excursion:  # back to the filtered value without it ever moving
+            self._excursion = False
+            self.prevented += 1
+        return value
+
+    def _filter(self, sample):
+        raise NotImplementedError
+
+    def _state(self, value):
+        return value
+
+
+class MajorityFilter(Filter):
+    """
+    Outputs a value once more than half of the last n samples have it, and keeps the previous output otherwise
+    """
+
+    def __init__(self, n=3, initial=None):
+        Filter.__init__(self, initial)
+        self.n = n
+        self._window = [initial] * n  # ring buffer of the last n samples
+        self._counts = {initial: n}
+        self._next = 0
+
+    def _filter(self, sample):
+        counts, window, i = self._counts, self._window, self._next
+        old = window[i]
+        counts[old] -= 1
+        window[i] = sample
+        counts[sample] = counts.get(sample, 0) + 1
+        self._next = i + 1 if i + 1 < self.n else 0
+        if counts[sample] * 2 > self.n:
+            return sample
+        return self.value
+
+
+class HysteresisFilter(Filter):
+    """
+    Lets the samples through, except when they cross one of the thresholds by less than the margin: the previous output
+    is kept then, so a behavior comparing the readings to the same thresholds does not flicker around them
+    """
+
+    def __init__(self, thresholds, margin, initial=None):
+        """
+        @param thresholds: The values the behaviors compare the reading to, e.g. (120, 400) for the cliff
+        @param margin: How far past a threshold a sample must be to cross it
+        """
+        Filter.__init__(self, initial)
+        self.thresholds = tuple(sorted(thresholds))
+        self.margin = margin
+        self._region = self._region_of(initial)
+
+    def _region_of(self, sample):
+        if sample is None:
+            return None
+        region = 0
+        for threshold in self.thresholds:
+            if sample <= threshold:
+                break
+            region += 1
+        return region
+
+    def _filter(self, sample):
+        if sample is None:
+            return self.value
+        region = self._region_of(sample)
+        if self._region is None or region == self._region:
+            self._region = region
+            return sample
+        thresholds = self.thresholds
+        if region > self._region:
+            crossed = sample - thresholds[region - 1] >= self.margin
+        else:
+            crossed = thresholds[region] - sample >= self.margin
+        if crossed:
+            self._region = region
+            return sample
+        return self.value
+
+    def _state(self, value):
+        return self._region_of(value)
+
+
+class DwellFilter(Filter):
+    """
+    Outputs a new value only after the samples kept it for dwell seconds
+    """
+
+    def __init__(self, dwell, initial=None, clock=CLOCK):
+        """
+        @param dwell: Minimum time, in seconds
+        @param clock: The clock the time is measured with
+        """
+        Filter.__init__(self, initial)
+        self.dwell = dwell
+        self.clock = clock
+        self._candidate = initial
+        self._since = None
+
+    def _filter(self, sample):
+        if sample == self.value:
+            self._candidate = sample
+            return sample
+        now = self.clock.time()
+        if sample != self._candidate or self._since is None:
+            self._candidate, self._since = sample, now
+        if now - self._since >= self.dwell:
+            return sample
+        return self.value
+
+
+class FilterChain():
+    """
+    Applies filters one after the other. Counts as prevented what any of them prevented
+    """
+
+    def __init__(self, *filters):
+        self.filters = filters
+        self.value = filters[-1].value
+
+    def __call__(self, sample):
+        value = sample
+        for stage in self.filters:
+            value = stage(value)
+        self.value = value
+        return value
+
+    @property
+    def prevented(self):
+        return sum(stage.prevented for stage in self.filters)
+
+
+def apply_filters(filters, values):
+    """
+    Filters the readings that have a filter, in place
+    @param filters: {key: filter}
+    @param values: {key: raw value}, e.g. what the sensors just returned
+    @return: values
+    """
+    for key in values:
+        stage = filters.get(key)
+        if stage is not None:
+            values[key] = stage(values[key])
+    return values
+
+
+"""
+History of the last samples of every reading, for the triggers that look at a trend instead of the current value
+("mean distance over 200 ms", "red seen in 3 of the last 5 samples", "rate of change"). Every reading keeps its samples
+and their acquisition times in fixed size ring buffers allocated once, so recording a sample does not allocate, and
+the queries run over the buffers with the C loops of bytearray.count and sum instead of per sample Python code.
+
+Kept free of ev3dev2 imports so it can be used by the sensor process and the benchmarks off the brick.
+"""
+from array import array
+
+
+class ReadingHistory():
+    """
+    Ring buffer of the last samples of one reading. Numeric readings (distances) are kept as doubles, the others
+    (colors, touch) as the index of their value in a table of the values seen so far
+    """
+
+    def __init__(self, size=64, numeric=True, clock=CLOCK):
+        """
+        @param size: Number of samples kept
+        @param numeric: Whether the values are numbers (mean and rate make sense) or labels (only counts do)
+        @param clock: The clock the samples are timestamped with when no time is given
+        """
+        self.size = size
+        self.numeric = numeric
+        self.clock = clock
+        self.times = array("d", [0.0]) * size
+        if numeric:
+            self.values = array("d", [0.0]) * size
+            self._view = memoryview(self.values)
+        else:
+            self.values = bytearray(size)
+            self.labels = [None]
+            self._codes = {None: 0}
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def push(self, value, stamp=None):
+        """
+        Records a sample
+        @param value: The sample
+        @param stamp: When it was acquired, now by default
+        @return: value
+        """
+        i = self.count % self.size
+        self.times[i] = self.clock.time() if stamp is None else stamp
+        if self.numeric:
+            self.values[i] = value
+        else:
+            code = self._codes.get(value)
+            if code is None:  # a value never seen before, only happens a few times per run
+                code = self._codes[value] = len(self.labels)
+                self.labels.append(value)
+            self.values[i] = code
+        self.count += 1  # last, so a reader never sees a sample before its value
+        return value
+
+    def latest(self):
+        """
+        @return: The last sample, or None if there is none
+        """
+        if self.count == 0:
+            return None
+        value = self.values[(self.count - 1) % self.size]
+        return value if self.numeric else self.labels[value]
+
+    def _ranges(self, n):
+        """
+        @return: The (start, end) slices of the buffers holding the last n samples, oldest first
+        """
+        end = self.count % self.size
+        start = end - n
+        if start >= 0:
+            return ((start, end),)
+        return ((start + self.size, self.size), (0, end))
+
+    def _within(self, window, now):
+        """
+        @return: How many of the last samples were acquired in the last window seconds (binary search on the times)
+        """
+        count, size, times = self.count, self.size, self.times
+        available = min(count, size)
+        oldest = now - window
+        low, high = 0, available  # number of samples, counted from the newest, known to be in / out of the window
+        while low < high:
+            middle = (low + high + 1) // 2
+            if times[(count - middle) % size] >= oldest:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def count_of(self, value, n):
+        """
+        Labeled readings only, a numeric one compares its samples with a threshold instead (e.g. mean())
+        @return: In how many of the last n samples the reading had the given value
+        """
+        if self.numeric:
+            raise ValueError("count_of needs a labeled history")
+        n = min(n, len(self))
+        code = self._codes.get(value)
+        if code is None:
+            return 0
+        return sum(self.values.count(code, start, end) for start, end in self._ranges(n))
+
+    def k_of_n(self, value, k, n):
+        """
+        Labeled readings only, see count_of()
+        @return: Whether at least k of the last n samples had the given value
+        """
+        return self.count_of(value, n) >= k
+
+    def mean(self, window, default=None, now=None):
+        """
+        @param window: Seconds back from now
+        @param default: What to return when no sample was acquired in the window
+        @return: The mean of the numeric samples acquired in the window
+        """
+        n = self._within(window, self.clock.time() if now is None else now)
+        if n == 0:
+            return default
+        return sum(sum(self._view[start:end]) for start, end in self._ranges(n)) / n
+
+    def rate(self, window, now=None):
+        """
+        @param window: Seconds back from now
+        @return: The change of the numeric reading per second between the oldest and the newest sample of the window,
+        or None if there are less than two
+        """
+        n = self._within(window, self.clock.time() if now is None else now)
+        if n < 2:
+            return None
+        size, count = self.size, self.count
+        first, last = (count - n) % size, (count - 1) % size
+        elapsed = self.times[last] - self.times[first]
+        if elapsed <= 0:
+            return None
+        return (self.values[last] - self.values[first]) / elapsed
+
+
+class SensorHistory(dict):
+    """
+    {key: ReadingHistory} of the readings of a brick
+    """
+
+    def __init__(self, numeric=(), labeled=(), size=64, clock=CLOCK):
+        """
+        @param numeric: Keys of the numeric readings, e.g. ("US_F", "US_B")
+        @param labeled: Keys of the other readings, e.g. ("CS_L", "CS_M", "CS_R", "TS_L", "TS_R", "TS_B")
+        @param size: Samples kept per reading
+        """
+        dict.__init__(self)
+        for key in numeric:
+            self[key] = ReadingHistory(size, True, clock)
+        for key in labeled:
+            self[key] = ReadingHistory(size, False, clock)
+
+    def record(self, values, stamp=None):
+        """
+        Records a sample of every given reading that has a history
+        @param values: {key: value}
+        @param stamp: When they were acquired, now by default
+        @return: values
+        """
+        for key, value in values.items():
+            history = self.get(key)
+            if history is not None:
+                history.push(value, stamp)
+        return values
+
+
+"""
+Classification of the raw RGB values of the color sensor through a quantized 3-D lookup table: every channel is cut
+into 2**bits bins, and one byte per (r, g, b) bin holds the index of the color name in a labels table (the names
+int2color returns). A lookup is a few shifts and two indexings, and with 5 bits per channel the table takes 32 KB,
+where the dict keyed by (r, g, b) tuples of stest.py needs an entry (and a tuple) per value.
+
+The tables are baked offline from recorded samples (see calibrate_color.py) and saved to a file the robot maps in
+memory at startup (ColorLUT.load), so nothing is parsed or copied when it starts, whatever the number of bins: the
+master, the slave, the tools and the simulator mapping the same file share its pages. The file is a small header
+followed by the cells:
+
+    "CLUT", version (u16), bits (u8), in_bits (u8), number of labels (u8),
+    every label as its length (u8) and its utf-8 bytes,
+    crc32 of the cells (u32),
+    the 2**(3 * bits) cells.
+
+Kept free of ev3dev2 imports so it can be built and benchmarked off the brick.
+"""
+import mmap
+import struct
+import zlib
+
+MAGIC = b"CLUT"
+VERSION = 1
+_HEADER = struct.Struct("<4sHBBB")
+_CHECKSUM = struct.Struct("<I")
+
+COLOR_NAMES = ("nocolor", "black", "blue", "green", "yellow", "red", "white")  # the names of commons.int2color
+
+# The thresholds tried in stest.py, as (name, ((r_min, r_max), (g_min, g_max), (b_min, b_max))) on 0-255 values
+DEFAULT_RANGES = (
+    ("black", ((0, 50), (0, 50), (0, 50))),
+    ("white", ((200, 255), (200, 255), (200, 255))),
+    ("blue", ((0, 50), (0, 50), (200, 255))),
+    ("red", ((200, 255), (0, 50), (0, 50))),
+    ("yellow", ((150, 250), (150, 250), (0, 100))),
+)
+
+
+class ColorLUT():
+    """
+    Maps (r, g, b) to a color name. The cells nothing was assigned to give labels[0] ("nocolor")
+    """
+
+    def __init__(self, bits=5, in_bits=8, labels=COLOR_NAMES, table=None):
+        """
+        @param bits: Bins per channel, as a power of 2: the table has 2**(3 * bits) cells
+        @param in_bits: Bits of the values given to classify: 8 for ColorSensor.rgb (0-255), 10 for the RGB-RAW mode
+        (0-1020)
+        @param labels: The names the cells can hold, the first one being the default
+        @param table: The cells, anything indexable giving ints (bytearray, bytes, mmap), a new empty bytearray by default
+        """
+        if not 0 < bits <= in_bits:
+            raise ValueError("bits must be between 1 and in_bits")
+        if len(labels) > 256:
+            raise ValueError("At most 256 labels fit in a byte")
+        self.bits = bits
+        self.in_bits = in_bits
+        self.labels = tuple(labels)
+        self._label_index = {label: i for i, label in enumerate(self.labels)}
+        self.size = 1 << (3 * bits)
+        if table is None:
+            table = bytearray(self.size)
+        elif len(table) != self.size:
+            raise ValueError("The table has {} cells, {} expected".format(len(table), self.size))
+        self.table = table
+        self._shift = in_bits - bits
+        self._max = (1 << in_bits) - 1
+
+    def index(self, red, green, blue):
+        """
+        @return: The cell of the table holding (red, green, blue)
+        """
+        shift, bits = self._shift, self.bits
+        return ((red >> shift) << (2 * bits)) | ((green >> shift) << bits) | (blue >> shift)
+
+    def classify(self, red, green, blue):
+        """
+        @return: The color name of (red, green, blue), values above the input range being clamped
+        """
+        top = self._max
+        if red > top or green > top or blue > top:
+            red, green, blue = min(red, top), min(green, top), min(blue, top)
+        shift, bits = self._shift, self.bits
+        return self.labels[self.table[((red >> shift) << (2 * bits)) | ((green >> shift) << bits) | (blue >> shift)]]
+
+    def center(self, index):
+        """
+        @return: The (r, g, b) in the middle of a cell, in the input range
+        """
+        mask = (1 << self.bits) - 1
+        half = (1 << self._shift) >> 1
+        return tuple((((index >> (2 * self.bits - c * self.bits)) & mask) << self._shift) + half for c in range(3))
+
+    def fill_box(self, name, ranges):
+        """
+        Assigns a color to every cell overlapping a box of values, like stest.set_color_ranges
+        @param name: One of the labels
+        @param ranges: ((r_min, r_max), (g_min, g_max), (b_min, b_max)), inclusive, in the input range
+        """
+        label = self._label_index[name]
+        shift, bits, table = self._shift, self.bits, self.table
+        (r0, r1), (g0, g1), (b0, b1) = ranges
+        for r in range(r0 >> shift, (min(r1, self._max) >> shift) + 1):
+            for g in range(g0 >> shift, (min(g1, self._max) >> shift) + 1):
+                row = (r << (2 * bits)) | (g << bits)
+                for b in range(b0 >> shift, (min(b1, self._max) >> shift) + 1):
+                    table[row | b] = label
+
+    @classmethod
+    def from_ranges(cls, ranges=DEFAULT_RANGES, bits=5, in_bits=8, labels=COLOR_NAMES):
+        """
+        @param ranges: (name, box) pairs as taken by fill_box, the later ones overwriting the earlier ones where they
+        overlap
+        """
+        lut = cls(bits, in_bits, labels)
+        for name, box in ranges:
+            lut.fill_box(name, box)
+        return lut
+
+    def save(self, path):
+        """
+        Writes the table with its header, for load
+        """
+        header = [_HEADER.pack(MAGIC, VERSION, self.bits, self.in_bits, len(self.labels))]
+        for label in self.labels:
+            name = label.encode("utf-8")
+            header.append(struct.pack("<B", len(name)) + name)
+        header.append(_CHECKSUM.pack(zlib.crc32(self.table) & 0xffffffff))
+        with open(path, "wb") as f:
+            f.write(b"".join(header))
+            f.write(self.table)
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """
+        Maps a table written by save in memory (read only), the pages being loaded as the lookups touch them
+        @param verify: Whether to check the cells against the checksum of the header. It reads them all once, so the
+        robot leaves it off and the files are verified where they are made (see calibrate_color.py verify)
+        @raise ValueError: If the file is not a table of this version, is truncated or does not match its checksum
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = None
+        try:
+            try:
+                magic, version, bits, in_bits, count = _HEADER.unpack_from(data, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError("{} is not a version {} color table".format(path, VERSION))
+                offset = _HEADER.size
+                labels = []
+                for _ in range(count):
+                    length = data[offset]
+                    labels.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+                    offset += 1 + length
+                checksum = _CHECKSUM.unpack_from(data, offset)[0]
+                offset += _CHECKSUM.size
+            except (struct.error, IndexError):
+                raise ValueError("{} is truncated".format(path))
+            table = memoryview(data)[offset:]
+            if verify and zlib.crc32(table) & 0xffffffff != checksum:
+                raise ValueError("{} does not match its checksum".format(path))
+            return cls(bits, in_bits, labels, table)
+        except Exception:  # do not leave the file mapped
+            if table is not None:
+                table.release()
+            data.close()
+            raise
+
+
+"""
+Fast path to the lego-sensor sysfs attributes. The ev3dev2 attribute access formats the path, goes through a file object
+and decodes a new string at every read; here the value files are opened once and read with pread (or lseek and readv
+before Python 3.7) into a buffer allocated once, and the number is parsed from the bytes directly.
+
+The root of the tree is a parameter, so it can be pointed at a fake tree in a temporary directory (see
+make_fake_sensor) off the brick.
+"""
+import os
+
+SYSFS_ROOT = "/sys/class/lego-sensor"
+
+_preadv = getattr(os, "preadv", None)  # Python >= 3.7
+
+
+def find_sensor(address, root=SYSFS_ROOT):
+    """
+    @param address: The port of the sensor, e.g. "ev3-ports:in1"
+    @param root: The lego-sensor class directory
+    @return: The directory of the sensor plugged on that port
+    """
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        try:
+            with open(os.path.join(path, "address")) as f:
+                if f.read().strip() == address:
+                    return path
+        except (IOError, OSError):
+            continue
+    raise LookupError("No sensor on " + address)
+
+
+class SysfsSensor():
+    """
+    Keeps the value files of a sensor open and reads them without allocating new buffers
+    """
+
+    def __init__(self, path, values=1, size=16):
+        """
+        @param path: Directory of the sensor, e.g. find_sensor("ev3-ports:in1") or the _path of an ev3dev2 sensor
+        @param values: How many value<N> files to open
+        @param size: Size of the read buffer, in bytes
+        """
+        self.path = path
+        self.fds = [os.open(os.path.join(path, "value" + str(i)), os.O_RDONLY) for i in range(values)]
+        self._buffer = bytearray(size)
+        self._buffers = [self._buffer]
+        self._mode_fd = None
+
+    def set_mode(self, mode):
+        """
+        Sets the mode of the sensor (e.g. "COL-COLOR", "US-DIST-CM"). Not for the hot path
+        """
+        with open(os.path.join(self.path, "mode"), "w") as f:
+            f.write(mode)
+
+    def write_mode(self, mode):
+        """
+        Writes the mode through a file kept open, for the single shot modes (e.g. "US-SI-CM") where every write starts
+        a new measurement
+        @param mode: The mode, as bytes
+        """
+        if self._mode_fd is None:
+            self._mode_fd = os.open(os.path.join(self.path, "mode"), os.O_WRONLY)
+        os.lseek(self._mode_fd, 0, os.SEEK_SET)
+        os.write(self._mode_fd, mode)
+
+    def read(self, index=0):
+        """
+        @param index: Which value<N> to read
+        @return: Its current integer value
+        """
+        fd = self.fds[index]
+        if _preadv is not None:
+            n = _preadv(fd, self._buffers, 0)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            n = os.readv(fd, self._buffers)
+        buffer = self._buffer
+        value = 0
+        negative = False
+        i = 0
+        while i < n:
+            c = buffer[i]
+            if 48 <= c <= 57:
+                value = value * 10 + c - 48
+            elif c == 45:  # "-"
+                negative = True
+            else:  # the "\n" at the end
+                break
+            i += 1
+        return -value if negative else value
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        if self._mode_fd is not None:
+            os.close(self._mode_fd)
+            self._mode_fd = None
+
+
+def make_fake_sensor(root, name, address, driver_name, mode, values):
+    """
+    Creates the files of a sensor in a fake lego-sensor tree, for testing and benchmarking off the brick
+    @param root: Directory standing for /sys/class/lego-sensor
+    @param name: e.g. "sensor0"
+    @param address: e.g. "ev3-ports:in1"
+    @param driver_name: e.g. "lego-ev3-color"
+    @param mode: e.g. "COL-COLOR"
+    @param values: Initial values of the value<N> files
+    @return: The directory of the sensor
+    """
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    attributes = {"address": address, "driver_name": driver_name, "mode": mode}
+    for i, value in enumerate(values):
+        attributes["value" + str(i)] = value
+    for attribute, value in attributes.items():
+        with open(os.path.join(path, attribute), "w") as f:
+            f.write(str(value) + "\n")
+    return path
+
+
+def write_fake_value(path, value, index=0):
+    """
+    Changes a value<N> file of a fake sensor, the way the driver would
+    """
+    with open(os.path.join(path, "value" + str(index)), "w") as f:
+        f.write(str(value) + "\n")
+
+
+"""
+Background polling of the sensors of a brick: every sensor gets its own thread reading it at its own rate, and the
+values are published in a double buffered snapshot, so the checks of the behaviors only read memory instead of waiting
+for the sysfs reads.
+
+Kept free of ev3dev2 imports, the read functions are given by the caller (e.g. commons.read_color_sensor).
+"""
 import threading
+import time
 
 
-class Behavior(object):
+class SensorService():
     """
-    This is an abstract class. Should embody an specific behavior belonging to a robot. Each Behavior must define three
-    things and should be implemented by the user:
-    1. check: Under what circumcises should this behavior take control.
-    2. action: What should this behavior do while it has control.
-    3. suppress: Should give up control immediately when this method is called. Will be called when a behavior with a
-    higher priority wants to take control.
+    Latest value of every polled sensor, in two preallocated dicts: a publish writes the back one and then flips the
+    generation, so readers always see a complete snapshot. A reader checks the generation did not move while it copied
+    (the writer only touches the buffer a reader may be copying two flips later) and copies again if it did.
     """
 
-    def check(self):
+    def __init__(self, keys, history=None):
         """
-        Method to check whether if this behavior should be started or not.
-        @return: Should return a true value if this behavior should take control or not
+        @param keys: Names of the polled readings, e.g. ("CS_L", "CS_M", "CS_R", "US_B")
+        @param history: The history.SensorHistory every published value is also recorded in, if any
         """
-        raise NotImplementedError("Should have implemented this")
+        self.keys = tuple(keys)
+        self.history = history
+        self._buffers = (dict.fromkeys(self.keys), dict.fromkeys(self.keys))
+        self._stamps = (dict.fromkeys(self.keys), dict.fromkeys(self.keys))  # acquisition times, flipped with the values
+        self.generation = 0
+        self._write_lock = threading.Lock()  # one publish at a time, the pollers run in parallel
+        self._unread = dict.fromkeys(self.keys, False)
+        self._last_generation = 0  # reader side, generation of the last refresh
+        self.pollers = []
+        self.published = dict.fromkeys(self.keys, 0)
+        self.dropped = dict.fromkeys(self.keys, 0)  # values overwritten before any refresh read them
+        self.retries = 0
+        self.listeners = []  # called after every publish, e.g. CONTROLLER.notify for an event driven Controller
+
+    def publish(self, key, value, stamp=None):
+        """
+        Writer side: stores a new value of one reading
+        @param stamp: When it was acquired (CLOCK.time()), now by default
+        """
+        if stamp is None:
+            stamp = CLOCK.time()
+        with self._write_lock:
+            generation = self.generation
+            back = self._buffers[(generation + 1) & 1]
+            back.update(self._buffers[generation & 1])
+            back[key] = value
+            stamps = self._stamps[(generation + 1) & 1]
+            stamps.update(self._stamps[generation & 1])
+            stamps[key] = stamp
+            self.generation = generation + 1
+            self.published[key] += 1
+            if self._unread[key]:
+                self.dropped[key] += 1
+            self._unread[key] = True
+            if self.history is not None:
+                self.history[key].push(value, stamp)
+        for listener in self.listeners:
+            listener()
+
+    def snapshot(self):
+        """
+        Reader side
+        @return: A consistent copy of the last values, as a new dict
+        """
+        while True:
+            generation = self.generation
+            values = dict(self._buffers[generation & 1])
+            if self.generation == generation:
+                return values
+            self.retries += 1
 
-    def action(self):
+    def refresh(self, readings):
         """
-        The code in action should represent what the behavior should do while it's active. When this method returns
-        the action is complete and the robot should be in a complete safe state, ie the motors are shut down and such,
-        so the next behavior can take safely take control of the robot
+        Reader side: copies the last values into readings (a Readings only bumps the versions of the values that changed,
+        and gets their acquisition times)
+        @param readings: The dict to update, e.g. READINGS_DICT
+        @return: Whether something new got published since the last refresh
         """
-        raise NotImplementedError("Should have implemented this")
+        if self.generation == self._last_generation:
+            return False
+        while True:  # copy first, a copy is only stored once the generation proved it is not torn
+            generation = self.generation
+            values = dict(self._buffers[generation & 1])
+            stamps = dict(self._stamps[generation & 1])
+            if self.generation == generation:
+                break
+            self.retries += 1
+        store = getattr(readings, "set", None)
+        if store is not None:
+            for key in self.keys:
+                if stamps[key] is not None:
+                    store(key, values[key], stamps[key])
+        else:
+            for key in self.keys:
+                readings[key] = values[key]
+        self._last_generation = generation
+        unread = self._unread
+        for key in self.keys:
+            unread[key] = False
+        return True
+
+    def add(self, key, read, rate, filter=None):
+        """
+        Polls a sensor in its own thread
+        @param key: The reading to publish the values as
+        @param read: Function returning the value of the sensor, e.g. lambda: read_color_sensor(CS_L)
+        @param rate: Polls per second
+        @param filter: Called on every value before it is published, e.g. a filters.MajorityFilter
+        @return: The SensorPoller
+        """
+        poller = SensorPoller(self, key, read, rate, filter)
+        self.pollers.append(poller)
+        return poller
 
-    def suppress(self):
+    def start(self):
+        for poller in self.pollers:
+            poller.start()
+
+    def stop(self):
+        for poller in self.pollers:
+            poller.stop()
+
+    def stats(self):
         """
-        Should immediately cause the behavior to exits it execution and put the state in safe mode. In other words it
-        should cause the action() method to stop it's execution
+        @return: {key: {"rate", "published", "dropped", "missed", "prevented"}}, missed being the polls that could not be
+        done on time because the previous read took too long, and prevented the spurious activations its filter prevented
         """
-        raise NotImplementedError("Should have implemented this")
+        return {poller.key: {"rate": poller.rate, "published": self.published[poller.key],
+                             "dropped": self.dropped[poller.key], "missed": poller.missed,
+                             "prevented": poller.filter.prevented if poller.filter is not None else 0}
+                for poller in self.pollers}
 
 
-class Controller():
+class SensorPoller():
     """
-    Runs the main subsumption logic. Controls which behavior will run based on their priority and if they want to become
-    active or not. Works as a scheduler, where only one behavior can be active at a time and who is active is decided by
-    the sensor data and their priority. The previous active behavior gets suppressed when a behavior with a higher
-    priority wants to run.
-
-    There is two usages in this class. One is to make the class take care of scheduler itself, by calling the start()
-    method. The other is to take care of the scheduler by yourself, by using the step() method
+    Thread reading one sensor at a fixed rate and publishing what it read in a SensorService
     """
 
-    def __init__(self, return_when_no_action):
-        """
-        Initialize the object. Notice the subsumption module is not bound to a specific brick, the behaviors are. This
-        makes it possible to have a subsumption module responsible for multiple bricks at the same time, if desirable.
-        """
-        self.behaviors = []
-        self.wait_object = threading.Event()
-        self.active_behavior_index = None
+    def __init__(self, service, key, read, rate, filter=None):
+        self.service = service
+        self.key = key
+        self.read = read
+        self.rate = rate
+        self.filter = filter
+        self.missed = 0
+        self._running = False
+        self._thread = None
 
+    def start(self):
         self._running = True
-        self._return_when_no_action = return_when_no_action
+        self._thread = threading.Thread(name="Sensor poller " + self.key, target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
 
-        self.callback = lambda x: 0
+    def stop(self):
+        self._running = False
 
-    def add(self, behavior):
-        """
-        Add a behavior to the behavior module. The order decide which priority they have. First > Second
-        @type behavior: Behavior
-        """
-        self.behaviors.append(behavior)
+    def _run(self):
+        period = 1.0 / self.rate
+        publish, read, key = self.service.publish, self.read, self.key
+        if self.filter is not None:
+            raw, filter = read, self.filter
+            read = lambda: filter(raw())
+        next_tick = time.monotonic()
+        while self._running:
+            publish(key, read())
+            next_tick += period
+            now = time.monotonic()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+            else:  # the read took longer than the period, the polls that should have happened meanwhile are lost
+                self.missed += int((now - next_tick) / period) + 1
+                next_tick = now
+
+
+"""
+Process split runtime: the sensor polling and the bluetooth link run in their own process and publish the readings in a
+shared memory block, so they do not fight over the GIL with the checker and action threads of the Controller. The
+controller side copies the block into its Readings (see SharedReadings.refresh) without any IPC round trip.
+
+Kept free of ev3dev2 imports so it can be benchmarked off the brick.
+"""
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
 
-    def remove(self, index):
-        old_behavior = self.behaviors[index]
-        del self.behaviors[index]
-        if self.active_behavior_index == index:  # stop the old one if the new one overrides it
-            old_behavior.suppress()
-            self.active_behavior_index = None
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, e.g. the one on the brick: fall back to an anonymous shared mmap
+    shared_memory = None
 
-    def update(self, behavior, index):
-        old_behavior = self.behaviors[index]
-        self.behaviors[index] = behavior
-        if self.active_behavior_index == index:  # stop the old one if the new one overrides it
-            old_behavior.suppress()
+UNKNOWN_LABEL = "unknown"  # what readers get for a published label missing from the labels table
 
-    def step(self):
+
+class SharedBlock():
+    """
+    A block of memory shared with the processes forked after its creation
+    """
+
+    def __init__(self, size):
+        self.size = size
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self.buf = self._shm.buf
+        else:
+            self._shm = None
+            self.buf = mmap.mmap(-1, size)  # MAP_SHARED | MAP_ANONYMOUS, inherited by fork()
+
+    def close(self):
         """
-        Find the next active behavior and runs it.
-        @return: Returns whether it got to run any behavior or not
+        Frees the block. Only the process that created it should call this
         """
-        behavior = self.find_next_active_behavior()
-        if behavior is not None:
-            self.behaviors[behavior].action()
-            return True
-        return False
+        if self._shm is not None:
+            self.buf = None
+            self._shm.close()
+            self._shm.unlink()
+        else:
+            self.buf.close()
 
-    def find_next_active_behavior(self):
+
+class SharedReadings():
+    """
+    Fixed layout of readings in a SharedBlock, protected by a seqlock: the writer makes the sequence number odd, writes
+    the values, then makes it even again; a reader retries until it read the same even number before and after copying
+    the values. Readers never block the writer. The writer keeps its values in a preallocated list and packs them
+    straight into the block, so a publish builds no buffer, only the small tuples of the encoding and of the arguments.
+
+    Every reading is stored as a tag (None, bool, int, float or label), a double and its acquisition time, labels (e.g.
+    the color names) being stored as their index in the labels table given at construction. A label missing from the
+    table is published as UNKNOWN_LABEL and counted in unknown, instead of killing the writer process.
+
+    A single process writes (the sensor process), any number read. The EV3 has a single core, so the plain stores of
+    the writer are seen in order by the readers.
+    """
+
+    NONE, BOOL, INT, FLOAT, LABEL, UNKNOWN = 0, 1, 2, 3, 4, 5
+
+    _SEQ = struct.Struct("<Q")
+
+    def __init__(self, keys, labels=()):
         """
-        Finds the next behavior that wants to run, if any
-        @return: Next runnable behavior if any
-        @rtype: int
+        @param keys: Names of the readings, e.g. list(READINGS_DICT)
+        @param labels: The non numeric values the readings can take, e.g. the color names
         """
-        for priority, behavior in enumerate(self.behaviors):
-            if behavior.check():
-                return priority
+        self.keys = tuple(keys)
+        self.labels = tuple(labels)
+        self._label_index = {label: i for i, label in enumerate(self.labels)}
+        # time of the publish, unknown labels so far, then (tag, value, acquisition time) per key
+        self._payload = struct.Struct("<dQ" + "Bdd" * len(self.keys))
+        self.block = SharedBlock(self._SEQ.size + self._payload.size)
+        self._values = [self.NONE, 0.0, 0.0] * len(self.keys)  # writer side copy of the payload
+        self._index = {key: 3 * i for i, key in enumerate(self.keys)}
+        self._seq = 0
+        self._last_seq = 0  # reader side, sequence number of the last refresh
+        self.stamp = None  # reader side, time of the publish read by the last refresh
+        self.retries = 0  # reader side, reads that had to be done again because of a concurrent write
+        self.unknown = 0  # values not in labels published so far, counted by the writer and read back by refresh()
+        self.changed = multiprocessing.get_context("fork").Event()  # set by every publish, see watch()
+
+    def _encode(self, value):
+        if value is None:
+            return self.NONE, 0.0
+        if value is True or value is False:
+            return self.BOOL, float(value)
+        if isinstance(value, int):
+            return self.INT, float(value)
+        if isinstance(value, float):
+            return self.FLOAT, value
+        index = self._label_index.get(value)
+        if index is None:
+            self.unknown += 1
+            return self.UNKNOWN, 0.0
+        return self.LABEL, float(index)
+
+    def _decode(self, tag, value):
+        if tag == self.INT:
+            return int(value)
+        if tag == self.LABEL:
+            return self.labels[int(value)]
+        if tag == self.BOOL:
+            return value != 0.0
+        if tag == self.FLOAT:
+            return value
+        if tag == self.UNKNOWN:
+            return UNKNOWN_LABEL
         return None
 
-    def _find_and_set_new_active_behavior(self):
-        new_behavior_priority = self.find_next_active_behavior()
-        if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
-            if self.active_behavior_index is not None:
-                self.behaviors[self.active_behavior_index].suppress()
-            self.active_behavior_index = new_behavior_priority
+    def publish(self, values, stamp=None, stamps=None):
+        """
+        Writer side: stores the given readings (the others keep their last value)
+        @param values: {key: value} for some or all of the keys
+        @param stamp: When the values were acquired (time.monotonic()), now by default
+        @param stamps: {key: acquisition time} of the values not acquired at stamp (e.g. received earlier on the link)
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        payload = self._values
+        for key, value in values.items():
+            i = self._index[key]
+            payload[i], payload[i + 1] = self._encode(value)
+            payload[i + 2] = stamps[key] if stamps is not None and key in stamps else stamp
+
+        buf = self.block.buf
+        seq = self._seq
+        self._SEQ.pack_into(buf, 0, seq + 1)  # odd: write in progress
+        self._payload.pack_into(buf, self._SEQ.size, stamp, self.unknown, *payload)
+        self._SEQ.pack_into(buf, 0, seq + 2)
+        self._seq = seq + 2
+        self.changed.set()
 
-            # Callback to tell something it changed the active behavior if anything is interested
-            self.callback(self.active_behavior_index)
+    def _read(self):
+        buf = self.block.buf
+        while True:
+            seq = self._SEQ.unpack_from(buf, 0)[0]
+            if not seq & 1:
+                data = self._payload.unpack_from(buf, self._SEQ.size)
+                if self._SEQ.unpack_from(buf, 0)[0] == seq:
+                    return seq, data
+            self.retries += 1
+
+    def snapshot(self):
+        """
+        Reader side
+        @return: (time of the publish, {key: value}) of the last complete publish
+        """
+        seq, data = self._read()
+        self.unknown = data[1]
+        return data[0], {key: self._decode(data[2 + 3 * i], data[3 + 3 * i]) for i, key in enumerate(self.keys)}
 
-    def _start(self):  # run the action methods
+    def refresh(self, readings):
         """
-        Starts finding and running behaviors, suppressing the old behaviors when new behaviors with higher priority
-        wants to run.
+        Reader side: copies the last published values into readings (a Readings only bumps the versions of the values
+        that changed, and gets their acquisition times). Costs a single 8 bytes read when nothing got published since
+        the last call
+        @param readings: The dict to update, e.g. READINGS_DICT
+        @return: Whether something new got published
         """
-        self._running = True
-        self._find_and_set_new_active_behavior()  # force do it ourselves once to find the right one
-        thread = threading.Thread(name="Continuous behavior checker",
-                                  target=self._continuously_find_new_active_behavior, args=())
+        if self._SEQ.unpack_from(self.block.buf, 0)[0] == self._last_seq:
+            return False
+        seq, data = self._read()
+        self._last_seq = seq
+        self.stamp = data[0]
+        self.unknown = data[1]
+        decode = self._decode
+        store = getattr(readings, "set", None)
+        for i, key in enumerate(self.keys):
+            value = decode(data[2 + 3 * i], data[3 + 3 * i])
+            if store is None:
+                readings[key] = value
+            elif data[4 + 3 * i]:  # never published otherwise
+                store(key, value, data[4 + 3 * i])
+        return True
+
+    def watch(self, notify):
+        """
+        Reader side: calls notify from a thread of this process every time something got published, so an event driven
+        Controller runs its arbitration pass (and the refresh) right away instead of waiting for its deadline
+        @param notify: e.g. CONTROLLER.notify
+        """
+        def run():
+            while True:
+                self.changed.wait()
+                self.changed.clear()
+                notify()
+
+        thread = threading.Thread(name="Shared readings watcher", target=run, args=())
         thread.daemon = True
         thread.start()
 
-        while self._running:
-            if self.active_behavior_index is not None:
-                running_behavior = self.active_behavior_index
-                self.behaviors[running_behavior].action()
-                if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
-                    self.active_behavior_index = None
-                    self._find_and_set_new_active_behavior()
+    def close(self):
+        self.block.close()
 
-            elif self._return_when_no_action:
-                break
 
-        #Nothing more to do, so we are shutting down
+class SensorProcess():
+    """
+    Process polling the sensors (and the link) at a fixed rate and publishing what it read in a SharedReadings
+    """
+
+    def __init__(self, shared, make_poll, period=0.01):
+        """
+        @param shared: The SharedReadings to publish into
+        @param make_poll: Called once in the new process (e.g. to start the link listener there), returns the function
+        called every period that reads the sensors and returns {key: value}, or ({key: value}, {key: acquisition time})
+        when some values were acquired earlier than the poll
+        @param period: Polling period in seconds
+        """
+        self.shared = shared
+        self.make_poll = make_poll
+        self.period = period
+        context = multiprocessing.get_context("fork")  # the shared block and the devices are inherited, not pickled
+        self._stop = context.Event()
+        self.process = context.Process(name="Sensor process", target=self._run, args=())
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self._stop.set()
+        self.process.join()
+
+    def _run(self):
+        poll = self.make_poll()
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            stamp = time.monotonic()
+            values = poll()
+            if isinstance(values, tuple):
+                self.shared.publish(values[0], stamp, values[1])
+            else:
+                self.shared.publish(values, stamp)
+            next_tick += self.period
+            now = time.monotonic()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+            else:
+                next_tick = now
+
+
+"""
+Time slots for the ultrasonic sensors of both bricks, so they never ping at the same time and hear each other's echoes
+(the bogus cliff readings of US_B). The sensors run in single shot mode (every write of the mode sends one ping) and
+each one only pings in its own slots of a schedule shared by the bricks.
+
+The master negotiates the schedule over the bluetooth link:
+    1. a few clock sync rounds: the master sends "!SYNC,<master time>", the slave answers "!SYNC,<master time>,<slave
+       time>" right away, and the round trip with the smallest delay gives the offset between the two clocks;
+    2. the master sends "!PINGS,<start>,<slot>,<owners>", start being given on the clock of the slave, and both bricks
+       run the same schedule from there;
+    3. the clocks of the bricks drift apart (by tens of ppm), so every RESYNC_PERIOD the master syncs them again and
+       sends the same schedule with the new offset.
+
+Kept free of ev3dev2 imports so the schedules can be built and checked off the brick.
+"""
+import threading
+
+SINGLE_SHOT_MODE = "US-SI-CM"  # every write of this mode makes the sensor ping once
+SLOT_MIN = 0.03  # seconds a ping needs: echo from up to 2.5 m and measurement by the sensor
+SETTLE = 0.8  # part of the slot waited for before reading the value of a ping
+LEAD_TIME = 0.5  # seconds between the negotiation and the start of the schedule
+RESYNC_PERIOD = 10.0  # seconds between two clock syncs, far below the drift that would eat the margin of a slot
+
+
+def make_schedule(rates, slot_min=SLOT_MIN):
+    """
+    Spreads the pings of the sensors over a frame of one second, every sensor getting as many slots as its rate and its
+    slots being as evenly spaced as possible (smooth weighted round robin)
+    @param rates: {sensor: pings per second}, e.g. {"US_B": 10, "US_F": 10}
+    @param slot_min: Shortest slot the sensors can work with
+    @return: (slot duration, [owner of every slot of the frame])
+    @raise ValueError: If a rate is not a whole number of pings, or the rates do not fit in a second with slots of
+    slot_min
+    """
+    for sensor, rate in rates.items():
+        if rate < 0 or rate != int(rate):
+            raise ValueError("The rate of {} must be a whole number of pings per second, not {}".format(sensor, rate))
+    rates = {sensor: int(rate) for sensor, rate in rates.items()}
+    total = sum(rates.values())
+    if total <= 0:
+        raise ValueError("No pings to schedule")
+    slot = 1.0 / total
+    if slot < slot_min:
+        raise ValueError("{} pings per second do not fit in slots of {} s".format(total, slot_min))
+    credits = dict.fromkeys(rates, 0)
+    owners = []
+    for _ in range(total):
+        for sensor, rate in rates.items():
+            credits[sensor] += rate
+        owner = max(sorted(credits), key=lambda sensor: credits[sensor])
+        credits[owner] -= total
+        owners.append(owner)
+    return slot, owners
+
+
+def encode_schedule(start, slot, owners):
+    """
+    @return: The payload of a "!PINGS" message
+    """
+    return "{!r},{!r},{}".format(start, slot, ";".join(owners))
+
+
+def decode_schedule(payload):
+    """
+    @return: (start, slot, owners) of the payload of a "!PINGS" message
+    """
+    start, slot, owners = payload.split(",", 2)
+    return float(start), float(slot), owners.split(";")
+
+
+class PingScheduler():
+    """
+    Runs the schedule for the sensors of this brick: in each of their slots it triggers a ping, waits for the echo and
+    publishes the value. The slots of the other brick are left silent
+    """
+
+    def __init__(self, sensors, publish, clock=CLOCK):
+        """
+        @param sensors: {key: (trigger, read)} of the ultrasonic sensors of this brick, trigger sending one ping (e.g.
+        writing SINGLE_SHOT_MODE to the mode) and read returning its value
+        @param publish: Called with (key, value) after every ping, e.g. SensorService.publish
+        @param clock: The clock the schedule start is given on
+        """
+        self.sensors = sensors
+        self.publish = publish
+        self.clock = clock
+        self.schedule = None  # (start, slot, owners), replaced as a whole
+        self.pings = dict.fromkeys(sensors, 0)
+        self.late = 0  # slots of this brick skipped because the previous ping ended too late
+        self.latest = dict.fromkeys(sensors)
+        self._changed = threading.Event()
         self._running = False
+        self._thread = None
 
-    def start(self, run_in_thread=False):
-        if run_in_thread:
-            thread = threading.Thread(name="Subsumption Thread",
-                                      target=self._start, args=())
-            thread.daemon = True
-            thread.start()
-        else:
-            self._start()
+    def set_schedule(self, start, slot, owners):
+        """
+        @param start: When the first frame starts, on the clock of this brick
+        @param slot: Duration of a slot, in seconds
+        @param owners: Sensor of every slot of the frame
+        """
+        self.schedule = (start, slot, tuple(owners))
+        self._changed.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(name="Ping scheduler", target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
 
     def stop(self):
         self._running = False
-        self.behaviors[self.active_behavior_index].suppress()
+        self._changed.set()
 
-    def _continuously_find_new_active_behavior(self):
+    def _next_slot(self, schedule, now):
+        """
+        @return: (slot start, owner) of the next slot of a sensor of this brick starting at now or later
+        """
+        start, slot, owners = schedule
+        index = max(0, int((now - start) / slot))
+        if start + index * slot < now:
+            index += 1
+        for i in range(index, index + len(owners)):
+            if owners[i % len(owners)] in self.sensors:
+                return start + i * slot, owners[i % len(owners)]
+        return None, None
+
+    def _run(self):
+        clock = self.clock
         while self._running:
-            self._find_and_set_new_active_behavior()
+            schedule = self.schedule
+            if schedule is None:
+                self._changed.wait()
+                self._changed.clear()
+                continue
+            at, key = self._next_slot(schedule, clock.time())
+            if key is None:  # no slot for this brick
+                self._changed.wait()
+                self._changed.clear()
+                continue
+            wait = at - clock.time()
+            if wait > 0 and self._changed.wait(wait):  # new schedule meanwhile
+                self._changed.clear()
+                continue
+            if clock.time() - at > schedule[1] * (1 - SETTLE):  # too late to get the echo within the slot
+                self.late += 1
+                continue
+            trigger, read = self.sensors[key]
+            trigger()
+            clock.sleep(max(0.0, at + schedule[1] * SETTLE - clock.time()))
+            value = read()
+            self.pings[key] += 1
+            self.latest[key] = value
+            self.publish(key, value)
+
+    def stats(self):
+        """
+        @return: {"pings": {key: pings so far}, "late": slots missed, "rates": {key: scheduled pings per second}}
+        """
+        rates = {}
+        if self.schedule is not None:
+            start, slot, owners = self.schedule
+            frame = slot * len(owners)
+            rates = {key: owners.count(key) / frame for key in self.sensors}
+        return {"pings": dict(self.pings), "late": self.late, "rates": rates}
+
+
+class ClockSync():
+    """
+    Master side of the clock sync rounds: estimates the offset between the clock of the slave and the one of this
+    brick, keeping the round trip with the smallest delay
+    """
+
+    def __init__(self, clock=CLOCK):
+        self.clock = clock
+        self.offset = None  # slave clock - master clock
+        self.delay = None  # round trip of the best sample
+        self.replies = 0
+        self._replied = threading.Event()
+
+    def request(self):
+        """
+        @return: The "!SYNC" message to send to the slave
+        """
+        self._replied.clear()
+        return "!SYNC,{!r}".format(self.clock.time())
+
+    def handle_reply(self, payload):
+        """
+        Handles the answer of the slave: "<master time>,<slave time>"
+        """
+        now = self.clock.time()
+        sent, remote = (float(v) for v in payload.split(","))
+        delay = now - sent
+        if self.delay is None or delay < self.delay:
+            self.delay = delay
+            self.offset = remote - (sent + delay / 2)  # the slave read its clock half way through the round trip
+        self.replies += 1
+        self._replied.set()
+
+    def wait(self, timeout):
+        return self._replied.wait(timeout)
+
+    def reset(self):
+        """
+        Forgets the samples, before syncing again
+        """
+        self.offset = None
+        self.delay = None
+
+
+def _sync_clocks(connection, sync, rounds, timeout):
+    for _ in range(rounds):
+        connection.write(sync.request())
+        sync.wait(timeout)
+
+
+def _resync(connection, scheduler, sync, period, rounds, timeout):
+    """
+    Master side, in its own thread: syncs the clocks again every period and sends the schedule with the new offset,
+    until the scheduler stops. A failed sync keeps the previous offset
+    """
+    clock = sync.clock
+    while scheduler._running:
+        clock.sleep(period)
+        previous = (sync.offset, sync.delay)
+        sync.reset()
+        _sync_clocks(connection, sync, rounds, timeout)
+        if sync.offset is None:
+            sync.offset, sync.delay = previous
+            continue
+        start, slot, owners = scheduler.schedule
+        connection.write("!PINGS," + encode_schedule(start + sync.offset, slot, owners))
+
+
+def negotiate_pings(connection, scheduler, rates, rounds=5, timeout=1.0, resync=RESYNC_PERIOD, clock=CLOCK):
+    """
+    Master side: syncs the clocks with the slave, builds the schedule and sends it, then runs it for the sensors of this
+    brick and keeps the clocks in sync while the scheduler runs. The connection must be listening already
+    @param connection: The commons.BluetoothConnection to the slave
+    @param scheduler: The PingScheduler of this brick
+    @param rates: {sensor: pings per second} of the sensors of both bricks
+    @param rounds: Clock sync round trips
+    @param timeout: Seconds to wait for each answer
+    @param resync: Seconds between two clock syncs once the schedule runs, None to sync only once
+    @return: The ClockSync (offset and delay of the best round of the last sync)
+    @raise IOError: If the slave never answered
+    """
+    sync = ClockSync(clock)
+    connection.on("SYNC", sync.handle_reply)
+    _sync_clocks(connection, sync, rounds, timeout)
+    if sync.offset is None:
+        raise IOError("The slave did not answer the clock sync")
+    slot, owners = make_schedule(rates)
+    start = clock.time() + LEAD_TIME
+    connection.write("!PINGS," + encode_schedule(start + sync.offset, slot, owners))
+    scheduler.set_schedule(start, slot, owners)
+    if resync:
+        thread = threading.Thread(name="Ping resync", target=_resync,
+                                  args=(connection, scheduler, sync, resync, rounds, timeout))
+        thread.daemon = True
+        thread.start()
+    return sync
+
+
+def serve_pings(connection, scheduler, clock=CLOCK):
+    """
+    Slave side: answers the clock sync rounds of the master and runs the schedules it sends. Call it before the
+    connection starts listening
+    @param connection: The commons.BluetoothConnection to the master
+    @param scheduler: The PingScheduler of this brick
+    """
+    connection.on("SYNC", lambda payload: connection.write("!SYNC,{},{!r}".format(payload, clock.time())))
+    connection.on("PINGS", lambda payload: scheduler.set_schedule(*decode_schedule(payload)))
+
 
-    def __str__(self):
-        return str(self.behaviors)
-    
-#!/usr/bin/env python3
 
 DEBUG = False
 if DEBUG:
@@ -167,7 +3052,7 @@ if DEBUG:
 import random
 from ev3dev2.motor import SpeedPercent
 from ev3dev2.sound import Sound
-import bluetooth, threading, time
+import bluetooth, os, threading, time
 
 
 SOUND_NO_BLOCK = Sound.PLAY_NO_WAIT_FOR_COMPLETE # sound option that doesn't block the program
@@ -188,7 +3073,7 @@ def set_leds_color(leds, color):
 
 def feedback_leds_blocking(leds, color): # for generated code
     set_leds_color(leds, color)
-    time.sleep(0.5)
+    CLOCK.sleep(0.5)
     leds.reset()
 
 
@@ -225,6 +3110,7 @@ class Motor():
     def __init__(self, motor, base_speed=BASE_SPEED):
         self.motor = motor
         self.base_speed = base_speed
+        self.stop_hooks = []  # called after every stop, e.g. CONTROLLER.preemption.motor_stopped
         # self.log_distance = 0
         # self.log_angle = 0
 
@@ -258,6 +3144,8 @@ class Motor():
 
     def stop(self):
         self.motor.stop()
+        for hook in self.stop_hooks:
+            hook()
 
     def odometry_start(self):
         self.motor.odometry_start()
@@ -380,6 +3268,10 @@ class BluetoothConnection():
         self.port = port
         self.debug = debug
         self.buffer = [""] # buffer for the data that is received
+        self.received = 0  # number of messages received so far
+        self.received_at = None  # when the last message was received (CLOCK.time())
+        self.handlers = {}  # tag -> procedure, for the control messages ("!<tag>,<payload>")
+        self._write_lock = threading.Lock()  # the readings and the control messages are sent from different threads
         
         self.startup()
 
@@ -420,8 +3312,17 @@ class BluetoothConnection():
         Sends data to the other brick.
         @param data: The data to send
         """
-        self.sock_out.write(str(data) + "\n")
-        self.sock_out.flush()
+        with self._write_lock:
+            self.sock_out.write(str(data) + "\n")
+            self.sock_out.flush()
+
+    def on(self, tag, procedure):
+        """
+        Handles the control messages with the given tag in the listening thread instead of the data buffer
+        @param tag: e.g. "SYNC" for the "!SYNC,..." messages
+        @param procedure: Called with the payload of the message (what follows the first comma)
+        """
+        self.handlers[tag] = procedure
 
     def _read(self):
         """
@@ -439,16 +3340,26 @@ class BluetoothConnection():
         """
         while True:
             data = self._read()
+            if data.startswith("!"):
+                tag, _, payload = data[1:].partition(",")
+                handler = self.handlers.get(tag)
+                if handler is not None:
+                    handler(payload)
+                continue
             self.buffer[0] = str(data)
+            self.received_at = CLOCK.time()
+            self.received += 1
             procedure(data)
     
     def start_listening(self, procedure):
         """
         Starts listening for data from the other brick, by opening a thread.
-        @param procedure: The procedure to call when data is received (that take the data as argument)
+        @param procedure: The procedure to call when data is received (that take the data as argument), e.g.
+        lambda data: CONTROLLER.notify() so an event driven Controller handles the new readings right away
         """
 
         listener = threading.Thread(target=self._listen, args=[procedure])
+        listener.daemon = True  # does not keep the program alive once the missions are done
         listener.start()
 
     def get_data(self):
@@ -469,64 +3380,195 @@ class BluetoothConnection():
             self.server_sock.close()
 
 
-def set_color_ranges(color_dict, ranges, color_name):
-    for r_range, g_range, b_range in ranges:
-        for red in range(r_range[0], r_range[1] + 1):
-            for green in range(g_range[0], g_range[1] + 1):
-                for blue in range(b_range[0], b_range[1] + 1):
-                    color_dict[(red, green, blue)] = color_name
+SENSOR_RETRIES = 3  # reads tried before falling back to the last good value
+SENSOR_TIMEOUT = 0.05  # seconds a read (waiting for the device lock included) may take
+
+
+class SensorAccess():
+    """
+    Access layer to the sensors shared by the threads of a brick: one lock per device, a bounded number of retries
+    within a timeout, and the last good value of the device (or a default) when it keeps failing, so a flaky sensor
+    can not stall the control loop. Failed reads and fallbacks are counted per device.
+
+    The timeout bounds the retries of the failed reads and the wait for the lock, not a read itself: Python can not
+    interrupt a read hanging in the driver, so its caller stays blocked until it returns (and it gets counted in slow),
+    while the other threads reading the device get the fallback after the timeout since the lock is still held.
+    """
+    def __init__(self, retries=SENSOR_RETRIES, timeout=SENSOR_TIMEOUT):
+        self.retries = retries
+        self.timeout = timeout
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.last_good = {}
+        self.failures = {}  # device -> reads that raised
+        self.fallbacks = {}  # device -> times the last good value (or the default) got returned instead of a read
+        self.slow = {}  # device -> successful reads that returned after the timeout
+
+    def lock(self, device):
+        """
+        @return: The lock of the device, created the first time
+        """
+        lock = self._locks.get(device)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(device, threading.Lock())
+        return lock
+
+    def read(self, device, read, default=None, name="Sensor"):
+        """
+        @param device: The sensor (ev3dev2 object or SysfsSensor)
+        @param read: Function reading the device, given the device
+        @param default: Value to return if the device failed before ever being read successfully
+        @param name: For the debug log
+        @return: The value read, or the fallback
+        """
+        deadline = time.monotonic() + self.timeout
+        lock = self.lock(device)
+        if lock.acquire(timeout=self.timeout):
+            try:
+                for _ in range(self.retries):
+                    try:
+                        value = read(device)
+                    except Exception:
+                        self.failures[device] = self.failures.get(device, 0) + 1
+                        if DEBUG:
+                            timedlog(name + " wrong read")
+                        if time.monotonic() > deadline:
+                            break
+                        continue
+                    if time.monotonic() > deadline:
+                        self.slow[device] = self.slow.get(device, 0) + 1
+                    self.last_good[device] = value
+                    return value
+            finally:
+                lock.release()
+        self.fallbacks[device] = self.fallbacks.get(device, 0) + 1
+        return self.last_good.get(device, default)
+
+    def stats(self):
+        """
+        @return: {device name: {"failures", "fallbacks", "slow"}} of the devices that failed or were slow at least once
+        """
+        devices = set(self.failures) | set(self.fallbacks) | set(self.slow)
+        return {str(device): {"failures": self.failures.get(device, 0), "fallbacks": self.fallbacks.get(device, 0),
+                              "slow": self.slow.get(device, 0)}
+                for device in devices}
+
+
+SENSORS = SensorAccess()
+
+
+def _color(cs):
+    return int2color(cs.color)
+
+def _rgb(cs, lut):
+    red, green, blue = cs.rgb
+    return lut.classify(red, green, blue)
+
+def _distance(ultrasonic_sensor):
+    return ultrasonic_sensor.value()
+
+def _pressed(touch_sensor):
+    return touch_sensor.is_pressed
+
+def _color_fast(reader):
+    return int2color(reader.read())
+
+def _rgb_fast(reader, lut):
+    return lut.classify(reader.read(0), reader.read(1), reader.read(2))
+
+def _distance_fast(reader):
+    return reader.read()
 
 
 def read_color_sensor(cs):  
     """
     Reads the color sensor and returns the color that was read.
     @param color_sensor: The color sensor to read
-    @return: The color that was read
+    @return: The color that was read (the last good one, or None, if the sensor keeps failing)
     """
-    lock = threading.Lock()
+    return SENSORS.read(cs, _color, None, "Color sensor")
 
-    with lock:
-        try:
-            color = cs.color
-        except: 
-            if DEBUG:
-                timedlog("Color sensor wrong read")
-            return read_color_sensor(cs)
-        return int2color(color)
+# written by calibrate_color.py, looked for next to the program rather than in the directory it is started from
+COLOR_LUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "color_lut.bin")
+# the same for the RGB-RAW values of the fast path (calibrate_color.py record --mode RGB-RAW, fit --in-bits 10)
+COLOR_LUT_RAW_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "color_lut_raw.bin")
+
+def load_color_lut(path=COLOR_LUT_FILE, in_bits=8):
+    """
+    Maps the table calibrated for the arena, see calibrate_color.py
+    @param in_bits: The input range the table must be built for, 8 for ColorSensor.rgb
+    @return: The color_lut.ColorLUT, or one built from the default ranges if the file is missing or not usable
+    """
+    try:
+        lut = ColorLUT.load(path)
+        if lut.in_bits != in_bits:
+            raise ValueError(path + " is not built for {} bits values".format(in_bits))
+        return lut
+    except (IOError, OSError, ValueError) as e:
+        if DEBUG:
+            timedlog("No calibrated color table ({}), using the default ranges".format(e))
+        return ColorLUT.from_ranges(in_bits=in_bits)
+
+COLOR_LUT = load_color_lut()  # on ColorSensor.rgb values
+
+def read_color_sensor_rgb(cs, lut=COLOR_LUT):
+    """
+    Reads the color sensor in RGB mode and classifies the values with a lookup table instead of the sensor's own color
+    detection.
+    @param cs: The color sensor to read
+    @param lut: The color_lut.ColorLUT to classify with, built for 0-255 values
+    @return: The color that was read (the last good one, or None, if the sensor keeps failing)
+    """
+    return SENSORS.read(cs, lambda device: _rgb(device, lut), None, "Color sensor")
 
 def read_ultrasonic_sensor(ultrasonic_sensor):
     """
     Reads the ultrasonic sensor and returns the distance.
     @param color_sensor: The ultrasonic sensor to read
-    @return: The distance that was read
+    @return: The distance that was read (the last good one, or 1000, if the sensor keeps failing)
     """
-    lock = threading.Lock()
-    
-    with lock:
-        try:
-            distance = ultrasonic_sensor.value()
-        except: 
-            if DEBUG:
-                timedlog("Ultrasonic sensor wrong read")
-            return read_ultrasonic_sensor(ultrasonic_sensor)
-        return distance
+    return SENSORS.read(ultrasonic_sensor, _distance, 1000, "Ultrasonic sensor")
+
+def open_sysfs_sensor(sensor, mode=None, values=1):
+    """
+    Opens the fast path to the values of an ev3dev2 sensor, for read_color_sensor_fast, read_color_sensor_rgb_fast and
+    read_ultrasonic_sensor_fast
+    @param sensor: The ev3dev2 sensor
+    @param mode: The mode to put the sensor in first (the fast path does not switch modes by itself), e.g. "COL-COLOR"
+    @param values: How many values to read, 3 for "RGB-RAW"
+    @return: The SysfsSensor
+    """
+    if mode is not None:
+        sensor.mode = mode
+    return SysfsSensor(sensor._path, values)
+
+def read_color_sensor_fast(reader):
+    """
+    Same as read_color_sensor, for a SysfsSensor opened on a color sensor in COL-COLOR mode
+    """
+    return SENSORS.read(reader, _color_fast, None, "Color sensor")
+
+def read_color_sensor_rgb_fast(reader, lut):
+    """
+    Same as read_color_sensor_rgb, for a SysfsSensor opened with values=3 on a color sensor in RGB-RAW mode, so lut must
+    be built with in_bits=10
+    """
+    return SENSORS.read(reader, lambda device: _rgb_fast(device, lut), None, "Color sensor")
+
+def read_ultrasonic_sensor_fast(reader):
+    """
+    Same as read_ultrasonic_sensor, for a SysfsSensor opened on an ultrasonic sensor
+    """
+    return SENSORS.read(reader, _distance_fast, 1000, "Ultrasonic sensor")
 
 def read_touch_sensor(touch_sensor):
     """
     Reads the touch sensor and returns the distance.
     @param color_sensor: The touch sensor to read
-    @return: The touch that was read
+    @return: The touch that was read (the last good one, or False, if the sensor keeps failing)
     """
-    lock = threading.Lock()
-    
-    with lock:
-        try:
-            touch = touch_sensor.is_pressed
-        except: 
-            if DEBUG:
-                timedlog("Touch sensor wrong read")
-            return read_touch_sensor(touch_sensor)
-        return touch
+    return SENSORS.read(touch_sensor, _pressed, False, "Touch sensor")
 
 
 def set_global_MEASURE_OBJ(value):
@@ -539,4 +3581,4 @@ def set_global_OVERRIDED_LAKE(value):
 
 def set_global_MEASURE_LAKE(value):
     global MEASURE_LAKE
-    MEASURE_LAKE = value
\ No newline at end of file
+    MEASURE_LAKE = value
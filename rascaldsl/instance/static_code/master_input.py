@@ -15,11 +15,15 @@ CS_L, CS_M, CS_R, US_B, M_L, M_R, M_A, LEFT, RIGHT = INPUT_1, INPUT_2, INPUT_3,
 
 CS_L, CS_M, CS_R, US_B, move_differential, arm_steering, LEDS, S = ColorSensor(CS_L), ColorSensor(CS_M), ColorSensor(CS_R), UltrasonicSensor(US_B), MoveDifferential(M_L, M_R, wheel_class=EV3EducationSetTire, wheel_distance_mm=123), MediumMotor(M_A), Leds(), Sound()
 
-US_B.mode = 'US-DIST-CM'
+US_B.mode = SINGLE_SHOT_MODE  # pinged by start_ping_scheduler(), start_sensor_service(pings=False) switches it back
 MOTOR = Motor(move_differential)
 ARM = ArmMotor(arm_steering)
 
-READINGS_DICT = {"TS_L": False, "TS_R": False, "TS_B": False, "US_F": 1000, "US_B": 1000, "CS_R": None, "CS_M": None, "CS_L": None}
+READINGS_DICT = Readings({"TS_L": False, "TS_R": False, "TS_B": False, "US_F": 1000, "US_B": 1000, "CS_R": None, "CS_M": None, "CS_L": None})
+READINGS_MAX_AGE = 0.5  # seconds after which a reading is stale, see Behavior.max_age
+# what CliffAvoidanceBhv, EdgeAvoidanceBhv and LakeAvoidanceBhv read, then the slave readings of AvoidCollisionBhv and
+# RecoverCollisionBhv, which freeze whenever the bluetooth link stalls
+SAFETY_READINGS = ("US_B", "CS_L", "CS_M", "CS_R", "US_F", "TS_L", "TS_R", "TS_B")
 TASK_REGISTRY = TaskRegistry()
 TASK_REGISTRY.add("RunningBhv")
 
@@ -27,6 +31,7 @@ TASK_REGISTRY.add("RunningBhv")
 BLUETOOTH_CONNECTION = BluetoothConnection(MASTER, MASTER_MAC, debug=DEBUG)
 
 class RunningBhv(Behavior):
+    resources = (RES_DRIVE,)
 
     def __init__(self):
         Behavior.__init__(self)
@@ -69,10 +74,34 @@ class RunningBhv(Behavior):
             timedlog("Moving suppressed")
 
 
+def make_stale_guard():
+    """
+    @return: The StaleGuard to add right before the safety behaviors: it stops the robot while their readings are stale,
+    from the start until the first ones arrive (the slave ones too, so the robot does not move while the slave is
+    silent), since they are skipped then
+    """
+    return StaleGuard(READINGS_DICT, SAFETY_READINGS, READINGS_MAX_AGE, MOTOR.stop, resources=(RES_DRIVE,))
+
+
+def halt_stuck_action(behavior):
+    """
+    on_stuck of the ChannelController: stops the motors the action of a preempted behavior is still blocked on, so it
+    returns and can not drive against the action that preempted it
+    """
+    if DEBUG:
+        timedlog(type(behavior).__name__ + " did not return from its suppression, stopping the motors")
+    MOTOR.stop()
+    ARM.stop()
+
+
 class CliffAvoidanceBhv(Behavior):
     """
     This behavior will check if the robot is on falling off the cliff
     """
+    depends_on = ("US_B",)
+    resources = (RES_DRIVE,)
+    budget = 5.0  # a small turn and 3 cm, way less when the motor reports done
+    max_age = READINGS_MAX_AGE
 
     def __init__(self, heigth_treshold_min=120, heigth_treshold_max=400):
         Behavior.__init__(self)
@@ -152,6 +181,10 @@ class EdgeAvoidanceBhv(Behavior):
     """
     This behavior will check if the robot is on the black border, and tries to step away from it
     """
+    depends_on = ("CS_L", "CS_M", "CS_R")
+    resources = (RES_DRIVE,)
+    budget = 5.0
+    max_age = READINGS_MAX_AGE
 
     def __init__(self, edge_color="white"):
         """
@@ -269,6 +302,11 @@ class LakeAvoidanceBhv(Behavior):
     """
     This behavior will check if the robot is on a lake, and tries to step away from it
     """
+    depends_on = ("CS_L", "CS_M", "CS_R")
+    time_based = True  # check() also reads OVERRIDED_LAKE and MEASURE_LAKE, which are not readings
+    resources = (RES_DRIVE, RES_ARM)  # the lake measurement lowers the arm
+    budget = 10.0  # the drive moves, plus lake_measurement_time() when measuring, see check()
+    max_age = READINGS_MAX_AGE
 
     def __init__(self, lake_colors=["yellow", "blue", "red"]):
         """
@@ -318,8 +356,10 @@ class LakeAvoidanceBhv(Behavior):
             self.firing = True
             if MEASURE_LAKE and (any([left_color == MEASURE_LAKE[0], mid_color == MEASURE_LAKE[0], right_color == MEASURE_LAKE[0]])):
                 self.operations = get_measurement_lake_operation(left_edge, mid_edge, right_edge, MEASURE_LAKE[1]) + [lambda: set_global_MEASURE_LAKE(False)]
+                self.budget = LakeAvoidanceBhv.budget + lake_measurement_time(MEASURE_LAKE[1])
             else:
                 self.operations = self._get_operations(left_edge, mid_edge, right_edge, mid_nc)
+                self.budget = LakeAvoidanceBhv.budget
             
             return True
 
@@ -396,17 +436,26 @@ class UpdateReadings(Behavior):
     """
     This simple behavior, at each check cycle, will update the slave readings without doing anything else
     """
+    resources = ()
         
    
-    def __init__(self):
+    def __init__(self, service=None, rgb=False):
         """
         Initialize the behavior
         @param BLUETOOTH_CONNECTION: The bluetooth connection to useù
         @param readings_dict: The readings dictionary to update
+        @param service: The SensorService polling the sensors of this brick (see start_sensor_service()), if None they
+        are read here, in check()
+        @param rgb: Without a service, classify the colors with COLOR_LUT, see read_master_sensors()
         
         """
         Behavior.__init__(self)
         self.data = ""
+        self.service = service
+        self.rgb = rgb
+        self.received = 0  # messages of the slave already parsed
+        if service is None:  # read_master_sensors() polls US_B
+            US_B.mode = 'US-DIST-CM'
     
     def check(self):
         """
@@ -415,25 +464,24 @@ class UpdateReadings(Behavior):
         @rtype: bool
         """
 
-        data = BLUETOOTH_CONNECTION.get_data()
-        if data != "":
-            self.data = data
-            self._update_readings_dict()
+        received = BLUETOOTH_CONNECTION.received
+        if received != self.received:  # only parse a message once, stamped with when it arrived
+            self.received = received
+            self.data = BLUETOOTH_CONNECTION.get_data()
+            stamp = BLUETOOTH_CONNECTION.received_at
+            for key, value in parse_slave_readings(self.data, stamp).items():
+                READINGS_DICT.set(key, value, stamp)
+        # the sensors of this brick are stamped at every poll, the slave ones stay never acquired until its first
+        # message, the StaleGuard holding the robot meanwhile
+        self._update_readings_dict()
         
         return False
     
     def _update_readings_dict(self):
-        data = self.data.split(",")
-        READINGS_DICT["TS_L"] = bool(int(data[0]))
-        READINGS_DICT["TS_R"] = bool(int(data[1]))
-        READINGS_DICT["TS_B"] = bool(int(data[2]))
-        READINGS_DICT["US_F"] = int(data[3])
-
-
-        READINGS_DICT["CS_L"] = read_color_sensor(CS_L)
-        READINGS_DICT["CS_M"] = read_color_sensor(CS_M)
-        READINGS_DICT["CS_R"] = read_color_sensor(CS_R)
-        READINGS_DICT["US_B"] = read_ultrasonic_sensor(US_B)
+        if self.service is not None:
+            self.service.refresh(READINGS_DICT)
+        else:
+            READINGS_DICT.update(read_master_sensors(self.rgb))
         
         # log = "Readings: " + str(READINGS_DICT['touch_left']) + "," + str(READINGS_DICT['touch_right']) + "," + str(READINGS_DICT['touch_back']) + "," + str(READINGS_DICT['ult_front'])
         # timedlog(log)
@@ -455,10 +503,244 @@ class UpdateReadings(Behavior):
 
 
 
+COLOR_MAJORITY = 3  # samples voting for a color
+COLOR_DWELL = 0.03  # seconds a new color must hold
+US_MARGIN = 10  # mm past a threshold for the ultrasonic readings to cross it
+
+
+def make_sensor_filters():
+    """
+    @return: {key: filter} of the readings filtered before being published, the color sensors voting and the ultrasonic
+    sensors getting hysteresis on the thresholds of CliffAvoidanceBhv and AvoidCollisionBhv
+    """
+    filters = {key: FilterChain(MajorityFilter(COLOR_MAJORITY), DwellFilter(COLOR_DWELL))
+               for key in ("CS_L", "CS_M", "CS_R")}
+    filters["US_B"] = HysteresisFilter((120, 400), US_MARGIN, READINGS_DICT["US_B"])
+    filters["US_F"] = HysteresisFilter((300,), US_MARGIN, READINGS_DICT["US_F"])
+    return filters
+
+
+SENSOR_FILTERS = make_sensor_filters()
+
+
+def filter_report():
+    """
+    @return: {key: spurious activations prevented} of the filtered readings (by this process, the sensor process of
+    the process split layout has its own filters)
+    """
+    return {key: stage.prevented for key, stage in SENSOR_FILTERS.items()}
+
+
+# The last samples of every reading, for the windowed triggers (e.g. HISTORY["US_F"].mean(0.2))
+HISTORY = SensorHistory(numeric=("US_F", "US_B"), labeled=("CS_L", "CS_M", "CS_R", "TS_L", "TS_R", "TS_B"))
+
+
+def acquire(values, stamp=None):
+    """
+    Filters fresh sensor values and records them in HISTORY
+    @param values: {key: raw value}
+    @param stamp: When they were acquired, now by default
+    @return: {key: filtered value}
+    """
+    return HISTORY.record(apply_filters(SENSOR_FILTERS, values), stamp)
+
+
+def parse_slave_readings(data, stamp=None):
+    """
+    @param data: A message of the slave, see UpdateSlaveReadingsBhv
+    @param stamp: When it was received, now by default
+    @return: The readings it carries
+    """
+    data = data.split(",")
+    return acquire({"TS_L": bool(int(data[0])), "TS_R": bool(int(data[1])), "TS_B": bool(int(data[2])),
+                    "US_F": int(data[3])}, stamp)
+
+
+def read_master_sensors(rgb=False):
+    """
+    @param rgb: Classify the colors with COLOR_LUT (see read_color_sensor_rgb) instead of the detection of the sensors
+    """
+    read_color = read_color_sensor_rgb if rgb else read_color_sensor
+    return acquire({"CS_L": read_color(CS_L), "CS_M": read_color(CS_M), "CS_R": read_color(CS_R),
+                    "US_B": read_ultrasonic_sensor(US_B)})
+
+
+SENSOR_RATES = {"CS_L": 50, "CS_M": 50, "CS_R": 50, "US_B": 20}  # polls per second
+
+
+def color_readers(fast=True, rgb=False):
+    """
+    @param fast: Read the sysfs files directly (see sysfs.SysfsSensor) instead of going through ev3dev2
+    @param rgb: Classify the RGB values with the calibrated color tables (see calibrate_color.py) instead of using the
+    color detection of the sensors. The fast path reads RGB-RAW values and needs the table of COLOR_LUT_RAW_FILE
+    @return: The functions reading CS_L, CS_M and CS_R
+    """
+    sensors = (CS_L, CS_M, CS_R)
+    if fast and rgb:
+        lut = load_color_lut(COLOR_LUT_RAW_FILE, in_bits=10)
+        readers = [open_sysfs_sensor(sensor, "RGB-RAW", values=3) for sensor in sensors]
+        return [lambda reader=reader: read_color_sensor_rgb_fast(reader, lut) for reader in readers]
+    if fast:
+        readers = [open_sysfs_sensor(sensor, "COL-COLOR") for sensor in sensors]
+        return [lambda reader=reader: read_color_sensor_fast(reader) for reader in readers]
+    read_color = read_color_sensor_rgb if rgb else read_color_sensor
+    return [lambda sensor=sensor: read_color(sensor) for sensor in sensors]
+
+
+def start_sensor_service(rates=None, fast=True, pings=False, notify=None, rgb=False):
+    """
+    Starts polling every sensor of this brick in its own thread, for UpdateReadings
+    @param rates: Polls per second of some sensors, the others keep their SENSOR_RATES
+    @param fast: Read the sysfs files directly (see sysfs.SysfsSensor) instead of going through ev3dev2
+    @param pings: Leave US_B to start_ping_scheduler() instead of polling it in continuous mode
+    @param notify: Called after every new value, e.g. CONTROLLER.notify for an event driven Controller
+    @param rgb: Classify the colors with the calibrated color tables, see color_readers()
+    @return: The started SensorService
+    """
+    rates = dict(SENSOR_RATES, **(rates or {}))
+    filters = SENSOR_FILTERS
+    service = SensorService(("CS_L", "CS_M", "CS_R", "US_B"), HISTORY)
+    if notify is not None:
+        service.listeners.append(notify)
+    for key, read in zip(("CS_L", "CS_M", "CS_R"), color_readers(fast, rgb)):
+        service.add(key, read, rates[key], filters[key])
+    if not pings:
+        add_back_poller(service, rates["US_B"], fast)
+    service.start()
+    return service
+
+
+def add_back_poller(service, rate=SENSOR_RATES["US_B"], fast=True):
+    """
+    Polls US_B in continuous mode in the service, when it is not pinged by start_ping_scheduler()
+    @return: The SensorPoller, to start if the service already is
+    """
+    if fast:
+        back = open_sysfs_sensor(US_B, "US-DIST-CM")
+        return service.add("US_B", lambda: read_ultrasonic_sensor_fast(back), rate, SENSOR_FILTERS["US_B"])
+    US_B.mode = 'US-DIST-CM'
+    return service.add("US_B", lambda: read_ultrasonic_sensor(US_B), rate, SENSOR_FILTERS["US_B"])
+
+
+PING_RATES = {"US_B": 10, "US_F": 10}  # pings per second of the ultrasonic sensors of both bricks
+
+
+def start_ping_scheduler(service, rates=None, fast=True):
+    """
+    Pings US_B in single shot mode, only in its slots of a schedule negotiated with the slave (see ping_scheduler), so
+    it never hears the pings of US_F. Call it after BLUETOOTH_CONNECTION started listening and the slave called
+    start_ping_slave(), with a service started with pings=True. If the slave does not answer, US_B is polled in
+    continuous mode by the service instead, as with pings=False
+    @param service: The SensorService the values of US_B are published in
+    @param rates: Pings per second of some sensors, the others keep their PING_RATES
+    @param fast: Trigger and read the sensor through the sysfs files directly
+    @return: The started PingScheduler, None if the negotiation failed
+    """
+    rates = dict(PING_RATES, **(rates or {}))
+    if fast:
+        back = open_sysfs_sensor(US_B, SINGLE_SHOT_MODE)
+        mode = SINGLE_SHOT_MODE.encode()
+        sensor = (lambda: back.write_mode(mode), lambda: read_ultrasonic_sensor_fast(back))
+    else:
+        sensor = (lambda: setattr(US_B, "mode", SINGLE_SHOT_MODE), lambda: read_ultrasonic_sensor(US_B))
+    stage = SENSOR_FILTERS["US_B"]
+    scheduler = PingScheduler({"US_B": sensor}, lambda key, value: service.publish(key, stage(value)))
+    scheduler.start()
+    try:
+        negotiate_pings(BLUETOOTH_CONNECTION, scheduler, rates)
+    except IOError as e:
+        scheduler.stop()
+        if DEBUG:
+            timedlog("No ping schedule, polling US_B: " + str(e))
+        add_back_poller(service, SENSOR_RATES["US_B"], fast).start()
+        return None
+    return scheduler
+
+
+def master_sensor_poll(rgb=False):
+    """
+    Runs in the SensorProcess of the process split layout: starts listening to the slave in that process and returns the
+    function polling the link and the sensors of this brick
+    @param rgb: Classify the colors with COLOR_LUT, see read_master_sensors()
+    """
+    BLUETOOTH_CONNECTION.start_listening(lambda data: ())
+    US_B.mode = 'US-DIST-CM'  # polled by read_master_sensors()
+
+    parsed = [0]  # messages of the slave already parsed
+
+    def poll():
+        readings = read_master_sensors(rgb)
+        received = BLUETOOTH_CONNECTION.received
+        if received == parsed[0]:
+            return readings
+        parsed[0] = received
+        stamp = BLUETOOTH_CONNECTION.received_at
+        slave = parse_slave_readings(BLUETOOTH_CONNECTION.get_data(), stamp)
+        readings.update(slave)
+        return readings, dict.fromkeys(slave, stamp)
+
+    return poll
+
+
+def start_sensor_process(period=0.01, notify=None, rgb=False):
+    """
+    Process split layout: the sensors and the link are polled in a SensorProcess, use UpdateSharedReadings instead of
+    UpdateReadings on the controller side. Call it after BLUETOOTH_CONNECTION got connected
+    @param period: Polling period in seconds
+    @param notify: Called after every publish of the sensor process, e.g. CONTROLLER.notify for an event driven
+    Controller
+    @param rgb: Classify the colors with COLOR_LUT, see read_master_sensors()
+    @return: The SharedReadings to give to UpdateSharedReadings, and the started SensorProcess
+    """
+    shared = SharedReadings(list(READINGS_DICT), labels=tuple(set([int2color(i) for i in range(8)])))
+    process = SensorProcess(shared, lambda: master_sensor_poll(rgb), period)
+    process.start()
+    if notify is not None:
+        shared.watch(notify)
+    return shared, process
+
+
+class UpdateSharedReadings(Behavior):
+    """
+    Counterpart of UpdateReadings for the process split layout: at each check cycle, copies what the sensor process
+    published into READINGS_DICT, without reading any device nor the link itself
+    """
+    resources = ()
+
+    def __init__(self, shared):
+        """
+        @param shared: The SharedReadings returned by start_sensor_process()
+        """
+        Behavior.__init__(self)
+        self.shared = shared
+        self.recorded = {}  # key -> acquisition time of its last sample recorded in HISTORY
+
+    def check(self):
+        if self.shared.refresh(READINGS_DICT):
+            recorded = self.recorded
+            for key, stamp in READINGS_DICT.stamps.items():  # only the values acquired since the last refresh
+                if stamp is not None and stamp != recorded.get(key):
+                    recorded[key] = stamp
+                    history = HISTORY.get(key)
+                    if history is not None:
+                        history.push(READINGS_DICT[key], stamp)
+        return False
+
+    def action(self):
+        return True
+
+    def suppress(self):
+        pass
+
+
 class AvoidCollisionBhv(Behavior):
     """
     This behavior will check if the front ultrasonic sensor dedect an object, and makes the robot avoid it
     """
+    depends_on = ("US_F",)
+    time_based = True  # check() also reads MEASURE_OBJ, which is not a reading
+    resources = (RES_DRIVE,)
+    max_age = READINGS_MAX_AGE
         
     def __init__(self, threshold_distance=300):
         """
@@ -486,7 +768,7 @@ class AvoidCollisionBhv(Behavior):
         """
         
         
-        obj_front = READINGS_DICT["ult_front"] < self.threshold_distance and not MEASURE_OBJ
+        obj_front = READINGS_DICT["US_F"] < self.threshold_distance and not MEASURE_OBJ
 
         if obj_front != self.obj_front:
             self.obj_front = obj_front
@@ -539,6 +821,9 @@ class RecoverCollisionBhv(Behavior):
     """
     This behavior will check if we had collide with something, and makes the robot recover from it
     """
+    depends_on = ("TS_L", "TS_R", "TS_B")
+    resources = (RES_DRIVE,)
+    max_age = READINGS_MAX_AGE
         
     def __init__(self):
 
@@ -557,9 +842,9 @@ class RecoverCollisionBhv(Behavior):
         @rtype: bool
         """
         
-        obj_left = READINGS_DICT["touch_left"]
-        obj_right = READINGS_DICT["touch_right"]
-        obj_back = READINGS_DICT["touch_back"]
+        obj_left = READINGS_DICT["TS_L"]
+        obj_right = READINGS_DICT["TS_R"]
+        obj_back = READINGS_DICT["TS_B"]
 
 
         if obj_left != self.obj_left or obj_right != self.obj_right or obj_back != self.obj_back:
@@ -622,29 +907,40 @@ class RecoverCollisionBhv(Behavior):
 
 
 
+ARM_MOVE_TIME = 1.5  # seconds of an ARM.move() of a rotation at BASE_SPEED, 20% of the 1560 deg/s of the medium motor
+
+
+def lake_measurement_time(sleep_time):
+    """
+    @return: Upper bound of the time get_measurement_lake_operation() spends besides its drive moves: up to two sleeps,
+    and the arm going down and back up, blocking
+    """
+    return 2 * sleep_time + 2 * ARM_MOVE_TIME
+
+
 def get_measurement_lake_operation(left, mid, right, sleep_time):
     if all([left, mid]):
         return [lambda: MOTOR.turn(direction=LEFT, degrees=5), 
-                lambda: ARM.move(up=False, block=True), lambda: time.sleep(sleep_time), lambda: ARM.move(block=True),
-                lambda: MOTOR.run(forward=False, distance=3), lambda: time.sleep(sleep_time), lambda: MOTOR.turn(direction=LEFT, degrees=40)]
+                lambda: ARM.move(up=False, block=True), lambda: CLOCK.sleep(sleep_time), lambda: ARM.move(block=True),
+                lambda: MOTOR.run(forward=False, distance=3), lambda: CLOCK.sleep(sleep_time), lambda: MOTOR.turn(direction=LEFT, degrees=40)]
     
     if all([mid, right]):
         return [lambda: MOTOR.turn(direction=RIGHT, degrees=5), 
-                lambda: ARM.move(up=False, block=True), lambda: time.sleep(sleep_time), lambda: ARM.move(block=True),
+                lambda: ARM.move(up=False, block=True), lambda: CLOCK.sleep(sleep_time), lambda: ARM.move(block=True),
                 lambda: MOTOR.run(forward=False, distance=3), lambda: MOTOR.turn(direction=RIGHT, degrees=40)]
     
     if left:
         return [lambda: MOTOR.turn(direction=LEFT, degrees=15), 
-                lambda: ARM.move(up=False, block=True), lambda: time.sleep(sleep_time), lambda: ARM.move(block=True),
+                lambda: ARM.move(up=False, block=True), lambda: CLOCK.sleep(sleep_time), lambda: ARM.move(block=True),
                 lambda: MOTOR.run(forward=False, distance=3), lambda: MOTOR.turn(direction=LEFT, degrees=20)]
 
     if right:
         return [lambda: MOTOR.turn(direction=RIGHT, degrees=15), 
-                lambda: ARM.move(up=False, block=True), lambda: time.sleep(sleep_time), lambda: ARM.move(block=True),
+                lambda: ARM.move(up=False, block=True), lambda: CLOCK.sleep(sleep_time), lambda: ARM.move(block=True),
                 lambda: MOTOR.run(forward=False, distance=3), lambda: MOTOR.turn(direction=RIGHT, degrees=20)]
                     
     if mid:
-        return [lambda: ARM.move(up=False, block=True), lambda: time.sleep(sleep_time), lambda: ARM.move(block=True),
+        return [lambda: ARM.move(up=False, block=True), lambda: CLOCK.sleep(sleep_time), lambda: ARM.move(block=True),
                 lambda: MOTOR.run(forward=False, distance=3), lambda: MOTOR.turn(degrees=40)]
 
     return []
@@ -15,6 +15,33 @@ import time
 
 from Subs_arch import Behavior, Controller
 from commons import *
+from ping_scheduler import PingScheduler, SINGLE_SHOT_MODE, serve_pings
+
+
+
+TS_L, TS_R, TS_B, US_F, LEFT, RIGHT = INPUT_1, INPUT_2, INPUT_3, INPUT_4, -1, 1
+
+TS_L, TS_R, TS_B, US_F, S = TouchSensor(TS_L), TouchSensor(TS_R), TouchSensor(TS_B), UltrasonicSensor(US_F), Sound()
+US_F.mode = SINGLE_SHOT_MODE  # pinged in its slots by start_ping_slave()
+
+READINGS_DICT = {"TS_L": False, "TS_R": False, "TS_B": False, "US_F": 0}
+PING_SCHEDULER = None  # set by start_ping_slave()
+
+
+def start_ping_slave(connection):
+    """
+    Pings US_F in single shot mode, only in the slots the master gives it (see ping_scheduler), so it never hears the
+    pings of US_B. The values go straight into READINGS_DICT. Call it before the connection starts listening. Until the
+    master sends a schedule (it never does if its negotiation failed), UpdateSlaveReadingsBhv polls US_F as before
+    @param connection: The BluetoothConnection to the master
+    @return: The started PingScheduler
+    """
+    global PING_SCHEDULER
+    sensor = (lambda: setattr(US_F, "mode", SINGLE_SHOT_MODE), lambda: read_ultrasonic_sensor(US_F))
+    PING_SCHEDULER = PingScheduler({"US_F": sensor}, READINGS_DICT.__setitem__)
+    serve_pings(connection, PING_SCHEDULER)
+    PING_SCHEDULER.start()
+    return PING_SCHEDULER
 
 
 
@@ -23,20 +50,22 @@ class UpdateSlaveReadingsBhv(Behavior):
     This behavior will check if the robot touch an object, and tries to step away from it
     """
     
-    def __init__(self):
+    def __init__(self, connection=None):
         """
         Initialize the behavior
         @param touch_left: The left touch sensor to use
         @param touch_right: The right touch sensor to use
         @param touch_back: The back touch sensor to use
         @param ult_front: The front ultrasonic sensor to use
-        @param bluetooth_connection: The bluetooth connection to use
+        @param connection: The bluetooth connection to use, BLUETOOTH_CONNECTION of the generated slave by default
         @param readings_dict: The readings dictionary to update and send
         
         """
         Behavior.__init__(self)
+        self.connection = BLUETOOTH_CONNECTION if connection is None else connection
 
         self.direction = None
+        self.continuous = False  # US_F is in continuous mode, polled in action()
 
     
     def check(self):
@@ -53,16 +82,22 @@ class UpdateSlaveReadingsBhv(Behavior):
         Update the dictionary with the new readings and send them to the master
         """
 
-        READINGS_DICT["TS_L"] = read_touch_sensor(TL)
-        READINGS_DICT["TS_R"] = read_touch_sensor(TR)
-        READINGS_DICT["TS_B"] = read_touch_sensor(TB)
-        READINGS_DICT["US_F"] = read_ultrasonic_sensor(US_F)
+        READINGS_DICT["TS_L"] = read_touch_sensor(TS_L)
+        READINGS_DICT["TS_R"] = read_touch_sensor(TS_R)
+        READINGS_DICT["TS_B"] = read_touch_sensor(TS_B)
+        if PING_SCHEDULER is None or PING_SCHEDULER.schedule is None:  # otherwise US_F is only read in its ping slots
+            if not self.continuous:  # no schedule from the master (yet), the next ping slot switches it back
+                US_F.mode = 'US-DIST-CM'
+                self.continuous = True
+            READINGS_DICT["US_F"] = read_ultrasonic_sensor(US_F)
+        else:
+            self.continuous = False
 
         msg = str(READINGS_DICT['TS_L']) + "," + str(READINGS_DICT['TS_R']) + "," + str(READINGS_DICT['TS_B']) + "," + str(READINGS_DICT['US_F'])
         log = "Sending Readings: " + msg
         if DEBUG:
             timedlog(log)
-        BLUETOOTH_CONNECTION.write(msg)
+        self.connection.write(msg)
         
         time.sleep(0.05)
 
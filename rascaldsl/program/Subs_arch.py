@@ -1,5 +1,95 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import threading
+import time
+
+from Subs_metrics import DecisionTrace, PreemptionRecorder, Profiler, TickStats
+
+# Resources a behavior can ask for, see Behavior.resources and ChannelController
+RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS = "drive", "arm", "sound", "leds"
+ALL_RESOURCES = (RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS)
+
+
+class SystemClock():
+    """
+    The real time, used on the robot. Monotonic, so a change of the system time does not move the timers
+    """
+    lockstep = False
+
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock():
+    """
+    Simulated time for lockstep runs. Time only moves when sleep() or advance() is called, by steps of quantum seconds,
+    and after every step the listeners run (the lockstep Controller arbitrates there). Simulated motors advance it while
+    they are polled, so a whole mission runs single threaded, faster than real time and always the same way.
+    """
+    lockstep = True
+
+    def __init__(self, start=0.0, quantum=0.01):
+        """
+        @param start: Initial time, in seconds
+        @param quantum: Size of a time step, in seconds
+        """
+        self.now = start
+        self.quantum = quantum
+        self.listeners = []
+        self._notifying = False
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds=None):
+        """
+        Moves the time forward, one quantum at a time, running the listeners after every step
+        @param seconds: How much to move, a single quantum by default
+        """
+        end = self.now + (self.quantum if seconds is None else seconds)
+        while True:
+            self.now = min(self.now + self.quantum, end)
+            if not self._notifying:  # a listener moving the time does not call the listeners again
+                self._notifying = True
+                try:
+                    for listener in self.listeners:
+                        listener()
+                finally:
+                    self._notifying = False
+            if self.now >= end:
+                break
+
+
+class Clock():
+    """
+    The clock used by the behaviors and the generated code (CLOCK.time(), CLOCK.sleep()). It forwards to a SystemClock
+    unless a simulation installs a VirtualClock with use(), in which case Controller.start() runs in lockstep.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def use(self, source):
+        self.source = source
+
+    @property
+    def lockstep(self):
+        return self.source.lockstep
+
+    def time(self):
+        return self.source.time()
+
+    def sleep(self, seconds):
+        self.source.sleep(seconds)
+
+
+CLOCK = Clock(SystemClock())
 
 
 class Behavior(object):
@@ -10,8 +100,35 @@ class Behavior(object):
     2. action: What should this behavior do while it has control.
     3. suppress: Should give up control immediately when this method is called. Will be called when a behavior with a
     higher priority wants to take control.
+
+    A behavior can also declare in depends_on the keys of the Readings its check() reads. When the Controller tracks
+    readings, such a check is skipped (counted as False) as long as none of those keys changed since its last evaluation.
+    Checks that also depend on time (timeouts, delays) must set time_based so they are evaluated at every pass anyway.
+
+    With a ChannelController, resources declares what the action uses (RES_DRIVE, RES_ARM, RES_SOUND, RES_LEDS), so
+    behaviors that do not share any resource can run at the same time.
+
+    The Controller does not evaluate a behavior for cooldown seconds after its action returned (completed or
+    suppressed), nor for refractory seconds after it took control, so a noisy trigger can not make it fire again and
+    again. Its check() is simply not called during these windows.
+
+    A behavior can declare a time budget for its action: when the action runs longer (e.g. waiting for a motor that never
+    reports done), the Controller suppresses it, counts an overrun and goes on with the arbitration.
+
+    A behavior can also declare max_age: when the Controller tracks readings and one of the depends_on readings was
+    acquired longer ago than that (e.g. the bluetooth link stalled), its check() is not called and the behavior does
+    not take control until fresh values arrive. An action already running is not affected. Safety behaviors can not
+    react meanwhile, so a StaleGuard with a higher priority should stop the robot for as long as that lasts.
     """
 
+    depends_on = None  # keys of the readings check() reads, None means it is evaluated at every pass
+    time_based = False
+    resources = None  # resources the action uses, None means all of them
+    cooldown = 0.0  # seconds, counted from the end of the action
+    refractory = 0.0  # seconds, counted from the moment the behavior took control
+    budget = None  # seconds the action may run, None for no limit
+    max_age = None  # seconds after which the depends_on readings are stale, None for no limit
+
     def check(self):
         """
         Method to check whether if this behavior should be started or not.
@@ -35,6 +152,53 @@ class Behavior(object):
         raise NotImplementedError("Should have implemented this")
 
 
+class StaleGuard(Behavior):
+    """
+    Takes control while some readings are stale (e.g. none arrived yet at startup, or the bluetooth link stalled) and
+    keeps the robot still until they are fresh again. Added before the safety behaviors skipped on the same readings
+    (see Behavior.max_age), so the lower priority ones can not drive blind while nothing watches the cliff or the edges.
+    """
+    time_based = True
+
+    def __init__(self, readings, keys, max_age, halt, resources=None, poll=0.01, clock=CLOCK):
+        """
+        @param readings: The Readings to look at, e.g. READINGS_DICT
+        @param keys: The readings the safety behaviors depend on
+        @param max_age: Seconds after which they are stale, the max_age of the safety behaviors
+        @param halt: Called when taking control, e.g. MOTOR.stop
+        @param resources: What to hold with a ChannelController, e.g. (RES_DRIVE,), None for everything
+        @param poll: How often (seconds) the readings are looked at while holding
+        @param clock: Clock the ages are measured on
+        """
+        Behavior.__init__(self)
+        self.readings = readings
+        self.keys = tuple(keys)
+        self.max_age = max_age
+        self.halt = halt
+        self.resources = resources
+        self.poll = poll
+        self.clock = clock
+        self.suppressed = False
+        self.halts = 0  # times it stopped the robot
+
+    def check(self):
+        return self.readings.age(self.keys, self.clock.time()) > self.max_age
+
+    def action(self):
+        """
+        Stops the robot and holds control until the readings are fresh again
+        """
+        self.suppressed = False
+        self.halts += 1
+        self.halt()
+        while not self.suppressed and self.check():
+            self.clock.sleep(self.poll)
+        return not self.suppressed
+
+    def suppress(self):
+        self.suppressed = True
+
+
 class Controller():
     """
     Runs the main subsumption logic. Controls which behavior will run based on their priority and if they want to become
@@ -44,19 +208,79 @@ class Controller():
 
     There is two usages in this class. One is to make the class take care of scheduler itself, by calling the start()
     method. The other is to take care of the scheduler by yourself, by using the step() method
+
+    When started with start(), the behaviors are checked by a separate thread. By default that thread re-checks them in a
+    busy loop; with event_driven=True it only wakes up when notify() is called or when max_wait expires; with a period it
+    runs one pass per period and keeps jitter/overrun statistics in tick_stats.
+
+    A long lived controller can run several missions in a row: swap() replaces the mission behaviors while keeping the
+    first ones (e.g. the safety behaviors and their state), and with persistent=True the checker thread keeps running
+    between two start() calls instead of being respawned.
+
+    With compile_checks=True the arbitration pass is a function generated for the current behaviors, with their checks
+    unrolled in priority order (see _compile()). It is rebuilt when the behaviors change through add(), remove(),
+    update(), swap() or profiling, but it holds the check methods bound when it got built, so it does not suit behaviors
+    replacing their own check method afterwards.
     """
 
-    def __init__(self, return_when_no_action):
+    def __init__(self, return_when_no_action, event_driven=False, max_wait=0.05, period=None, readings=None,
+                 measure_preemption=False, profile=False, clock=CLOCK, persistent=False, trace_size=0,
+                 compile_checks=False):
         """
         Initialize the object. Notice the subsumption module is not bound to a specific brick, the behaviors are. This
         makes it possible to have a subsumption module responsible for multiple bricks at the same time, if desirable.
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param event_driven: If True the checker thread sleeps until notify() is called or max_wait seconds passed,
+        instead of re-checking the behaviors in a busy loop
+        @param max_wait: Deadline (in seconds) after which the checker runs a pass even if nobody notified it
+        @param period: If given (in seconds, e.g. 0.01 for 100 Hz) the checker runs at this fixed rate instead, sleeping
+        for what is left of each period. Takes precedence over event_driven
+        @param readings: The Readings the behaviors depend on. If given, the checks of behaviors declaring depends_on are
+        only evaluated again when one of their readings changed
+        @param measure_preemption: If True, self.preemption records the latency from a higher priority check to the
+        suppression of the old behavior and the start of the new action. Hook self.preemption.motor_stopped to the motor
+        (see Motor.stop_hooks) to also get the time to the motor stop
+        @param profile: Start with profiling on, see enable_profiling()
+        @param clock: Clock of the behaviors. When it is a lockstep clock (a VirtualClock, or CLOCK using one), start()
+        runs run_lockstep() instead of the threads
+        @param persistent: If True, start() returning (because no behavior wants to run) leaves the checker thread
+        running, so the next start() (e.g. after a swap()) reuses it. Only stop() ends it
+        @param trace_size: Number of arbitration decisions kept in self.trace (see dump_trace()), e.g. 1024. None are kept
+        by default
+        @param compile_checks: Whether to run the arbitration pass through a generated function instead of a loop (off by
+        default, see above)
         """
         self.behaviors = []
         self.wait_object = threading.Event()
         self.active_behavior_index = None
 
         self._running = True
+        self._stopped = False
         self._return_when_no_action = return_when_no_action
+        self.persistent = persistent
+        self._checker = None
+        self._lock = threading.RLock()  # serializes the arbitration passes and swap()
+        self.event_driven = event_driven
+        self.max_wait = max_wait
+        self._activated = threading.Event()  # wakes the idle action loop in event driven mode
+        self.period = period
+        self.tick_stats = TickStats(period) if period is not None else None
+        self.readings = readings
+        self._check_stamps = {}  # behavior -> readings stamp at its last False check
+        self._cooling = {}  # behavior -> time until which it is not evaluated
+        self.cooldown_skips = {}  # behavior -> number of checks skipped because of its cooldown or refractory window
+        self.stale_skips = {}  # behavior -> number of checks skipped because its readings were too old
+        self._action_start = None  # when the action of the active behavior started
+        self.overruns = {}  # behavior -> number of times its action ran over its budget or its handover
+        self.preemption = PreemptionRecorder() if measure_preemption else None
+        self.profiler = Profiler()
+        self.profiling = False
+        self.clock = clock
+        self.trace = DecisionTrace(trace_size) if trace_size else None
+        self.compile_checks = compile_checks
+        self._compiled = None  # (plain, tracked) arbitration functions for the current behaviors, built on demand
+        if profile:
+            self.enable_profiling()
 
         self.callback = lambda x: 0
 
@@ -66,10 +290,16 @@ class Controller():
         @type behavior: Behavior
         """
         self.behaviors.append(behavior)
+        if self.profiling:
+            self.profiler.wrap(behavior)
+        self._compiled = None
 
     def remove(self, index):
         old_behavior = self.behaviors[index]
         del self.behaviors[index]
+        if self.profiling:
+            self.profiler.unwrap(old_behavior)
+        self._compiled = None
         if self.active_behavior_index == index:  # stop the old one if the new one overrides it
             old_behavior.suppress()
             self.active_behavior_index = None
@@ -77,9 +307,109 @@ class Controller():
     def update(self, behavior, index):
         old_behavior = self.behaviors[index]
         self.behaviors[index] = behavior
+        if self.profiling:
+            self.profiler.unwrap(old_behavior)
+            self.profiler.wrap(behavior)
+        self._compiled = None
         if self.active_behavior_index == index:  # stop the old one if the new one overrides it
             old_behavior.suppress()
 
+    def swap(self, behaviors, keep=0):
+        """
+        Replaces the behaviors after the first keep ones with the given ones, in a single step with respect to the
+        arbitration passes. The kept behaviors are untouched (same objects, same state, same priority), an active
+        behavior that is swapped out gets suppressed. Meant to go from one mission to the next without rebuilding the
+        controller; with the AsyncController call it between two start().
+        @param behaviors: The new behaviors, in priority order, coming after the kept ones
+        @param keep: How many of the current highest priority behaviors to keep
+        """
+        with self._lock:
+            old_behaviors = self.behaviors[keep:]
+            self.behaviors = self.behaviors[:keep] + list(behaviors)
+            for behavior in old_behaviors:
+                self._cooling.pop(behavior, None)
+            if self.profiling:
+                for behavior in old_behaviors:
+                    self.profiler.unwrap(behavior)
+                for behavior in behaviors:
+                    self.profiler.wrap(behavior)
+            self._compiled = None
+            self._swapped_out(old_behaviors, keep)
+            self.invalidate()
+        self.notify()
+
+    def _swapped_out(self, old_behaviors, keep):
+        if self.active_behavior_index is not None and self.active_behavior_index >= keep:
+            old_behaviors[self.active_behavior_index - keep].suppress()
+            if self.trace is not None:
+                self.trace.record(self.clock.time(), None, self.active_behavior_index,
+                                  DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+            self.active_behavior_index = None
+            self.callback(self.active_behavior_index)
+
+    def enable_profiling(self):
+        """
+        Wraps the check() and action() of every behavior to record call counts, cumulative and max wall time, and the
+        time spent in checks returning True vs False. Behaviors added later are wrapped too.
+        """
+        self.profiling = True
+        for behavior in self.behaviors:
+            self.profiler.wrap(behavior)
+        self._compiled = None
+
+    def disable_profiling(self):
+        """
+        Gives the behaviors back their original methods. What was recorded stays available in profile_report()
+        """
+        self.profiling = False
+        self.profiler.unwrap_all()
+        self._compiled = None
+
+    def profile_report(self):
+        """
+        @return: One dict per behavior in priority order, see Profiler.report
+        """
+        return self.profiler.report(self.behaviors)
+
+    def dump_trace(self, path):
+        """
+        Writes the last arbitration decisions to a CSV file, see DecisionTrace.dump. The names written next to the
+        indexes are the ones of the current behaviors, so dump before a swap()
+        @param path: The file to write
+        """
+        if self.trace is not None:
+            self.trace.dump(path, [type(behavior).__name__ for behavior in self.behaviors])
+
+    def cooldown_report(self):
+        """
+        @return: One dict per behavior in priority order, with its windows, whether it is cooling down right now (and
+        for how long) and how many of its checks got skipped so far
+        """
+        now = self.clock.time()
+        report = []
+        for priority, behavior in enumerate(self.behaviors):
+            remaining = max(0.0, self._cooling.get(behavior, now) - now)
+            report.append({"priority": priority, "name": type(behavior).__name__, "cooldown": behavior.cooldown,
+                           "refractory": behavior.refractory, "cooling": remaining > 0, "remaining": remaining,
+                           "skipped": self.cooldown_skips.get(behavior, 0)})
+        return report
+
+    def stale_report(self):
+        """
+        @return: One dict per behavior in priority order, with its max_age, the age of its oldest reading right now and
+        how many of its checks got skipped so far because of stale readings
+        """
+        now = self.clock.time()
+        report = []
+        for priority, behavior in enumerate(self.behaviors):
+            age = None
+            if self.readings is not None and behavior.depends_on:
+                age = self.readings.age(behavior.depends_on, now)
+            report.append({"priority": priority, "name": type(behavior).__name__, "max_age": behavior.max_age,
+                           "age": age, "stale": behavior.max_age is not None and age is not None and age > behavior.max_age,
+                           "skipped": self.stale_skips.get(behavior, 0)})
+        return report
+
     def step(self):
         """
         Find the next active behavior and runs it.
@@ -88,6 +418,7 @@ class Controller():
         behavior = self.find_next_active_behavior()
         if behavior is not None:
             self.behaviors[behavior].action()
+            self.invalidate()
             return True
         return False
 
@@ -97,21 +428,164 @@ class Controller():
         @return: Next runnable behavior if any
         @rtype: int
         """
+        if self.compile_checks:
+            compiled = self._compiled
+            if compiled is None:
+                compiled = self._compiled = self._compile()
+            return compiled[1]() if self.readings is not None or self._cooling else compiled[0]()
+        if self.readings is not None or self._cooling:
+            return self._find_next_active_behavior_tracked()
         for priority, behavior in enumerate(self.behaviors):
             if behavior.check():
                 return priority
         return None
 
-    def _find_and_set_new_active_behavior(self):
-        new_behavior_priority = self.find_next_active_behavior()
-        if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
-            if self.active_behavior_index is not None:
-                self.behaviors[self.active_behavior_index].suppress()
-            self.active_behavior_index = new_behavior_priority
+    def _compile(self):
+        """
+        Generates the arbitration passes for the current behaviors: one calling their check() directly, one going
+        through _check() (readings tracking and cooldowns). The checks are unrolled in priority order and bound as closure
+        variables, so a pass does no iteration, no attribute lookup and no index bookkeeping, e.g. for two behaviors:
+
+            def plain():
+                if c0(): return 0
+                if c1(): return 1
+                return None
+
+        @return: (plain, tracked) functions returning the index of the first behavior that wants to run, or None
+        """
+        n = len(self.behaviors)
+        names = ", ".join(["c{0}, b{0}".format(i) for i in range(n)] + ["check"])
+        lines = ["def make(args):", "    {}, = args".format(names), "    def plain():"]  # no 255 arguments limit
+        lines += ["        if c{0}(): return {0}".format(i) for i in range(n)]
+        lines += ["        return None", "    def tracked():"]
+        lines += ["        if check(b{0}): return {0}".format(i) for i in range(n)]
+        lines += ["        return None", "    return plain, tracked"]
+        namespace = {}
+        exec(compile("\n".join(lines), "<arbitration of {} behaviors>".format(n), "exec"), namespace)
+        args = []
+        for behavior in self.behaviors:
+            args += [behavior.check, behavior]
+        return namespace["make"](args + [self._check])
+
+    def overrun_report(self):
+        """
+        @return: One dict per behavior in priority order, with its budget and how many times its action overran it
+        """
+        return [{"priority": priority, "name": type(behavior).__name__, "budget": behavior.budget,
+                 "overruns": self.overruns.get(behavior, 0)} for priority, behavior in enumerate(self.behaviors)]
+
+    def _over_budget(self, behavior, start):
+        """
+        Whether an action that started at start ran over the budget of its behavior, counting the overrun if so
+        """
+        budget = behavior.budget
+        if budget is None or start is None or self.clock.time() - start <= budget:
+            return False
+        self.overruns[behavior] = self.overruns.get(behavior, 0) + 1
+        return True
 
-            # Callback to tell something it changed the active behavior if anything is interested
+    def _watchdog(self):
+        """
+        Suppresses the active behavior if its action ran over its budget, so the pass can pick another one
+        """
+        index = self.active_behavior_index
+        if index is not None and self._over_budget(self.behaviors[index], self._action_start):
+            self._action_start = None
+            self.behaviors[index].suppress()
+            if self.trace is not None:
+                self.trace.record(self.clock.time(), None, index, DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+            self.active_behavior_index = None
+            self.invalidate()
             self.callback(self.active_behavior_index)
 
+    def _find_next_active_behavior_tracked(self):
+        for priority, behavior in enumerate(self.behaviors):
+            if self._check(behavior):
+                return priority
+        return None
+
+    def _check(self, behavior):
+        """
+        The check() of a behavior, skipped (counted as False) while it cools down, if its readings are stale, or if they
+        did not change
+        """
+        cooling = self._cooling
+        if cooling and behavior in cooling:
+            if self.clock.time() < cooling[behavior]:
+                self.cooldown_skips[behavior] = self.cooldown_skips.get(behavior, 0) + 1
+                return False
+            del cooling[behavior]
+        if self.readings is None:
+            return behavior.check()
+        max_age = behavior.max_age
+        if max_age is not None and behavior.depends_on and \
+                self.readings.age(behavior.depends_on, self.clock.time()) > max_age:
+            self.stale_skips[behavior] = self.stale_skips.get(behavior, 0) + 1
+            return False
+        return self._tracked_check(behavior)
+
+    def _cool_down(self, behavior, seconds):
+        """
+        Keeps a behavior from being evaluated for the given time (a longer window already running is kept)
+        """
+        if seconds:
+            until = self.clock.time() + seconds
+            if until > self._cooling.get(behavior, until - 1):
+                self._cooling[behavior] = until
+
+    def _tracked_check(self, behavior):
+        """
+        The check() of a behavior, skipped (counted as False) if it last returned False and none of its readings changed
+        """
+        depends_on = behavior.depends_on
+        if depends_on is None or behavior.time_based:
+            return behavior.check()
+
+        stamps = self._check_stamps
+        stamp = self.readings.stamp(depends_on)
+        if stamps.get(behavior) == stamp:  # inputs unchanged since the last False, still False
+            return False
+        if behavior.check():
+            stamps.pop(behavior, None)
+            return True
+        stamps[behavior] = stamp
+        return False
+
+    def invalidate(self):
+        """
+        Forget which checks could be skipped, so every behavior is evaluated again at the next pass. Done automatically
+        whenever the active behavior changes or an action ends, since behaviors reset their own state at those points.
+        """
+        self._check_stamps.clear()
+
+    def _find_and_set_new_active_behavior(self):
+        with self._lock:
+            self._watchdog()
+            new_behavior_priority = self.find_next_active_behavior()
+            if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
+                if self.active_behavior_index is not None:
+                    old_behavior = self.behaviors[self.active_behavior_index]
+                    if self.preemption is not None:
+                        self.preemption.triggered(old_behavior, self.behaviors[new_behavior_priority], new_behavior_priority)
+                        self.preemption.suppress_called()
+                    old_behavior.suppress()
+                    if self.preemption is not None:
+                        self.preemption.suppress_returned()
+                if new_behavior_priority != self.active_behavior_index:
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), new_behavior_priority, self.active_behavior_index,
+                                          0 if self.active_behavior_index is None
+                                          else DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self.active_behavior_index = new_behavior_priority
+                if new_behavior_priority is not None:
+                    new_behavior = self.behaviors[new_behavior_priority]
+                    self._cool_down(new_behavior, new_behavior.refractory)
+                    self._activated.set()
+
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+
     def _start(self):  # run the action methods
         """
         Starts finding and running behaviors, suppressing the old behaviors when new behaviors with higher priority
@@ -119,27 +593,102 @@ class Controller():
         """
         self._running = True
         self._find_and_set_new_active_behavior()  # force do it ourselves once to find the right one
-        thread = threading.Thread(name="Continuous behavior checker",
-                                  target=self._continuously_find_new_active_behavior, args=())
-        thread.daemon = True
-        thread.start()
+        self._start_checker()
 
         while self._running:
             if self.active_behavior_index is not None:
                 running_behavior = self.active_behavior_index
-                self.behaviors[running_behavior].action()
-                if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
-                    self.active_behavior_index = None
-                    self._find_and_set_new_active_behavior()
+                if self.preemption is not None:
+                    self.preemption.action_started(running_behavior)
+                behavior = self.behaviors[running_behavior]
+                self._action_start = self.clock.time()
+                behavior.action()
+                with self._lock:
+                    self._cool_down(behavior, behavior.cooldown)
+                    if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
+                        self._completed(running_behavior)
+                        self._find_and_set_new_active_behavior()
 
             elif self._return_when_no_action:
                 break
 
+            elif self.event_driven or self.period is not None:  # nothing to run, sleep until the checker activates something
+                self._activated.wait(self.max_wait)
+                self._activated.clear()
+
         #Nothing more to do, so we are shutting down
         self._running = False
 
+    def _completed(self, index):
+        if self.trace is not None:
+            self.trace.record(self.clock.time(), None, index, DecisionTrace.COMPLETED)
+        self.active_behavior_index = None
+        self.invalidate()
+
+    def _start_checker(self):
+        self._stopped = False
+        if self._checker is not None and self._checker.is_alive():  # persistent, still running from the last start()
+            return
+        checker = self._periodically_find_new_active_behavior if self.period is not None \
+            else self._continuously_find_new_active_behavior
+        thread = threading.Thread(name="Continuous behavior checker", target=checker, args=())
+        thread.daemon = True
+        self._checker = thread
+        thread.start()
+
+    def _checking(self):
+        """
+        Whether the checker thread should go on
+        """
+        return self._running or (self.persistent and not self._stopped)
+
+    def run_lockstep(self, until=None):
+        """
+        Runs the behaviors on the calling thread only, against the virtual time of self.clock. Arbitration happens at
+        every step of the clock: while an action waits (on a simulated motor or a CLOCK.sleep) the time moves, the
+        behaviors are checked and the action gets suppressed exactly as the checker thread would do, but always at the
+        same virtual instants. Only one action runs at a time, whatever the Controller type.
+        @param until: Virtual time at which to give up (e.g. to bound a CI run), None to run until done or stopped
+        """
+        clock = self.clock.source if isinstance(self.clock, Clock) else self.clock
+        listener = self._lockstep_pass
+        clock.listeners.append(listener)
+        self._running = True
+        try:
+            Controller._find_and_set_new_active_behavior(self)
+            while self._running and (until is None or clock.time() < until):
+                if self.active_behavior_index is not None:
+                    running_behavior = self.active_behavior_index
+                    if self.preemption is not None:
+                        self.preemption.action_started(running_behavior)
+                    behavior = self.behaviors[running_behavior]
+                    self._action_start = self.clock.time()
+                    self._lockstep_action(behavior)
+                    self._cool_down(behavior, behavior.cooldown)
+                    if running_behavior == self.active_behavior_index:  # means the action got completed the old fashion way
+                        self._completed(running_behavior)
+                        Controller._find_and_set_new_active_behavior(self)
+
+                elif self._return_when_no_action:
+                    break
+
+                else:
+                    clock.advance()
+        finally:
+            clock.listeners.remove(listener)
+            self._running = False
+
+    def _lockstep_action(self, behavior):
+        return behavior.action()
+
+    def _lockstep_pass(self):
+        if self._running:
+            Controller._find_and_set_new_active_behavior(self)  # single action semantics, even for subclasses
+
     def start(self, run_in_thread=False):
-        if run_in_thread:
+        if self.clock.lockstep:
+            self.run_lockstep()
+        elif run_in_thread:
             thread = threading.Thread(name="Subsumption Thread",
                                       target=self._start, args=())
             thread.daemon = True
@@ -149,11 +698,481 @@ class Controller():
 
     def stop(self):
         self._running = False
-        self.behaviors[self.active_behavior_index].suppress()
+        self._stopped = True
+        self.wait_object.set()
+        if self.active_behavior_index is not None:
+            self.behaviors[self.active_behavior_index].suppress()
+
+    def notify(self):
+        """
+        Signal that new sensor data is available (or that a behavior changed its state), so the checker thread runs an
+        arbitration pass right away. Safe to call from any thread, e.g. from a BluetoothConnection listener.
+        """
+        self.wait_object.set()
 
     def _continuously_find_new_active_behavior(self):
-        while self._running:
+        while self._checking():
+            if self.event_driven:
+                self.wait_object.wait(self.max_wait)
+                self.wait_object.clear()
+            self._find_and_set_new_active_behavior()
+
+    def _periodically_find_new_active_behavior(self):
+        """
+        Runs one arbitration pass every period. When a pass takes longer than the period, the missed ticks are dropped
+        and counted as an overrun instead of being run back to back.
+        """
+        stats, clock = self.tick_stats, self.clock
+        next_tick = clock.time()
+        while self._checking():
+            start = clock.time()
+            stats.jitter.add(abs(start - next_tick))
             self._find_and_set_new_active_behavior()
+            end = clock.time()
+            stats.check_duration.add(end - start)
+            stats.ticks += 1
+
+            next_tick += self.period
+            if end > next_tick:
+                stats.overruns += 1
+                next_tick = end
+            else:
+                clock.sleep(next_tick - end)
 
     def __str__(self):
-        return str(self.behaviors)
\ No newline at end of file
+        return str(self.behaviors)
+
+
+class ChannelController(Controller):
+    """
+    Controller arbitrating per resource instead of allowing a single active behavior. Going through the behaviors by
+    priority, a behavior that wants to run gets its resources if no higher priority behavior holds or took one of them;
+    a lower priority active behavior holding one of them gets suppressed. Every active behavior runs its action in its
+    own thread, so e.g. a speech can go on while another behavior drives.
+
+    The action of a behavior only starts once the behaviors it preempted (or its own previous run) returned from their
+    action, so the cleanup of the old one (e.g. a MOTOR.stop() in _reset) can not cut the new one. An action still
+    running handover seconds after its suppression (e.g. blocked in a motor call) counts as an overrun, on_stuck is
+    called on it and the new action starts anyway.
+    """
+
+    def __init__(self, return_when_no_action, handover=1.0, on_stuck=None, **kwargs):
+        """
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param handover: Seconds a starting action waits for the actions it preempted to return
+        @param on_stuck: Called with a preempted behavior whose action did not return within handover, e.g. to stop the
+        motors it is blocked on
+        @param kwargs: Same options as Controller
+        """
+        Controller.__init__(self, return_when_no_action, **kwargs)
+        self.handover = handover
+        self.on_stuck = on_stuck
+        self.active_behaviors = set()  # behaviors currently holding their resources
+        self._threads = {}  # behavior -> thread running its action, until the action returns
+        self._action_starts = {}  # behavior -> when its running action started
+        self._changed = threading.Event()
+
+    @staticmethod
+    def resources_of(behavior):
+        return ALL_RESOURCES if behavior.resources is None else behavior.resources
+
+    def step(self):
+        """
+        Runs one arbitration pass and waits for the started actions to return.
+        @return: Returns whether it got to run any behavior or not
+        """
+        started = self._find_and_set_new_active_behavior()
+        for thread in list(self._threads.values()):
+            thread.join()
+        return bool(started)
+
+    def _swapped_out(self, old_behaviors, keep):
+        for index, behavior in enumerate(old_behaviors):
+            if behavior in self.active_behaviors:
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, keep + index,
+                                      DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+        active_behavior_index = min([self.behaviors.index(b) for b in self.active_behaviors]) \
+            if self.active_behaviors else None
+        if active_behavior_index != self.active_behavior_index:
+            self.active_behavior_index = active_behavior_index
+            self.callback(self.active_behavior_index)
+
+    def _find_and_set_new_active_behavior(self):
+        """
+        One arbitration pass over all the resources
+        @return: The indexes of the behaviors started by this pass
+        """
+        started = []
+        with self._lock:
+            self._watchdog()
+            claimed = set()
+            for priority, behavior in enumerate(self.behaviors):
+                resources = self.resources_of(behavior)
+                if behavior in self.active_behaviors:
+                    if claimed.isdisjoint(resources):
+                        claimed.update(resources)
+                    else:  # a higher priority behavior took one of its resources
+                        self.active_behaviors.discard(behavior)
+                        if self.preemption is not None:
+                            self.preemption.suppress_called()
+                        behavior.suppress()
+                        if self.preemption is not None:
+                            self.preemption.suppress_returned()
+                    continue
+
+                if not claimed.isdisjoint(resources) or not self._check(behavior):
+                    continue
+                claimed.update(resources)
+                if self.preemption is not None or self.trace is not None:
+                    preempted = None  # the lower priority active behavior giving up its resources, if any
+                    for active in self.active_behaviors:
+                        if not set(self.resources_of(active)).isdisjoint(resources):
+                            preempted = active
+                            break
+                    if self.preemption is not None and preempted is not None:
+                        self.preemption.triggered(preempted, behavior, priority)
+                    if self.trace is not None:
+                        if preempted is None:
+                            self.trace.record(self.clock.time(), priority, None)
+                        else:
+                            self.trace.record(self.clock.time(), priority, self.behaviors.index(preempted),
+                                              DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self._cool_down(behavior, behavior.refractory)
+                self._start_action(behavior, priority)
+                started.append(priority)
+
+            if started:
+                self.invalidate()
+            active_behavior_index = min([self.behaviors.index(b) for b in self.active_behaviors]) \
+                if self.active_behaviors else None
+            if active_behavior_index != self.active_behavior_index:
+                self.active_behavior_index = active_behavior_index
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+        return started
+
+    def _watchdog(self):
+        for behavior, start in list(self._action_starts.items()):
+            if behavior in self.active_behaviors and self._over_budget(behavior, start):
+                del self._action_starts[behavior]
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, self.behaviors.index(behavior),
+                                      DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                self.invalidate()
+
+    def _start_action(self, behavior, priority):
+        resources = self.resources_of(behavior)
+        wait_for = [(other, thread) for other, thread in self._threads.items()
+                    if other is behavior or not set(self.resources_of(other)).isdisjoint(resources)]
+        thread = threading.Thread(name="Action " + type(behavior).__name__, target=self._run_action,
+                                  args=(behavior, priority, wait_for))
+        thread.daemon = True
+        self.active_behaviors.add(behavior)
+        self._threads[behavior] = thread
+        thread.start()
+
+    def _run_action(self, behavior, priority, wait_for):
+        try:
+            for other, thread in wait_for:
+                thread.join(self.handover)
+                if thread.is_alive():  # it ignores its suppression
+                    with self._lock:
+                        self.overruns[other] = self.overruns.get(other, 0) + 1
+                        if self.trace is not None and other in self.behaviors:  # not swapped out meanwhile
+                            self.trace.record(self.clock.time(), None, self.behaviors.index(other),
+                                              DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                    if self.on_stuck is not None:
+                        self.on_stuck(other)
+            if behavior in self.active_behaviors:  # could have been preempted while waiting
+                if self.preemption is not None:
+                    self.preemption.action_started(priority)
+                self._action_starts[behavior] = self.clock.time()
+                behavior.action()
+        finally:
+            with self._lock:
+                if self._threads.get(behavior) is threading.current_thread():
+                    self._action_starts.pop(behavior, None)
+                self._cool_down(behavior, behavior.cooldown)
+                if self._threads.get(behavior) is threading.current_thread():
+                    del self._threads[behavior]
+                if behavior in self.active_behaviors:  # means the action got completed the old fashion way
+                    self.active_behaviors.discard(behavior)
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), None, priority, DecisionTrace.COMPLETED)
+            self._changed.set()
+            self.wait_object.set()
+
+    def _start(self):
+        """
+        Starts arbitrating, and waits until stop() is called (or until nothing runs, if return_when_no_action)
+        """
+        self._running = True
+        self._find_and_set_new_active_behavior()  # force do it ourselves once to find the right ones
+        self._start_checker()
+
+        while self._running:
+            if not self._threads and self._return_when_no_action:
+                self._find_and_set_new_active_behavior()
+                if not self._threads:
+                    break
+            self._changed.wait(self.max_wait)
+            self._changed.clear()
+
+        #Nothing more to do, so we are shutting down
+        self._running = False
+
+    def stop(self):
+        self._running = False
+        self._stopped = True
+        self.wait_object.set()
+        self._changed.set()
+        with self._lock:
+            for behavior in list(self.active_behaviors):
+                self.active_behaviors.discard(behavior)
+                behavior.suppress()
+
+
+class AsyncBehavior(Behavior):
+    """
+    Behavior whose action() is a coroutine, to be run by an AsyncController. Instead of spinning until the motors are
+    done, the action awaits (see wait_motor and wait_until), so the controller can keep checking the other behaviors on
+    the same thread. Suppression is the cancellation of the action task: the action gets a CancelledError at its current
+    await and should put the robot in a safe state (e.g. in a finally clause) before letting it propagate.
+    """
+
+    async def action(self):
+        raise NotImplementedError("Should have implemented this")
+
+    def suppress(self):
+        """
+        Not needed, the AsyncController cancels the action instead
+        """
+        pass
+
+
+async def wait_motor(motor, poll=0.01):
+    """
+    Waits for a motor to complete its current movement, without blocking the other coroutines
+    @param motor: Anything with an is_running property (Motor, ArmMotor)
+    @param poll: How often (seconds) the motor is polled. In lockstep, polling a simulated motor moves the virtual time
+    instead, so the loop is only yielded to
+    """
+    while motor.is_running:
+        await asyncio.sleep(0 if CLOCK.lockstep else poll)
+
+
+async def wait_until(predicate, poll=0.01):
+    """
+    Waits until predicate() returns a true value, e.g. until a new message arrived on the bluetooth connection
+    @param predicate: Function without arguments to poll
+    @param poll: How often (seconds) the predicate is polled. In lockstep, the virtual time moves by one quantum instead
+    """
+    while not predicate():
+        if CLOCK.lockstep:
+            CLOCK.source.advance()
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(poll)
+
+
+async def run_sync_action(behavior):
+    """
+    Adapter to run the action() of a plain Behavior from an AsyncController. The action runs in the loop executor
+    (it blocks, so it needs its own thread) and cancelling this coroutine calls the behavior suppress() and waits for
+    the action to return, as the threaded Controller would.
+    @param behavior: The synchronous behavior
+    @return: What the action returned
+    """
+    future = asyncio.get_event_loop().run_in_executor(None, behavior.action)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        behavior.suppress()
+        await future
+        raise
+
+
+class AsyncController(Controller):
+    """
+    Controller running on a single asyncio event loop instead of the checker and action threads. Arbitration runs at
+    every notify() or every max_wait seconds; the active action runs as a task on the same loop and is cancelled when a
+    behavior with a higher priority wants to take control.
+
+    AsyncBehavior actions are awaited directly. The actions of plain Behavior subclasses go through run_sync_action, so
+    they still work (in an executor thread) and can be migrated one by one.
+    """
+
+    def __init__(self, return_when_no_action, max_wait=0.01, readings=None, measure_preemption=False):
+        """
+        @param return_when_no_action: Whether start() should return when no behavior wants to run
+        @param max_wait: Deadline (in seconds) after which an arbitration pass runs even if nobody notified the controller
+        @param readings: See Controller
+        @param measure_preemption: See Controller. Suppression is measured as the cancellation of the action task
+        """
+        Controller.__init__(self, return_when_no_action, event_driven=True, max_wait=max_wait, readings=readings,
+                            measure_preemption=measure_preemption)
+        self.loop = None
+        self._wake = None
+        self._task = None
+        self._lockstep_index = None  # index of the behavior whose action task runs, in lockstep
+
+    def step(self):
+        """
+        Find the next active behavior and runs it to completion on a new event loop.
+        @return: Returns whether it got to run any behavior or not
+        """
+        behavior = self.find_next_active_behavior()
+        if behavior is not None:
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._run_action(behavior))
+            finally:
+                loop.close()
+            self.invalidate()
+            return True
+        return False
+
+    async def _run_action(self, index):
+        behavior = self.behaviors[index]
+        if self.preemption is not None:
+            self.preemption.action_started(index)
+        self._action_start = self.clock.time()
+        try:
+            if asyncio.iscoroutinefunction(behavior.action):
+                return await behavior.action()
+            return await run_sync_action(behavior)
+        finally:
+            self._cool_down(behavior, behavior.cooldown)
+
+    async def _cancel_active(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+    def _on_action_done(self, task):
+        self._wake.set()
+
+    async def _arbitrate(self):
+        """
+        Coroutine version of Controller._start: one arbitration pass per wake up
+        """
+        self._running = True
+        self._wake = asyncio.Event()
+        while self._running:
+            if self._task is not None and self._task.done():  # the action got completed the old fashion way
+                task, self._task = self._task, None
+                task.result()  # raises what the action raised, as the threaded controller would
+                self._completed(self.active_behavior_index)
+
+            index = self.active_behavior_index
+            if index is not None and self._over_budget(self.behaviors[index], self._action_start):
+                self._action_start = None
+                await self._cancel_active()
+                if self.trace is not None:
+                    self.trace.record(self.clock.time(), None, index, DecisionTrace.SUPPRESSED | DecisionTrace.OVERRUN)
+                self.active_behavior_index = None
+                self.invalidate()
+
+            new_behavior_priority = self.find_next_active_behavior()
+            if self.active_behavior_index is None or (new_behavior_priority is not None and self.active_behavior_index > new_behavior_priority):
+                if self.active_behavior_index is not None:
+                    if self.preemption is not None:
+                        self.preemption.triggered(self.behaviors[self.active_behavior_index],
+                                                  self.behaviors[new_behavior_priority], new_behavior_priority)
+                        self.preemption.suppress_called()
+                    await self._cancel_active()
+                    if self.preemption is not None:
+                        self.preemption.suppress_returned()
+                if new_behavior_priority != self.active_behavior_index:
+                    self.invalidate()
+                    if self.trace is not None:
+                        self.trace.record(self.clock.time(), new_behavior_priority, self.active_behavior_index,
+                                          0 if self.active_behavior_index is None
+                                          else DecisionTrace.SUPPRESSED | DecisionTrace.PREEMPTED)
+                self.active_behavior_index = new_behavior_priority
+                if new_behavior_priority is not None:
+                    self._cool_down(self.behaviors[new_behavior_priority], self.behaviors[new_behavior_priority].refractory)
+                    self._task = asyncio.ensure_future(self._run_action(new_behavior_priority))
+                    self._task.add_done_callback(self._on_action_done)
+
+                # Callback to tell something it changed the active behavior if anything is interested
+                self.callback(self.active_behavior_index)
+
+            if self.active_behavior_index is None and self._return_when_no_action:
+                break
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+        #Nothing more to do, so we are shutting down
+        await self._cancel_active()
+        self._running = False
+
+    def run_lockstep(self, until=None):
+        """
+        Runs the behaviors on the calling thread only, against the virtual time of self.clock, as Controller.run_lockstep
+        does. The coroutine actions run as tasks on a private event loop and a preemption cancels the task, at its
+        current await. They should wait with wait_motor and wait_until, asyncio.sleep waiting for the real time
+        @param until: Virtual time at which to give up, None to run until done or stopped
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            Controller.run_lockstep(self, until)
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def _lockstep_action(self, behavior):
+        if not asyncio.iscoroutinefunction(behavior.action):
+            return behavior.action()
+        self._task = self.loop.create_task(behavior.action())
+        self._lockstep_index = self.active_behavior_index
+        try:
+            return self.loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            return False
+        finally:
+            self._task = None
+
+    def _lockstep_pass(self):
+        Controller._lockstep_pass(self)
+        if self._task is not None and self.active_behavior_index != self._lockstep_index:  # preempted
+            self._task.cancel()
+
+    def _start(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._arbitrate())
+        finally:
+            self.loop.close()
+            self.loop = None
+
+    def _call_in_loop(self, callback):
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(callback)
+
+    def stop(self):
+        self._running = False
+        self._call_in_loop(self._wake_up)
+
+    def notify(self):
+        """
+        Signal that new sensor data is available, so an arbitration pass runs right away. Safe to call from any thread.
+        """
+        self._call_in_loop(self._wake_up)
+
+    def _wake_up(self):
+        if self._wake is not None:
+            self._wake.set()
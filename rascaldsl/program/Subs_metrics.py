@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Small, allocation free statistics used by the Controller to report on its own timing while the robot is running.
+"""
+import asyncio
+import time
+from array import array
+from bisect import bisect_left
+
+# Upper bounds (in seconds) of the histogram buckets, from 50us to 1s. Everything above goes in the last bucket.
+DEFAULT_BOUNDS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def log_bounds(low, high, per_decade):
+    """
+    Log spaced bucket bounds, for histograms that need a finer resolution than DEFAULT_BOUNDS
+    @param low: First upper bound, in seconds
+    @param high: Last upper bound, in seconds
+    @param per_decade: Number of buckets per power of ten
+    """
+    bounds = []
+    i = 0
+    while True:
+        bound = low * 10 ** (i / float(per_decade))
+        if bound > high * 1.0001:
+            return tuple(bounds)
+        bounds.append(bound)
+        i += 1
+
+
+# 10 buckets per decade from 10us to 2s, i.e. about 26% resolution on the percentiles
+LATENCY_BOUNDS = log_bounds(0.00001, 2.0, 10)
+
+
+class Histogram():
+    """
+    Fixed buckets histogram of durations. Adding a value does not allocate, so it can stay on in production runs.
+    Meant to be written by a single thread and read by any other.
+    """
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        """
+        @param bounds: Sorted upper bounds of the buckets, in seconds
+        """
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        Records one value
+        @param value: The duration to record, in seconds
+        """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket containing the p-th percentile (the max for the overflow bucket)
+        @param p: Percentile between 0 and 100
+        @return: The estimate, or None if nothing got recorded
+        """
+        if self.count == 0:
+            return None
+        target = self.count * p / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def snapshot(self):
+        """
+        @return: A dict copy of the current state, safe to keep around or print
+        """
+        return {"count": self.count, "mean": self.mean(), "max": self.max,
+                "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99),
+                "bounds": list(self.bounds), "counts": list(self.counts)}
+
+
+class TickStats():
+    """
+    Statistics of the Controller periodic scheduler: how late every tick started (jitter), how long the check phase took
+    and how many ticks overran their period
+    """
+
+    def __init__(self, period):
+        """
+        @param period: The period of the scheduler, in seconds
+        """
+        self.period = period
+        self.jitter = Histogram()
+        self.check_duration = Histogram()
+        self.ticks = 0
+        self.overruns = 0
+
+    def reset(self):
+        self.jitter.reset()
+        self.check_duration.reset()
+        self.ticks = 0
+        self.overruns = 0
+
+    def worst_case_reaction(self):
+        """
+        Worst observed time between a sensor change and the end of the check pass that sees it: a full period plus the
+        worst jitter plus the slowest check phase
+        """
+        return self.period + self.jitter.max + self.check_duration.max
+
+    def snapshot(self):
+        return {"period": self.period, "ticks": self.ticks, "overruns": self.overruns,
+                "worst_case_reaction": self.worst_case_reaction(),
+                "jitter": self.jitter.snapshot(), "check_duration": self.check_duration.snapshot()}
+
+
+class PreemptionRecorder():
+    """
+    Measures, for every pair of (preempted behavior, preempting behavior), the time from the higher priority check()
+    returning True to:
+    - suppress: the old behavior suppress() being called
+    - suppressed: that suppress() returning
+    - stop: the motor stop being issued (only if motor_stopped is hooked to the motor, e.g. Motor.stop_hooks)
+    - action: the new behavior action() starting
+    """
+
+    STAGES = ("suppress", "suppressed", "stop", "action")
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.pairs = {}
+        self._pending = None  # (histograms of the pair, trigger time, index of the new behavior)
+        self._stop_pending = False
+
+    def triggered(self, old_behavior, new_behavior, new_index):
+        """
+        Called by the controller as soon as it decided that new_behavior preempts old_behavior
+        """
+        now = time.perf_counter()
+        pair = (type(old_behavior).__name__, type(new_behavior).__name__)
+        histograms = self.pairs.get(pair)
+        if histograms is None:
+            histograms = {stage: Histogram(self.bounds) for stage in self.STAGES}
+            self.pairs[pair] = histograms
+        self._pending = (histograms, now, new_index)
+        self._stop_pending = True
+
+    def _record(self, stage):
+        pending = self._pending
+        if pending is not None:
+            pending[0][stage].add(time.perf_counter() - pending[1])
+
+    def suppress_called(self):
+        self._record("suppress")
+
+    def suppress_returned(self):
+        self._record("suppressed")
+
+    def motor_stopped(self):
+        """
+        Hook for the motor stop. Only the first stop after a trigger counts
+        """
+        if self._stop_pending:
+            self._stop_pending = False
+            self._record("stop")
+
+    def action_started(self, index):
+        pending = self._pending
+        if pending is not None and pending[2] == index:
+            self._record("action")
+            self._pending = None
+
+    def reset(self):
+        self.pairs = {}
+        self._pending = None
+
+    def report(self):
+        """
+        @return: {"Old->New": {stage: {"count", "p50", "p95", "p99", "max"}}} in seconds
+        """
+        report = {}
+        for (old, new), histograms in self.pairs.items():
+            report[old + "->" + new] = {stage: {"count": h.count, "p50": h.percentile(50), "p95": h.percentile(95),
+                                                "p99": h.percentile(99), "max": h.max}
+                                        for stage, h in histograms.items()}
+        return report
+
+
+class BehaviorProfile():
+    """
+    Timing counters of a single behavior, filled by the Profiler wrappers
+    """
+
+    def __init__(self):
+        self.check_calls = 0
+        self.check_time = 0.0
+        self.check_max = 0.0
+        self.true_calls = 0
+        self.true_time = 0.0
+        self.false_time = 0.0
+        self.action_calls = 0
+        self.action_time = 0.0
+        self.action_max = 0.0
+
+    def snapshot(self):
+        return dict(self.__dict__)
+
+
+class Profiler():
+    """
+    Wraps the check() and action() of behaviors to count calls and measure their wall time. The wrappers are instance
+    attributes shadowing the methods, so unwrapping a behavior gives it back its original methods and profiling costs
+    nothing while it is off.
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        self._originals = {}
+
+    def wrap(self, behavior):
+        """
+        Starts profiling a behavior (nothing happens if it is already profiled)
+        """
+        if behavior in self._originals:
+            return
+        self._originals[behavior] = (behavior.__dict__.get("check"), behavior.__dict__.get("action"))
+        profile = self.profiles.get(behavior)
+        if profile is None:
+            profile = self.profiles[behavior] = BehaviorProfile()
+        perf_counter = time.perf_counter
+        check, action = behavior.check, behavior.action
+
+        def profiled_check():
+            start = perf_counter()
+            result = check()
+            elapsed = perf_counter() - start
+            profile.check_calls += 1
+            profile.check_time += elapsed
+            if elapsed > profile.check_max:
+                profile.check_max = elapsed
+            if result:
+                profile.true_calls += 1
+                profile.true_time += elapsed
+            else:
+                profile.false_time += elapsed
+            return result
+
+        def _account_action(elapsed):
+            profile.action_calls += 1
+            profile.action_time += elapsed
+            if elapsed > profile.action_max:
+                profile.action_max = elapsed
+
+        if asyncio.iscoroutinefunction(action):
+            async def profiled_action():
+                start = perf_counter()
+                try:
+                    return await action()
+                finally:
+                    _account_action(perf_counter() - start)
+        else:
+            def profiled_action():
+                start = perf_counter()
+                try:
+                    return action()
+                finally:
+                    _account_action(perf_counter() - start)
+
+        behavior.check = profiled_check
+        behavior.action = profiled_action
+
+    def unwrap(self, behavior):
+        """
+        Stops profiling a behavior, keeping what was measured so far
+        """
+        originals = self._originals.pop(behavior, None)
+        if originals is None:
+            return
+        for name, original in zip(("check", "action"), originals):
+            if original is None:
+                del behavior.__dict__[name]
+            else:
+                behavior.__dict__[name] = original
+
+    def unwrap_all(self):
+        for behavior in list(self._originals):
+            self.unwrap(behavior)
+
+    def reset(self):
+        for profile in self.profiles.values():
+            profile.__init__()
+
+    def report(self, behaviors):
+        """
+        @param behaviors: The behaviors to report on, in priority order
+        @return: A list with one dict per behavior, with its counters and the share of the total check time it took
+        """
+        total_check_time = sum([profile.check_time for profile in self.profiles.values()]) or 1.0
+        report = []
+        for priority, behavior in enumerate(behaviors):
+            profile = self.profiles.get(behavior, BehaviorProfile())
+            entry = profile.snapshot()
+            entry.update({"priority": priority, "name": type(behavior).__name__,
+                          "check_share": profile.check_time / total_check_time,
+                          "check_mean": profile.check_time / profile.check_calls if profile.check_calls else None})
+            report.append(entry)
+        return report
+
+
+class DecisionTrace():
+    """
+    Fixed size ring buffer of the arbitration decisions, kept in preallocated arrays so recording a decision does not
+    allocate nor format anything and can stay on in production runs. Once full, the oldest decisions get overwritten.
+
+    Every entry holds the time, the index of the behavior that won (None when nothing runs anymore), the index of the
+    previously active one and flags telling whether the previous one got suppressed, and whether its action completed,
+    got preempted or ran over its time budget.
+    """
+
+    SUPPRESSED = 1
+    COMPLETED = 2
+    PREEMPTED = 4
+    OVERRUN = 8
+
+    def __init__(self, size=1024):
+        """
+        @param size: Number of decisions kept
+        """
+        self.size = size
+        self.times = array("d", [0.0]) * size
+        self.winners = array("h", [0]) * size
+        self.previous = array("h", [0]) * size
+        self.flags = array("B", [0]) * size
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, timestamp, winner, previous, flags=0):
+        """
+        @param timestamp: When the decision was taken, in seconds
+        @param winner: Index of the behavior taking control, or None
+        @param previous: Index of the behavior that had control, or None
+        @param flags: SUPPRESSED, COMPLETED and PREEMPTED or-ed together
+        """
+        i = self.count % self.size
+        self.times[i] = timestamp
+        self.winners[i] = -1 if winner is None else winner
+        self.previous[i] = -1 if previous is None else previous
+        self.flags[i] = flags
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def entries(self):
+        """
+        @return: The kept decisions, oldest first, as (time, winner, previous, flags) tuples
+        """
+        count, size = self.count, self.size
+        entries = []
+        for n in range(max(0, count - size), count):
+            i = n % size
+            winner, previous = self.winners[i], self.previous[i]
+            entries.append((self.times[i], None if winner < 0 else winner, None if previous < 0 else previous,
+                            self.flags[i]))
+        return entries
+
+    def dump(self, path, names=None):
+        """
+        Writes the kept decisions to a CSV file, oldest first
+        @param path: The file to write
+        @param names: Optional behavior names by priority index, written next to the indexes
+        """
+        def label(index):
+            if index is None:
+                return ""
+            if names is not None and index < len(names):
+                return "{}:{}".format(index, names[index])
+            return str(index)
+
+        with open(path, "w") as f:
+            f.write("# decisions {} kept {} dropped {}\n".format(self.count, len(self), self.count - len(self)))
+            f.write("time,winner,previous,suppressed,outcome\n")
+            for timestamp, winner, previous, flags in self.entries():
+                outcome = "completed" if flags & self.COMPLETED else "preempted" if flags & self.PREEMPTED \
+                    else "overrun" if flags & self.OVERRUN else ""
+                f.write("{:.6f},{},{},{},{}\n".format(timestamp, label(winner), label(previous),
+                                                      int(bool(flags & self.SUPPRESSED)), outcome))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+RGB classification with the lookup table of color_lut against the dict keyed by (r, g, b) tuples of stest.py, on the
+same color ranges: build time, load time (pickle of the dict, table file mapped with mmap), memory and lookups per
+second.
+
+Usage: python3 bench_color.py [seconds_per_run] [bits]
+"""
+import os
+import pickle
+import random
+import sys
+import tempfile
+import time
+
+from color_lut import DEFAULT_RANGES, ColorLUT
+
+
+def set_color_ranges(color_dict, ranges, color_name):
+    """
+    The dict approach, as in stest.py
+    """
+    for r_range, g_range, b_range in ranges:
+        for red in range(r_range[0], r_range[1] + 1):
+            for green in range(g_range[0], g_range[1] + 1):
+                for blue in range(b_range[0], b_range[1] + 1):
+                    color_dict[(red, green, blue)] = color_name
+
+
+def dict_size(color_dict):
+    """
+    @return: Bytes taken by the dict and its keys (the values are shared strings)
+    """
+    size = sys.getsizeof(color_dict)
+    for key in color_dict:
+        size += sys.getsizeof(key) + sum(sys.getsizeof(c) for c in key if c > 256)  # small ints are cached
+    return size
+
+
+def _rate(classify, samples, duration):
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for red, green, blue in samples:
+            classify(red, green, blue)
+        count += len(samples)
+    return count / duration
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    bits = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    start = time.perf_counter()
+    categories = {}
+    for name, box in DEFAULT_RANGES:
+        set_color_ranges(categories, [box], name)
+    dict_build = time.perf_counter() - start
+    pickled = pickle.dumps(categories)
+    start = time.perf_counter()
+    categories = pickle.loads(pickled)
+    dict_load = time.perf_counter() - start
+
+    def classify_dict(red, green, blue):
+        return categories.get((red, green, blue), "nocolor")
+
+    start = time.perf_counter()
+    lut = ColorLUT.from_ranges(DEFAULT_RANGES, bits)
+    lut_build = time.perf_counter() - start
+    handle, path = tempfile.mkstemp(suffix=".bin")
+    os.close(handle)
+    try:
+        lut.save(path)
+        lut_file = os.path.getsize(path)
+        start = time.perf_counter()
+        lut = ColorLUT.load(path)
+        lut_load = time.perf_counter() - start
+    finally:
+        os.remove(path)
+
+    rng = random.Random(0)
+    samples = [(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)) for _ in range(1000)]
+    samples += [(rng.randint(0, 50), rng.randint(0, 50), rng.randint(0, 50)) for _ in range(1000)]  # mostly black
+    # The bins cut the boxes at multiples of 2**(8 - bits), so the values near the edges of the boxes may differ
+    agree = sum(classify_dict(*s) == lut.classify(*s) for s in samples) / len(samples)
+
+    results = (
+        ("dict", dict_build, dict_load, dict_size(categories), len(pickled), _rate(classify_dict, samples, duration)),
+        ("lut", lut_build, lut_load, lut.size, lut_file, _rate(lut.classify, samples, duration)),
+    )
+    print("RGB classification ({} samples, {:.1f}s each, {} bits per channel, {:.1%} agreement):".format(
+        len(samples), duration, bits, agree))
+    print("  {:6s} {:>10s} {:>10s} {:>12s} {:>12s} {:>12s} {:>8s}".format(
+        "", "build (s)", "load (s)", "memory (B)", "file (B)", "lookups/s", "us"))
+    for name, build, load, memory, size, rate in results:
+        print("  {:6s} {:10.3f} {:10.4f} {:12d} {:12d} {:12.0f} {:8.2f}".format(
+            name, build, load, memory, size, rate, 1e6 / rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,658 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the Subs_arch Controller. They only use fake behaviors, so they run on a plain Linux box as well as on the
+brick (no ev3dev2 needed).
+
+Usage: python3 bench_controller.py [seconds_per_run] [--suite] [--output results.json]
+
+With --suite only the arbitration suite runs, and its results are printed as JSON (or written to --output) so they can
+be compared between commits.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+from Subs_arch import Behavior, ChannelController, Controller, RES_ARM, RES_DRIVE, RES_LEDS, RES_SOUND
+from Subs_metrics import Histogram, LATENCY_BOUNDS
+from readings import Readings
+from shared_readings import SensorProcess, SharedReadings
+
+
+class FakeSensorBhv(Behavior):
+    """
+    Stands for UpdateReadings: a check with some fixed cost that never wants to take control
+    """
+
+    def __init__(self, cost=200):
+        Behavior.__init__(self)
+        self.cost = cost
+        self.checks = 0
+
+    def check(self):
+        self.checks += 1
+        for _ in range(self.cost):
+            pass
+        return False
+
+    def action(self):
+        return True
+
+    def suppress(self):
+        pass
+
+
+class FakeMotor():
+    """
+    Stands for commons.Motor, only keeps track of the stops
+    """
+
+    def __init__(self):
+        self.stop_hooks = []
+
+    def stop(self):
+        for hook in self.stop_hooks:
+            hook()
+
+
+class FakeDriveBhv(Behavior):
+    """
+    Stands for RunningBhv: keeps control, does chunks of work and polls a "motor" in between
+    """
+
+    def __init__(self, chunk=1000, poll=0.001, motor=None):
+        Behavior.__init__(self)
+        self.suppressed = False
+        self.chunk = chunk
+        self.poll = poll
+        self.chunks = 0
+        self.motor = motor if motor is not None else FakeMotor()
+
+    def check(self):
+        return True
+
+    def action(self):
+        self.suppressed = False
+        while not self.suppressed:
+            for _ in range(self.chunk):
+                pass
+            self.chunks += 1
+            time.sleep(self.poll)
+        return not self.suppressed
+
+    def suppress(self):
+        self.motor.stop()
+        self.suppressed = True
+
+
+class FakeCliffBhv(Behavior):
+    """
+    Stands for CliffAvoidanceBhv: fires once every time trigger() is called and runs a short maneuver
+    """
+
+    def __init__(self, duration=0.01):
+        Behavior.__init__(self)
+        self.duration = duration
+        self.triggered = False
+
+    def trigger(self):
+        self.triggered = True
+
+    def check(self):
+        if self.triggered:
+            self.triggered = False
+            return True
+        return False
+
+    def action(self):
+        time.sleep(self.duration)
+        return True
+
+    def suppress(self):
+        pass
+
+
+class FakeTaskBhv(Behavior):
+    """
+    Stands for one step of a mission (drive somewhere, lower the arm, speak...): wants to run until its action completed
+    once without being suppressed
+    """
+
+    def __init__(self, resources, duration=0.2):
+        Behavior.__init__(self)
+        self.resources = resources
+        self.duration = duration
+        self.suppressed = False
+        self.done = False
+
+    def check(self):
+        return not self.done
+
+    def action(self):
+        self.suppressed = False
+        end = time.perf_counter() + self.duration
+        while time.perf_counter() < end and not self.suppressed:
+            time.sleep(0.005)
+        self.done = not self.suppressed
+        return self.done
+
+    def suppress(self):
+        self.suppressed = True
+
+
+def _publisher(controller, rate, stop_event):
+    """
+    Simulates the slave readings arriving over bluetooth, notifying the controller at a fixed rate
+    """
+    while not stop_event.is_set():
+        time.sleep(1.0 / rate)
+        controller.notify()
+
+
+CHECKER_MODES = ("busy", "event", "periodic")
+
+
+def bench_checker_modes(duration=2.0, publish_rate=20, period=0.01):
+    """
+    Compares the busy looping checker against the event driven and the periodic ones.
+    @return: a dict per mode with the cpu share of the process, checker passes per second and action chunks per second
+    (plus the tick statistics for the periodic mode)
+    """
+    results = {}
+    modes_kwargs = {"busy": {}, "event": {"event_driven": True}, "periodic": {"period": period}}
+    for mode in CHECKER_MODES:
+        controller = Controller(return_when_no_action=False, **modes_kwargs[mode])
+        sensor, drive = FakeSensorBhv(), FakeDriveBhv()
+        controller.add(sensor)
+        controller.add(drive)
+
+        stop_event = threading.Event()
+        publisher = threading.Thread(target=_publisher, args=(controller, publish_rate, stop_event))
+        publisher.daemon = True
+
+        controller.start(run_in_thread=True)
+        publisher.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        checks_start, chunks_start = sensor.checks, drive.chunks
+        time.sleep(duration)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        checks, chunks = sensor.checks - checks_start, drive.chunks - chunks_start
+        stop_event.set()
+        controller.stop()
+        time.sleep(0.1)  # let the threads notice the stop
+
+        results[mode] = {"cpu_share": cpu / wall, "checks_per_s": checks / wall, "action_chunks_per_s": chunks / wall}
+        if controller.tick_stats is not None:
+            results[mode]["tick_stats"] = controller.tick_stats.snapshot()
+    return results
+
+
+def bench_preemption(duration=2.0, rate=20, period=0.01):
+    """
+    Fires a cliff at random intervals (rate per second on average) while the drive behavior runs, and measures the
+    preemption latency for each checker mode.
+    @return: a dict per mode with the PreemptionRecorder report
+    """
+    results = {}
+    modes_kwargs = {"busy": {}, "event": {"event_driven": True}, "periodic": {"period": period}}
+    for mode in CHECKER_MODES:
+        controller = Controller(return_when_no_action=False, measure_preemption=True, **modes_kwargs[mode])
+        cliff, drive = FakeCliffBhv(), FakeDriveBhv()
+        drive.motor.stop_hooks.append(controller.preemption.motor_stopped)
+        controller.add(cliff)
+        controller.add(drive)
+
+        controller.start(run_in_thread=True)
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            time.sleep(random.expovariate(rate))
+            cliff.trigger()
+            controller.notify()
+        controller.stop()
+        time.sleep(0.1)
+
+        results[mode] = controller.preemption.report()
+    return results
+
+
+def bench_profile(duration=2.0, period=0.01):
+    """
+    Runs the fake behaviors with profiling on, to show how the check time of an arbitration pass is split
+    @return: the Controller.profile_report()
+    """
+    controller = Controller(return_when_no_action=False, period=period, profile=True)
+    cliff = FakeCliffBhv()
+    controller.add(FakeSensorBhv(cost=2000))
+    controller.add(cliff)
+    controller.add(FakeDriveBhv())
+    controller.start(run_in_thread=True)
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        time.sleep(0.1)
+        cliff.trigger()
+    controller.stop()
+    time.sleep(0.1)
+    return controller.profile_report()
+
+
+def bench_channels(duration=0.2):
+    """
+    Time to complete a measurement like sequence (drive, arm, speech, leds, and a second drive step) with a single
+    active behavior against per resource arbitration
+    @return: completion time in seconds per controller
+    """
+    results = {}
+    for cls in (Controller, ChannelController):
+        controller = cls(return_when_no_action=True, event_driven=True)
+        for resources in ((RES_DRIVE,), (RES_ARM,), (RES_SOUND,), (RES_LEDS,), (RES_DRIVE,)):
+            controller.add(FakeTaskBhv(resources, duration))
+        start = time.perf_counter()
+        controller.start()
+        results[cls.__name__] = time.perf_counter() - start
+    return results
+
+
+def bench_arbitration(sizes=(5, 20, 100), passes=20000):
+    """
+    Cost of one arbitration pass (no behavior wants to run, so every check gets called) with the loop over the behaviors
+    against the generated function, for a few numbers of behaviors
+    @return: {n_behaviors: {"loop": seconds per pass, "compiled": seconds per pass}}
+    """
+    results = {}
+    for n in sizes:
+        results[n] = {}
+        for name, compile_checks in (("loop", False), ("compiled", True)):
+            controller = Controller(return_when_no_action=True, compile_checks=compile_checks)
+            for _ in range(n):
+                controller.add(FakeSensorBhv(cost=0))
+            find = controller.find_next_active_behavior
+            find()
+            start = time.perf_counter()
+            for _ in range(passes):
+                find()
+            results[n][name] = (time.perf_counter() - start) / passes
+    return results
+
+
+def _work(cost):
+    for _ in range(cost):
+        pass
+
+
+class _CliffSource():
+    """
+    Stands for the floor under a sensor: a cliff appears at random times (rate per second on average) and stays hold
+    seconds. read() returns (cliff, time the last cliff appeared)
+    """
+
+    def __init__(self, rate, hold):
+        self.rate = rate
+        self.hold = hold
+        self.event = 0.0
+        self.next_event = time.monotonic() + random.expovariate(rate)
+
+    def read(self):
+        now = time.monotonic()
+        if now >= self.next_event:
+            self.event = self.next_event
+            self.next_event = self.event + self.hold + random.expovariate(self.rate)
+        return now < self.event + self.hold, self.event
+
+
+class FakeDeciderBhv(Behavior):
+    """
+    Takes control when a new cliff shows up in the readings, recording how long after it appeared
+    """
+
+    def __init__(self, readings):
+        Behavior.__init__(self)
+        self.readings = readings
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.seen = 0.0
+
+    def check(self):
+        readings = self.readings
+        if readings["CLIFF"] and readings["EVENT_T"] != self.seen:
+            self.seen = readings["EVENT_T"]
+            self.latency.add(time.monotonic() - self.seen)
+            return True
+        return False
+
+    def action(self):
+        time.sleep(0.005)
+        return True
+
+    def suppress(self):
+        pass
+
+
+class FakeUpdateBhv(Behavior):
+    """
+    Stands for UpdateReadings: reads the local sensors (sensor_cost) and copies what the link thread received
+    """
+
+    def __init__(self, readings, link, sensor_cost):
+        Behavior.__init__(self)
+        self.readings = readings
+        self.link = link
+        self.sensor_cost = sensor_cost
+
+    def check(self):
+        _work(self.sensor_cost)
+        self.readings.update(self.link[0])
+        return False
+
+    def action(self):
+        return True
+
+    def suppress(self):
+        pass
+
+
+class FakeSharedUpdateBhv(FakeUpdateBhv):
+    """
+    Stands for UpdateSharedReadings
+    """
+
+    def __init__(self, readings, shared):
+        FakeUpdateBhv.__init__(self, readings, None, 0)
+        self.shared = shared
+
+    def check(self):
+        self.shared.refresh(self.readings)
+        return False
+
+
+def _link_thread(link, source, period, parse_cost, stop_event):
+    """
+    Stands for the BluetoothConnection listener thread: receives the slave readings every period and parses them
+    """
+    while not stop_event.is_set():
+        time.sleep(period)
+        cliff, event = source.read()
+        _work(parse_cost)
+        link[0] = {"CLIFF": cliff, "EVENT_T": event}
+
+
+def bench_sensor_latency(duration=2.0, rate=20, period=0.005, sensor_cost=3000, parse_cost=1000):
+    """
+    Time from a cliff appearing to the controller deciding on it, with the sensors and the link polled in the controller
+    process (sensors in the checker pass, link in a listener thread) and with them moved to a SensorProcess publishing in
+    shared memory. A drive behavior keeps the action thread busy in both layouts.
+    @return: {"threads": Histogram snapshot, "process": Histogram snapshot} of the latencies, in seconds
+    """
+    results = {}
+    hold = 0.05
+    for layout in ("threads", "process"):
+        readings = Readings({"CLIFF": False, "EVENT_T": 0.0})
+        stop_event = threading.Event()
+        controller = Controller(return_when_no_action=False, readings=readings)
+        if layout == "threads":
+            link = [{}]
+            thread = threading.Thread(target=_link_thread,
+                                      args=(link, _CliffSource(rate, hold), period, parse_cost, stop_event))
+            thread.daemon = True
+            thread.start()
+            controller.add(FakeUpdateBhv(readings, link, sensor_cost))
+        else:
+            shared = SharedReadings(list(readings))
+
+            def make_poll():
+                source = _CliffSource(rate, hold)
+
+                def poll():
+                    _work(sensor_cost + parse_cost)
+                    cliff, event = source.read()
+                    return {"CLIFF": cliff, "EVENT_T": event}
+                return poll
+
+            process = SensorProcess(shared, make_poll, period)
+            process.start()
+            controller.add(FakeSharedUpdateBhv(readings, shared))
+        decider = FakeDeciderBhv(readings)
+        controller.add(decider)
+        controller.add(FakeDriveBhv())
+
+        controller.start(run_in_thread=True)
+        time.sleep(duration)
+        controller.stop()
+        stop_event.set()
+        if layout == "process":
+            process.stop()
+            shared.close()
+        time.sleep(0.1)
+        results[layout] = decider.latency.snapshot()
+    return results
+
+
+class FakeBhv(Behavior):
+    """
+    Generic behavior for the arbitration suite: its check costs check_cost loop iterations and wants to run with the
+    given probability; its action lasts duration seconds unless suppressed
+    """
+
+    def __init__(self, check_cost=100, probability=0.01, duration=0.002):
+        Behavior.__init__(self)
+        self.check_cost = check_cost
+        self.probability = probability
+        self.duration = duration
+        self.suppressed = False
+        self.checks = 0
+
+    def check(self):
+        self.checks += 1
+        _work(self.check_cost)
+        return random.random() < self.probability
+
+    def action(self):
+        self.suppressed = False
+        end = time.perf_counter() + self.duration
+        while time.perf_counter() < end and not self.suppressed:
+            time.sleep(0.0005)
+        return not self.suppressed
+
+    def suppress(self):
+        self.suppressed = True
+
+
+def _merged_stage(recorder, stage):
+    """
+    @return: Snapshot of the given stage of a PreemptionRecorder, all behavior pairs together
+    """
+    merged = Histogram(recorder.bounds)
+    for histograms in recorder.pairs.values():
+        histogram = histograms[stage]
+        merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        merged.count += histogram.count
+        merged.total += histogram.total
+        merged.max = max(merged.max, histogram.max)
+    snapshot = merged.snapshot()
+    del snapshot["bounds"], snapshot["counts"]
+    return snapshot
+
+
+class WinnerChanges():
+    """
+    Counts the decisions of a controller, i.e. the passes electing another behavior than the one elected before (a
+    behavior going idle in between does not count). Used as Controller.callback in the threaded modes
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.winner = None
+
+    def __call__(self, index):
+        if index is not None and index != self.winner:
+            self.winner = index
+            self.count += 1
+            return True
+        return False
+
+
+def _suite_controller(n, check_cost, probability, action_duration, **kwargs):
+    controller = Controller(return_when_no_action=False, **kwargs)
+    for _ in range(n - 1):
+        controller.add(FakeBhv(check_cost, probability, action_duration))
+    controller.add(FakeBhv(check_cost, 1.0, 25 * action_duration))  # the RunningBhv of the suite, always wants to run
+    return controller
+
+
+SUITE_MODES = ("periodic", "event", "step")
+
+
+def bench_suite(sizes=(5, 20, 100), duration=2.0, check_cost=100, probability=0.01, period=0.002, publish_rate=100,
+                action_duration=0.002):
+    """
+    Arbitration suite: for every number of behaviors, runs FakeBhv behaviors through the threaded start() with the
+    periodic checker and with the event driven one (notified publish_rate times per second), and through a step() loop.
+    In the threaded modes the actions last action_duration seconds (25 times that for the last behavior, which always
+    wants to run) unless preempted; in the step() loop they return right away, so only the arbitration is measured.
+
+    A decision is a pass electing another behavior than the one elected before, in every mode, and a pass is a check of
+    the highest priority behavior. The preemption latency is the check to action one of the PreemptionRecorder in the
+    threaded modes; the step() loop can not preempt an action, there it is the time from the start of the pass electing
+    a higher priority behavior to the start of its action.
+    @return: A list with one dict per (mode, number of behaviors): decisions and passes per second, cpu share of the
+    process and the preemption latency
+    """
+    results = []
+    modes_kwargs = {"periodic": {"period": period}, "event": {"event_driven": True}}
+    for n in sizes:
+        for mode in SUITE_MODES[:2]:
+            controller = _suite_controller(n, check_cost, probability, action_duration, measure_preemption=True,
+                                           **modes_kwargs[mode])
+            controller.callback = decisions = WinnerChanges()
+            stop_event = threading.Event()
+            publisher = threading.Thread(target=_publisher, args=(controller, publish_rate, stop_event))
+            publisher.daemon = True
+            first = controller.behaviors[0]
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            controller.start(run_in_thread=True)
+            if mode == "event":
+                publisher.start()
+            time.sleep(duration)
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            passes = first.checks
+            stop_event.set()
+            controller.stop()
+            time.sleep(0.1)
+            results.append({"mode": mode, "behaviors": n, "decisions_per_s": decisions.count / wall,
+                            "passes_per_s": passes / wall, "cpu_share": cpu / wall,
+                            "preemption": _merged_stage(controller.preemption, "action")})
+
+        controller = _suite_controller(n, check_cost, probability, 0.0)
+        decisions = WinnerChanges()
+        latency = Histogram(LATENCY_BOUNDS)
+        passes = 0
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        end = wall_start + duration
+        while time.perf_counter() < end:  # step(), with the pass and the action apart to time them
+            start = time.perf_counter()
+            previous = decisions.winner
+            index = controller.find_next_active_behavior()
+            passes += 1
+            if index is None:
+                continue
+            if decisions(index) and previous is not None and index < previous:
+                latency.add(time.perf_counter() - start)
+            controller.behaviors[index].action()
+            controller.invalidate()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        preemption = latency.snapshot()
+        del preemption["bounds"], preemption["counts"]
+        results.append({"mode": "step", "behaviors": n, "decisions_per_s": decisions.count / wall,
+                        "passes_per_s": passes / wall, "cpu_share": cpu / wall, "preemption": preemption})
+    return results
+
+
+def suite_report(duration=2.0, **kwargs):
+    """
+    @return: The bench_suite results with what is needed to compare them later
+    """
+    return {"python": platform.python_version(), "machine": platform.machine(), "duration": duration,
+            "time": time.time(), "results": bench_suite(duration=duration, **kwargs)}
+
+
+def _ms(value):
+    return "   -   " if value is None else "{:7.3f}".format(1000 * value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the Subs_arch controllers")
+    parser.add_argument("duration", nargs="?", type=float, default=2.0, help="seconds per run")
+    parser.add_argument("--suite", action="store_true", help="only run the arbitration suite, printed as JSON")
+    parser.add_argument("--output", help="also write the arbitration suite results (JSON) to this file")
+    args = parser.parse_args()
+    duration = args.duration
+
+    if args.suite or args.output:
+        report = suite_report(duration)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+        if args.suite:
+            json.dump(report, sys.stdout, indent=1, sort_keys=True)
+            print()
+            return
+    else:
+        report = suite_report(duration)
+
+    print("Arbitration suite ({:.1f}s each), latency in ms:".format(duration))
+    for res in report["results"]:
+        latency = res["preemption"] or {"p50": None, "p99": None}
+        print("  {:8s} {:3d} behaviors  decisions/s {:8.1f}  passes/s {:9.1f}  cpu {:5.1f}%  preemption p50 {} p99 {}".format(
+            res["mode"], res["behaviors"], res["decisions_per_s"], res["passes_per_s"], 100 * res["cpu_share"],
+            _ms(latency["p50"]), _ms(latency["p99"])))
+
+    print("Checker modes ({:.1f}s each):".format(duration))
+    results = bench_checker_modes(duration)
+    for mode in CHECKER_MODES:
+        res = results[mode]
+        print("  {:8s} cpu {:5.1f}%  checks/s {:10.0f}  action chunks/s {:7.0f}".format(
+            mode, 100 * res["cpu_share"], res["checks_per_s"], res["action_chunks_per_s"]))
+        if "tick_stats" in res:
+            ticks = res["tick_stats"]
+            print("             ticks {}  overruns {}  jitter p99 {:.6f}s  check max {:.6f}s  worst reaction {:.6f}s".format(
+                ticks["ticks"], ticks["overruns"], ticks["jitter"]["p99"], ticks["check_duration"]["max"],
+                ticks["worst_case_reaction"]))
+
+
+    print("Arbitration pass in us (loop / compiled):")
+    for n, res in sorted(bench_arbitration().items()):
+        print("  {:3d} behaviors {:8.2f} {:8.2f}  x{:.2f}".format(
+            n, 1e6 * res["loop"], 1e6 * res["compiled"], res["loop"] / res["compiled"]))
+
+    print("Sensor to decision latency in ms ({:.1f}s each):".format(duration))
+    results = bench_sensor_latency(duration)
+    for layout in ("threads", "process"):
+        res = results[layout]
+        print("  {:8s} n={:<5d} p50 {} p95 {} p99 {} max {}".format(
+            layout, res["count"], _ms(res["p50"]), _ms(res["p95"]), _ms(res["p99"]), _ms(res["max"])))
+
+    print("Mission steps completion time:")
+    for name, elapsed in sorted(bench_channels().items()):
+        print("  {:18s} {:.3f}s".format(name, elapsed))
+
+    print("Preemption latency in ms, p50/p95/p99 ({:.1f}s each):".format(duration))
+    results = bench_preemption(duration)
+    for mode in CHECKER_MODES:
+        for pair, stages in sorted(results[mode].items()):
+            print("  {:8s} {}".format(mode, pair))
+            for stage in ("suppress", "stop", "action"):
+                res = stages[stage]
+                print("           {:9s} n={:<5d} {} {} {}".format(
+                    stage, res["count"], _ms(res["p50"]), _ms(res["p95"]), _ms(res["p99"])))
+
+    print("Check/action profile, times in ms ({:.1f}s):".format(duration))
+    for entry in bench_profile(duration):
+        print("  {:2d} {:14s} checks {:6d} share {:5.1f}%  mean {}  max {}  true {:4d} ({} total)  actions {:4d} max {}".format(
+            entry["priority"], entry["name"], entry["check_calls"], 100 * entry["check_share"], _ms(entry["check_mean"]),
+            _ms(entry["check_max"]), entry["true_calls"], _ms(entry["true_time"]), entry["action_calls"],
+            _ms(entry["action_max"])))
+
+
+if __name__ == "__main__":
+    main()
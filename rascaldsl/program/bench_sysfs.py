@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Reads per second of the sysfs fast path (sysfs.SysfsSensor) against the ev3dev2 attribute access. On the brick it uses
+the real sensor on the given port; elsewhere it builds a fake lego-sensor tree in a temporary directory and compares
+with the way ev3dev2 reads an attribute (seek, read, strip, decode, int on a file opened once).
+
+Usage: python3 bench_sysfs.py [seconds_per_run] [port, e.g. ev3-ports:in1]
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sysfs import SYSFS_ROOT, SysfsSensor, find_sensor, make_fake_sensor, write_fake_value
+
+
+class Ev3dev2LikeAttribute():
+    """
+    What ev3dev2 Device.value() does at every read, for when ev3dev2 is not installed
+    """
+
+    def __init__(self, path):
+        self.attribute = io.FileIO(os.path.join(path, "value0"), "r")
+
+    def value(self):
+        self.attribute.seek(0)
+        return int(self.attribute.read().strip().decode())
+
+
+def _rate(read, duration):
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for _ in range(100):
+            read()
+        count += 100
+    return count / duration
+
+
+def bench(path, duration, ev3dev2_read):
+    fast = SysfsSensor(path)
+    assert fast.read() == ev3dev2_read(), "the fast path does not read the same value"
+    results = {"ev3dev2": _rate(ev3dev2_read, duration), "sysfs": _rate(fast.read, duration)}
+    fast.close()
+    return results
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    port = sys.argv[2] if len(sys.argv) > 2 else "ev3-ports:in1"
+
+    if os.path.isdir(SYSFS_ROOT):
+        from ev3dev2.sensor import Sensor
+        path = find_sensor(port)
+        sensor = Sensor(port)
+        results = bench(path, duration, lambda: sensor.value())
+        where = "brick, " + port
+    else:
+        root = tempfile.mkdtemp()
+        try:
+            path = make_fake_sensor(root, "sensor0", port, "lego-ev3-color", "COL-COLOR", [6])
+            assert find_sensor(port, root) == path
+            write_fake_value(path, 1234)
+            attribute = Ev3dev2LikeAttribute(path)
+            results = bench(path, duration, attribute.value)
+        finally:
+            shutil.rmtree(root)
+        where = "fake tree"
+
+    print("Reads per second ({}, {:.1f}s each):".format(where, duration))
+    for name in ("ev3dev2", "sysfs"):
+        print("  {:8s} {:10.0f}".format(name, results[name]))
+    print("  speedup  x{:.2f}".format(results["sysfs"] / results["ev3dev2"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Offline calibration of the color classification: records raw RGB samples of the surfaces of an arena on the brick,
+fits a classifier on them (nearest centroid or k nearest neighbours, both with a reject region giving "nocolor") and
+bakes it into a color_lut table file the robot maps at startup (commons.load_color_lut). To be done again for every
+arena and lighting condition.
+
+Usage:
+    on the brick, once per surface (the label being one of color_lut.COLOR_NAMES):
+        python3 calibrate_color.py record black samples.csv --count 200 --port ev3-ports:in2
+        python3 calibrate_color.py record black raw_samples.csv --mode RGB-RAW  # for start_sensor_service(rgb=True)
+    anywhere:
+        python3 calibrate_color.py fit samples.csv color_lut.bin [--method knn] [--k 7] [--reject 3.0]
+        python3 calibrate_color.py fit raw_samples.csv color_lut_raw.bin --in-bits 10  # the fast path table
+        python3 calibrate_color.py verify color_lut.bin  # the robot does not check the file, see ColorLUT.load
+
+The samples are kept as "label,r,g,b" lines, so recordings of several sessions can simply be concatenated.
+"""
+import argparse
+import csv
+import math
+import sys
+
+from color_lut import COLOR_NAMES, ColorLUT
+
+
+def read_samples(path):
+    """
+    @return: [(label, (r, g, b))] of a samples file
+    """
+    samples = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            label, rgb = row[0].strip(), tuple(int(v) for v in row[1:4])
+            if label not in COLOR_NAMES:
+                raise ValueError("Unknown label {} in {}".format(label, path))
+            samples.append((label, rgb))
+    return samples
+
+
+def record(label, path, count, port, mode, period):
+    """
+    Reads the color sensor count times and appends the samples to a samples file
+    @param mode: "RGB-RAW" (0-1020 values, bake with --in-bits 10) or "RGB" (ColorSensor.rgb, 0-255 values)
+    """
+    import time
+    from ev3dev2.sensor.lego import ColorSensor
+    sensor = ColorSensor(port)
+    if mode == "RGB-RAW":
+        sensor.mode = ColorSensor.MODE_RGB_RAW
+        read = lambda: sensor.raw
+    else:
+        read = lambda: sensor.rgb
+    with open(path, "a") as f:
+        writer = csv.writer(f)
+        for _ in range(count):
+            writer.writerow((label,) + tuple(read()))
+            time.sleep(period)
+
+
+def _distance(a, b):
+    return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
+
+
+class NearestCentroid():
+    """
+    Gives the label of the nearest class mean. A value is rejected when it is further from that mean than reject
+    times the spread (standard deviation of the distances to the mean) of the class, or when the two nearest means are
+    almost at the same distance
+    """
+
+    def __init__(self, samples, reject=3.0, margin=1.1):
+        """
+        @param reject: Size of the accepted region around a mean, in spreads of its class
+        @param margin: Minimum ratio between the distances to the second and the nearest mean
+        """
+        self.reject = reject
+        self.margin = margin
+        by_label = {}
+        for label, rgb in samples:
+            by_label.setdefault(label, []).append(rgb)
+        self.classes = []
+        for label, values in sorted(by_label.items()):
+            mean = tuple(sum(v[c] for v in values) / len(values) for c in range(3))
+            spread = math.sqrt(sum(_distance(v, mean) ** 2 for v in values) / len(values))
+            self.classes.append((label, mean, max(spread, 1.0)))
+
+    def __call__(self, rgb):
+        distances = sorted((_distance(rgb, mean), spread, label) for label, mean, spread in self.classes)
+        nearest, spread, label = distances[0]
+        if nearest > self.reject * spread:
+            return COLOR_NAMES[0]
+        if len(distances) > 1 and distances[1][0] < self.margin * nearest:
+            return COLOR_NAMES[0]
+        return label
+
+
+class KNearestNeighbours():
+    """
+    Gives the label most of the k nearest samples have. A value is rejected when fewer than min_votes of them agree, or
+    when the nearest sample is further than max_distance
+    """
+
+    def __init__(self, samples, k=7, min_votes=None, max_distance=40.0):
+        """
+        @param min_votes: Votes needed to accept a label, more than half of k by default
+        @param max_distance: Distance to the nearest sample beyond which a value is unknown, in the input range
+        """
+        self.samples = samples
+        self.k = k
+        self.min_votes = k // 2 + 1 if min_votes is None else min_votes
+        self.max_distance = max_distance
+
+    def __call__(self, rgb):
+        nearest = sorted((_distance(rgb, value), label) for label, value in self.samples)[:self.k]
+        if not nearest or nearest[0][0] > self.max_distance:
+            return COLOR_NAMES[0]
+        votes = {}
+        for _, label in nearest:
+            votes[label] = votes.get(label, 0) + 1
+        label, count = max(votes.items(), key=lambda item: item[1])
+        return label if count >= self.min_votes else COLOR_NAMES[0]
+
+
+def bake(classify, bits=5, in_bits=8):
+    """
+    @param classify: The fitted classifier, called on the center of every cell
+    @return: The ColorLUT
+    """
+    lut = ColorLUT(bits, in_bits)
+    label_index = {label: i for i, label in enumerate(lut.labels)}
+    table = lut.table
+    for index in range(lut.size):
+        table[index] = label_index[classify(lut.center(index))]
+    return lut
+
+
+def report(lut, samples):
+    """
+    @return: {label: (samples, classified right, rejected)} of the baked table on the samples
+    """
+    results = {}
+    for label, rgb in samples:
+        total, right, rejected = results.get(label, (0, 0, 0))
+        got = lut.classify(*rgb)
+        results[label] = (total + 1, right + (got == label), rejected + (got == COLOR_NAMES[0]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Color lookup table calibration")
+    commands = parser.add_subparsers(dest="command")
+    recording = commands.add_parser("record", help="Record samples of a surface (on the brick)")
+    recording.add_argument("label", choices=COLOR_NAMES[1:])
+    recording.add_argument("samples")
+    recording.add_argument("--count", type=int, default=200)
+    recording.add_argument("--port", default="ev3-ports:in2")
+    recording.add_argument("--mode", choices=("RGB", "RGB-RAW"), default="RGB")
+    recording.add_argument("--period", type=float, default=0.02)
+    fitting = commands.add_parser("fit", help="Fit a classifier on samples and bake it into a table file")
+    fitting.add_argument("samples")
+    fitting.add_argument("output")
+    fitting.add_argument("--method", choices=("centroid", "knn"), default="centroid")
+    fitting.add_argument("--reject", type=float, default=3.0, help="centroid: accepted spreads around a mean")
+    fitting.add_argument("--margin", type=float, default=1.1, help="centroid: minimum ratio of the two nearest")
+    fitting.add_argument("--k", type=int, default=7, help="knn: neighbours")
+    fitting.add_argument("--max-distance", type=float, default=40.0, help="knn: reject beyond this distance")
+    fitting.add_argument("--bits", type=int, default=5)
+    fitting.add_argument("--in-bits", type=int, default=8, help="8 for RGB samples, 10 for RGB-RAW ones")
+    verifying = commands.add_parser("verify", help="Check a table file against its checksum before copying it")
+    verifying.add_argument("table")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.label, args.samples, args.count, args.port, args.mode, args.period)
+    elif args.command == "fit":
+        samples = read_samples(args.samples)
+        if args.method == "centroid":
+            classify = NearestCentroid(samples, args.reject, args.margin)
+        else:
+            classify = KNearestNeighbours(samples, args.k, max_distance=args.max_distance)
+        lut = bake(classify, args.bits, args.in_bits)
+        lut.save(args.output)
+        ColorLUT.load(args.output, verify=True)  # the robot maps it without checking
+        print("{} cells written to {}".format(lut.size, args.output))
+        for label, (total, right, rejected) in sorted(report(lut, samples).items()):
+            print("  {:8s} {:5d} samples {:6.1%} right {:6.1%} rejected".format(
+                label, total, right / total, rejected / total))
+    elif args.command == "verify":
+        try:
+            lut = ColorLUT.load(args.table, verify=True)
+        except (IOError, OSError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+        print("{}: {} bits per channel, {} bits values, labels {}".format(
+            args.table, lut.bits, lut.in_bits, ", ".join(lut.labels)))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
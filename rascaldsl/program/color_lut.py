@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Classification of the raw RGB values of the color sensor through a quantized 3-D lookup table: every channel is cut
+into 2**bits bins, and one byte per (r, g, b) bin holds the index of the color name in a labels table (the names
+int2color returns). A lookup is a few shifts and two indexings, and with 5 bits per channel the table takes 32 KB,
+where the dict keyed by (r, g, b) tuples of stest.py needs an entry (and a tuple) per value.
+
+The tables are baked offline from recorded samples (see calibrate_color.py) and saved to a file the robot maps in
+memory at startup (ColorLUT.load), so nothing is parsed or copied when it starts, whatever the number of bins: the
+master, the slave, the tools and the simulator mapping the same file share its pages. The file is a small header
+followed by the cells:
+
+    "CLUT", version (u16), bits (u8), in_bits (u8), number of labels (u8),
+    every label as its length (u8) and its utf-8 bytes,
+    crc32 of the cells (u32),
+    the 2**(3 * bits) cells.
+
+Kept free of ev3dev2 imports so it can be built and benchmarked off the brick.
+"""
+import mmap
+import struct
+import zlib
+
+MAGIC = b"CLUT"
+VERSION = 1
+_HEADER = struct.Struct("<4sHBBB")
+_CHECKSUM = struct.Struct("<I")
+
+COLOR_NAMES = ("nocolor", "black", "blue", "green", "yellow", "red", "white")  # the names of commons.int2color
+
+# The thresholds tried in stest.py, as (name, ((r_min, r_max), (g_min, g_max), (b_min, b_max))) on 0-255 values
+DEFAULT_RANGES = (
+    ("black", ((0, 50), (0, 50), (0, 50))),
+    ("white", ((200, 255), (200, 255), (200, 255))),
+    ("blue", ((0, 50), (0, 50), (200, 255))),
+    ("red", ((200, 255), (0, 50), (0, 50))),
+    ("yellow", ((150, 250), (150, 250), (0, 100))),
+)
+
+
+class ColorLUT():
+    """
+    Maps (r, g, b) to a color name. The cells nothing was assigned to give labels[0] ("nocolor")
+    """
+
+    def __init__(self, bits=5, in_bits=8, labels=COLOR_NAMES, table=None):
+        """
+        @param bits: Bins per channel, as a power of 2: the table has 2**(3 * bits) cells
+        @param in_bits: Bits of the values given to classify: 8 for ColorSensor.rgb (0-255), 10 for the RGB-RAW mode
+        (0-1020)
+        @param labels: The names the cells can hold, the first one being the default
+        @param table: The cells, anything indexable giving ints (bytearray, bytes, mmap), a new empty bytearray by default
+        """
+        if not 0 < bits <= in_bits:
+            raise ValueError("bits must be between 1 and in_bits")
+        if len(labels) > 256:
+            raise ValueError("At most 256 labels fit in a byte")
+        self.bits = bits
+        self.in_bits = in_bits
+        self.labels = tuple(labels)
+        self._label_index = {label: i for i, label in enumerate(self.labels)}
+        self.size = 1 << (3 * bits)
+        if table is None:
+            table = bytearray(self.size)
+        elif len(table) != self.size:
+            raise ValueError("The table has {} cells, {} expected".format(len(table), self.size))
+        self.table = table
+        self._shift = in_bits - bits
+        self._max = (1 << in_bits) - 1
+
+    def index(self, red, green, blue):
+        """
+        @return: The cell of the table holding (red, green, blue)
+        """
+        shift, bits = self._shift, self.bits
+        return ((red >> shift) << (2 * bits)) | ((green >> shift) << bits) | (blue >> shift)
+
+    def classify(self, red, green, blue):
+        """
+        @return: The color name of (red, green, blue), values above the input range being clamped
+        """
+        top = self._max
+        if red > top or green > top or blue > top:
+            red, green, blue = min(red, top), min(green, top), min(blue, top)
+        shift, bits = self._shift, self.bits
+        return self.labels[self.table[((red >> shift) << (2 * bits)) | ((green >> shift) << bits) | (blue >> shift)]]
+
+    def center(self, index):
+        """
+        @return: The (r, g, b) in the middle of a cell, in the input range
+        """
+        mask = (1 << self.bits) - 1
+        half = (1 << self._shift) >> 1
+        return tuple((((index >> (2 * self.bits - c * self.bits)) & mask) << self._shift) + half for c in range(3))
+
+    def fill_box(self, name, ranges):
+        """
+        Assigns a color to every cell overlapping a box of values, like stest.set_color_ranges
+        @param name: One of the labels
+        @param ranges: ((r_min, r_max), (g_min, g_max), (b_min, b_max)), inclusive, in the input range
+        """
+        label = self._label_index[name]
+        shift, bits, table = self._shift, self.bits, self.table
+        (r0, r1), (g0, g1), (b0, b1) = ranges
+        for r in range(r0 >> shift, (min(r1, self._max) >> shift) + 1):
+            for g in range(g0 >> shift, (min(g1, self._max) >> shift) + 1):
+                row = (r << (2 * bits)) | (g << bits)
+                for b in range(b0 >> shift, (min(b1, self._max) >> shift) + 1):
+                    table[row | b] = label
+
+    @classmethod
+    def from_ranges(cls, ranges=DEFAULT_RANGES, bits=5, in_bits=8, labels=COLOR_NAMES):
+        """
+        @param ranges: (name, box) pairs as taken by fill_box, the later ones overwriting the earlier ones where they
+        overlap
+        """
+        lut = cls(bits, in_bits, labels)
+        for name, box in ranges:
+            lut.fill_box(name, box)
+        return lut
+
+    def save(self, path):
+        """
+        Writes the table with its header, for load
+        """
+        header = [_HEADER.pack(MAGIC, VERSION, self.bits, self.in_bits, len(self.labels))]
+        for label in self.labels:
+            name = label.encode("utf-8")
+            header.append(struct.pack("<B", len(name)) + name)
+        header.append(_CHECKSUM.pack(zlib.crc32(self.table) & 0xffffffff))
+        with open(path, "wb") as f:
+            f.write(b"".join(header))
+            f.write(self.table)
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """
+        Maps a table written by save in memory (read only), the pages being loaded as the lookups touch them
+        @param verify: Whether to check the cells against the checksum of the header. It reads them all once, so the
+        robot leaves it off and the files are verified where they are made (see calibrate_color.py verify)
+        @raise ValueError: If the file is not a table of this version, is truncated or does not match its checksum
+        """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        table = None
+        try:
+            try:
+                magic, version, bits, in_bits, count = _HEADER.unpack_from(data, 0)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError("{} is not a version {} color table".format(path, VERSION))
+                offset = _HEADER.size
+                labels = []
+                for _ in range(count):
+                    length = data[offset]
+                    labels.append(data[offset + 1:offset + 1 + length].decode("utf-8"))
+                    offset += 1 + length
+                checksum = _CHECKSUM.unpack_from(data, offset)[0]
+                offset += _CHECKSUM.size
+            except (struct.error, IndexError):
+                raise ValueError("{} is truncated".format(path))
+            table = memoryview(data)[offset:]
+            if verify and zlib.crc32(table) & 0xffffffff != checksum:
+                raise ValueError("{} does not match its checksum".format(path))
+            return cls(bits, in_bits, labels, table)
+        except Exception:  # do not leave the file mapped
+            if table is not None:
+                table.release()
+            data.close()
+            raise
@@ -6,7 +6,10 @@ if DEBUG:
 import random
 from ev3dev2.motor import SpeedPercent
 from ev3dev2.sound import Sound
-import bluetooth, threading, time
+import bluetooth, os, threading, time
+from Subs_arch import CLOCK
+from sysfs import SysfsSensor
+from color_lut import ColorLUT
 
 
 SOUND_NO_BLOCK = Sound.PLAY_NO_WAIT_FOR_COMPLETE # sound option that doesn't block the program
@@ -27,7 +30,7 @@ def set_leds_color(leds, color):
 
 def feedback_leds_blocking(leds, color): # for generated code
     set_leds_color(leds, color)
-    time.sleep(0.5)
+    CLOCK.sleep(0.5)
     leds.reset()
 
 
@@ -64,6 +67,7 @@ class Motor():
     def __init__(self, motor, base_speed=BASE_SPEED):
         self.motor = motor
         self.base_speed = base_speed
+        self.stop_hooks = []  # called after every stop, e.g. CONTROLLER.preemption.motor_stopped
         # self.log_distance = 0
         # self.log_angle = 0
 
@@ -97,6 +101,8 @@ class Motor():
 
     def stop(self):
         self.motor.stop()
+        for hook in self.stop_hooks:
+            hook()
 
     def odometry_start(self):
         self.motor.odometry_start()
@@ -219,6 +225,10 @@ class BluetoothConnection():
         self.port = port
         self.debug = debug
         self.buffer = [""] # buffer for the data that is received
+        self.received = 0  # number of messages received so far
+        self.received_at = None  # when the last message was received (CLOCK.time())
+        self.handlers = {}  # tag -> procedure, for the control messages ("!<tag>,<payload>")
+        self._write_lock = threading.Lock()  # the readings and the control messages are sent from different threads
         
         self.startup()
 
@@ -259,8 +269,17 @@ class BluetoothConnection():
         Sends data to the other brick.
         @param data: The data to send
         """
-        self.sock_out.write(str(data) + "\n")
-        self.sock_out.flush()
+        with self._write_lock:
+            self.sock_out.write(str(data) + "\n")
+            self.sock_out.flush()
+
+    def on(self, tag, procedure):
+        """
+        Handles the control messages with the given tag in the listening thread instead of the data buffer
+        @param tag: e.g. "SYNC" for the "!SYNC,..." messages
+        @param procedure: Called with the payload of the message (what follows the first comma)
+        """
+        self.handlers[tag] = procedure
 
     def _read(self):
         """
@@ -278,16 +297,26 @@ class BluetoothConnection():
         """
         while True:
             data = self._read()
+            if data.startswith("!"):
+                tag, _, payload = data[1:].partition(",")
+                handler = self.handlers.get(tag)
+                if handler is not None:
+                    handler(payload)
+                continue
             self.buffer[0] = str(data)
+            self.received_at = CLOCK.time()
+            self.received += 1
             procedure(data)
     
     def start_listening(self, procedure):
         """
         Starts listening for data from the other brick, by opening a thread.
-        @param procedure: The procedure to call when data is received (that take the data as argument)
+        @param procedure: The procedure to call when data is received (that take the data as argument), e.g.
+        lambda data: CONTROLLER.notify() so an event driven Controller handles the new readings right away
         """
 
         listener = threading.Thread(target=self._listen, args=[procedure])
+        listener.daemon = True  # does not keep the program alive once the missions are done
         listener.start()
 
     def get_data(self):
@@ -308,56 +337,195 @@ class BluetoothConnection():
             self.server_sock.close()
 
 
+SENSOR_RETRIES = 3  # reads tried before falling back to the last good value
+SENSOR_TIMEOUT = 0.05  # seconds a read (waiting for the device lock included) may take
+
+
+class SensorAccess():
+    """
+    Access layer to the sensors shared by the threads of a brick: one lock per device, a bounded number of retries
+    within a timeout, and the last good value of the device (or a default) when it keeps failing, so a flaky sensor
+    can not stall the control loop. Failed reads and fallbacks are counted per device.
+
+    The timeout bounds the retries of the failed reads and the wait for the lock, not a read itself: Python can not
+    interrupt a read hanging in the driver, so its caller stays blocked until it returns (and it gets counted in slow),
+    while the other threads reading the device get the fallback after the timeout since the lock is still held.
+    """
+    def __init__(self, retries=SENSOR_RETRIES, timeout=SENSOR_TIMEOUT):
+        self.retries = retries
+        self.timeout = timeout
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.last_good = {}
+        self.failures = {}  # device -> reads that raised
+        self.fallbacks = {}  # device -> times the last good value (or the default) got returned instead of a read
+        self.slow = {}  # device -> successful reads that returned after the timeout
+
+    def lock(self, device):
+        """
+        @return: The lock of the device, created the first time
+        """
+        lock = self._locks.get(device)
+        if lock is None:
+            with self._locks_lock:
+                lock = self._locks.setdefault(device, threading.Lock())
+        return lock
+
+    def read(self, device, read, default=None, name="Sensor"):
+        """
+        @param device: The sensor (ev3dev2 object or SysfsSensor)
+        @param read: Function reading the device, given the device
+        @param default: Value to return if the device failed before ever being read successfully
+        @param name: For the debug log
+        @return: The value read, or the fallback
+        """
+        deadline = time.monotonic() + self.timeout
+        lock = self.lock(device)
+        if lock.acquire(timeout=self.timeout):
+            try:
+                for _ in range(self.retries):
+                    try:
+                        value = read(device)
+                    except Exception:
+                        self.failures[device] = self.failures.get(device, 0) + 1
+                        if DEBUG:
+                            timedlog(name + " wrong read")
+                        if time.monotonic() > deadline:
+                            break
+                        continue
+                    if time.monotonic() > deadline:
+                        self.slow[device] = self.slow.get(device, 0) + 1
+                    self.last_good[device] = value
+                    return value
+            finally:
+                lock.release()
+        self.fallbacks[device] = self.fallbacks.get(device, 0) + 1
+        return self.last_good.get(device, default)
+
+    def stats(self):
+        """
+        @return: {device name: {"failures", "fallbacks", "slow"}} of the devices that failed or were slow at least once
+        """
+        devices = set(self.failures) | set(self.fallbacks) | set(self.slow)
+        return {str(device): {"failures": self.failures.get(device, 0), "fallbacks": self.fallbacks.get(device, 0),
+                              "slow": self.slow.get(device, 0)}
+                for device in devices}
+
+
+SENSORS = SensorAccess()
+
+
+def _color(cs):
+    return int2color(cs.color)
+
+def _rgb(cs, lut):
+    red, green, blue = cs.rgb
+    return lut.classify(red, green, blue)
+
+def _distance(ultrasonic_sensor):
+    return ultrasonic_sensor.value()
+
+def _pressed(touch_sensor):
+    return touch_sensor.is_pressed
+
+def _color_fast(reader):
+    return int2color(reader.read())
+
+def _rgb_fast(reader, lut):
+    return lut.classify(reader.read(0), reader.read(1), reader.read(2))
+
+def _distance_fast(reader):
+    return reader.read()
+
+
 def read_color_sensor(cs):  
     """
     Reads the color sensor and returns the color that was read.
     @param color_sensor: The color sensor to read
-    @return: The color that was read
+    @return: The color that was read (the last good one, or None, if the sensor keeps failing)
     """
-    lock = threading.Lock()
+    return SENSORS.read(cs, _color, None, "Color sensor")
+
+# written by calibrate_color.py, looked for next to the program rather than in the directory it is started from
+COLOR_LUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "color_lut.bin")
+# the same for the RGB-RAW values of the fast path (calibrate_color.py record --mode RGB-RAW, fit --in-bits 10)
+COLOR_LUT_RAW_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "color_lut_raw.bin")
 
-    with lock:
-        try:
-            color = cs.color
-        except: 
-            if DEBUG:
-                timedlog("Color sensor wrong read")
-            return read_color_sensor(cs)
-        return int2color(color)
+def load_color_lut(path=COLOR_LUT_FILE, in_bits=8):
+    """
+    Maps the table calibrated for the arena, see calibrate_color.py
+    @param in_bits: The input range the table must be built for, 8 for ColorSensor.rgb
+    @return: The color_lut.ColorLUT, or one built from the default ranges if the file is missing or not usable
+    """
+    try:
+        lut = ColorLUT.load(path)
+        if lut.in_bits != in_bits:
+            raise ValueError(path + " is not built for {} bits values".format(in_bits))
+        return lut
+    except (IOError, OSError, ValueError) as e:
+        if DEBUG:
+            timedlog("No calibrated color table ({}), using the default ranges".format(e))
+        return ColorLUT.from_ranges(in_bits=in_bits)
+
+COLOR_LUT = load_color_lut()  # on ColorSensor.rgb values
+
+def read_color_sensor_rgb(cs, lut=COLOR_LUT):
+    """
+    Reads the color sensor in RGB mode and classifies the values with a lookup table instead of the sensor's own color
+    detection.
+    @param cs: The color sensor to read
+    @param lut: The color_lut.ColorLUT to classify with, built for 0-255 values
+    @return: The color that was read (the last good one, or None, if the sensor keeps failing)
+    """
+    return SENSORS.read(cs, lambda device: _rgb(device, lut), None, "Color sensor")
 
 def read_ultrasonic_sensor(ultrasonic_sensor):
     """
     Reads the ultrasonic sensor and returns the distance.
     @param color_sensor: The ultrasonic sensor to read
-    @return: The distance that was read
+    @return: The distance that was read (the last good one, or 1000, if the sensor keeps failing)
     """
-    lock = threading.Lock()
-    
-    with lock:
-        try:
-            distance = ultrasonic_sensor.value()
-        except: 
-            if DEBUG:
-                timedlog("Ultrasonic sensor wrong read")
-            return read_ultrasonic_sensor(ultrasonic_sensor)
-        return distance
+    return SENSORS.read(ultrasonic_sensor, _distance, 1000, "Ultrasonic sensor")
+
+def open_sysfs_sensor(sensor, mode=None, values=1):
+    """
+    Opens the fast path to the values of an ev3dev2 sensor, for read_color_sensor_fast, read_color_sensor_rgb_fast and
+    read_ultrasonic_sensor_fast
+    @param sensor: The ev3dev2 sensor
+    @param mode: The mode to put the sensor in first (the fast path does not switch modes by itself), e.g. "COL-COLOR"
+    @param values: How many values to read, 3 for "RGB-RAW"
+    @return: The SysfsSensor
+    """
+    if mode is not None:
+        sensor.mode = mode
+    return SysfsSensor(sensor._path, values)
+
+def read_color_sensor_fast(reader):
+    """
+    Same as read_color_sensor, for a SysfsSensor opened on a color sensor in COL-COLOR mode
+    """
+    return SENSORS.read(reader, _color_fast, None, "Color sensor")
+
+def read_color_sensor_rgb_fast(reader, lut):
+    """
+    Same as read_color_sensor_rgb, for a SysfsSensor opened with values=3 on a color sensor in RGB-RAW mode, so lut must
+    be built with in_bits=10
+    """
+    return SENSORS.read(reader, lambda device: _rgb_fast(device, lut), None, "Color sensor")
+
+def read_ultrasonic_sensor_fast(reader):
+    """
+    Same as read_ultrasonic_sensor, for a SysfsSensor opened on an ultrasonic sensor
+    """
+    return SENSORS.read(reader, _distance_fast, 1000, "Ultrasonic sensor")
 
 def read_touch_sensor(touch_sensor):
     """
     Reads the touch sensor and returns the distance.
     @param color_sensor: The touch sensor to read
-    @return: The touch that was read
+    @return: The touch that was read (the last good one, or False, if the sensor keeps failing)
     """
-    lock = threading.Lock()
-    
-    with lock:
-        try:
-            touch = touch_sensor.is_pressed
-        except: 
-            if DEBUG:
-                timedlog("Touch sensor wrong read")
-            return read_touch_sensor(touch_sensor)
-        return touch
+    return SENSORS.read(touch_sensor, _pressed, False, "Touch sensor")
 
 
 def set_global_MEASURE_OBJ(value):
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming filters for the sensor values, applied to every sample before it is published in the readings, so a single
+mis-read does not fire a whole maneuver. Each filter takes a raw sample and returns the filtered value in O(1), on
+buffers allocated once, and they can be chained (FilterChain):
+
+    MajorityFilter: the value most of the last n samples agree on (color sensors)
+    HysteresisFilter: a value only crosses a threshold once it is past it by a margin (ultrasonic sensors)
+    DwellFilter: a new value only gets through after it held for a minimum time
+
+Every filter counts the spurious activations it prevented: the excursions of the raw samples away from the filtered
+value that ended without the filtered value ever following them.
+
+Kept free of ev3dev2 imports so it can be used by the sensor process and the benchmarks off the brick.
+"""
+from Subs_arch import CLOCK
+
+
+class Filter():
+    """
+    Base class of the filters: keeps the filtered value and counts the prevented activations. Subclasses implement
+    _filter(sample), returning the new filtered value, and may override _state(value), what the behaviors act on (the
+    value itself by default)
+    """
+
+    def __init__(self, initial=None):
+        """
+        @param initial: The filtered value before the first sample
+        """
+        self.value = initial
+        self.prevented = 0
+        self._excursion = False
+
+    def __call__(self, sample):
+        """
+        @param sample: The raw sample
+        @return: The filtered value
+        """
+        state = self._state
+        previous = state(self.value)
+        value = self._filter(sample)
+        self.value = value
+        current = state(value)
+        if current != previous:
+            self._excursion = False  # followed, late or not
+        elif state(sample) != current:
+            self._excursion = True
+        elif self._excursion:  # back to the filtered value without it ever moving
+            self._excursion = False
+            self.prevented += 1
+        return value
+
+    def _filter(self, sample):
+        raise NotImplementedError
+
+    def _state(self, value):
+        return value
+
+
+class MajorityFilter(Filter):
+    """
+    Outputs a value once more than half of the last n samples have it, and keeps the previous output otherwise
+    """
+
+    def __init__(self, n=3, initial=None):
+        Filter.__init__(self, initial)
+        self.n = n
+        self._window = [initial] * n  # ring buffer of the last n samples
+        self._counts = {initial: n}
+        self._next = 0
+
+    def _filter(self, sample):
+        counts, window, i = self._counts, self._window, self._next
+        old = window[i]
+        counts[old] -= 1
+        window[i] = sample
+        counts[sample] = counts.get(sample, 0) + 1
+        self._next = i + 1 if i + 1 < self.n else 0
+        if counts[sample] * 2 > self.n:
+            return sample
+        return self.value
+
+
+class HysteresisFilter(Filter):
+    """
+    Lets the samples through, except when they cross one of the thresholds by less than the margin: the previous output
+    is kept then, so a behavior comparing the readings to the same thresholds does not flicker around them
+    """
+
+    def __init__(self, thresholds, margin, initial=None):
+        """
+        @param thresholds: The values the behaviors compare the reading to, e.g. (120, 400) for the cliff
+        @param margin: How far past a threshold a sample must be to cross it
+        """
+        Filter.__init__(self, initial)
+        self.thresholds = tuple(sorted(thresholds))
+        self.margin = margin
+        self._region = self._region_of(initial)
+
+    def _region_of(self, sample):
+        if sample is None:
+            return None
+        region = 0
+        for threshold in self.thresholds:
+            if sample <= threshold:
+                break
+            region += 1
+        return region
+
+    def _filter(self, sample):
+        if sample is None:
+            return self.value
+        region = self._region_of(sample)
+        if self._region is None or region == self._region:
+            self._region = region
+            return sample
+        thresholds = self.thresholds
+        if region > self._region:
+            crossed = sample - thresholds[region - 1] >= self.margin
+        else:
+            crossed = thresholds[region] - sample >= self.margin
+        if crossed:
+            self._region = region
+            return sample
+        return self.value
+
+    def _state(self, value):
+        return self._region_of(value)
+
+
+class DwellFilter(Filter):
+    """
+    Outputs a new value only after the samples kept it for dwell seconds
+    """
+
+    def __init__(self, dwell, initial=None, clock=CLOCK):
+        """
+        @param dwell: Minimum time, in seconds
+        @param clock: The clock the time is measured with
+        """
+        Filter.__init__(self, initial)
+        self.dwell = dwell
+        self.clock = clock
+        self._candidate = initial
+        self._since = None
+
+    def _filter(self, sample):
+        if sample == self.value:
+            self._candidate = sample
+            return sample
+        now = self.clock.time()
+        if sample != self._candidate or self._since is None:
+            self._candidate, self._since = sample, now
+        if now - self._since >= self.dwell:
+            return sample
+        return self.value
+
+
+class FilterChain():
+    """
+    Applies filters one after the other. Counts as prevented what any of them prevented
+    """
+
+    def __init__(self, *filters):
+        self.filters = filters
+        self.value = filters[-1].value
+
+    def __call__(self, sample):
+        value = sample
+        for stage in self.filters:
+            value = stage(value)
+        self.value = value
+        return value
+
+    @property
+    def prevented(self):
+        return sum(stage.prevented for stage in self.filters)
+
+
+def apply_filters(filters, values):
+    """
+    Filters the readings that have a filter, in place
+    @param filters: {key: filter}
+    @param values: {key: raw value}, e.g. what the sensors just returned
+    @return: values
+    """
+    for key in values:
+        stage = filters.get(key)
+        if stage is not None:
+            values[key] = stage(values[key])
+    return values
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+History of the last samples of every reading, for the triggers that look at a trend instead of the current value
+("mean distance over 200 ms", "red seen in 3 of the last 5 samples", "rate of change"). Every reading keeps its samples
+and their acquisition times in fixed size ring buffers allocated once, so recording a sample does not allocate, and
+the queries run over the buffers with the C loops of bytearray.count and sum instead of per sample Python code.
+
+Kept free of ev3dev2 imports so it can be used by the sensor process and the benchmarks off the brick.
+"""
+from array import array
+
+from Subs_arch import CLOCK
+
+
+class ReadingHistory():
+    """
+    Ring buffer of the last samples of one reading. Numeric readings (distances) are kept as doubles, the others
+    (colors, touch) as the index of their value in a table of the values seen so far
+    """
+
+    def __init__(self, size=64, numeric=True, clock=CLOCK):
+        """
+        @param size: Number of samples kept
+        @param numeric: Whether the values are numbers (mean and rate make sense) or labels (only counts do)
+        @param clock: The clock the samples are timestamped with when no time is given
+        """
+        self.size = size
+        self.numeric = numeric
+        self.clock = clock
+        self.times = array("d", [0.0]) * size
+        if numeric:
+            self.values = array("d", [0.0]) * size
+            self._view = memoryview(self.values)
+        else:
+            self.values = bytearray(size)
+            self.labels = [None]
+            self._codes = {None: 0}
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def push(self, value, stamp=None):
+        """
+        Records a sample
+        @param value: The sample
+        @param stamp: When it was acquired, now by default
+        @return: value
+        """
+        i = self.count % self.size
+        self.times[i] = self.clock.time() if stamp is None else stamp
+        if self.numeric:
+            self.values[i] = value
+        else:
+            code = self._codes.get(value)
+            if code is None:  # a value never seen before, only happens a few times per run
+                code = self._codes[value] = len(self.labels)
+                self.labels.append(value)
+            self.values[i] = code
+        self.count += 1  # last, so a reader never sees a sample before its value
+        return value
+
+    def latest(self):
+        """
+        @return: The last sample, or None if there is none
+        """
+        if self.count == 0:
+            return None
+        value = self.values[(self.count - 1) % self.size]
+        return value if self.numeric else self.labels[value]
+
+    def _ranges(self, n):
+        """
+        @return: The (start, end) slices of the buffers holding the last n samples, oldest first
+        """
+        end = self.count % self.size
+        start = end - n
+        if start >= 0:
+            return ((start, end),)
+        return ((start + self.size, self.size), (0, end))
+
+    def _within(self, window, now):
+        """
+        @return: How many of the last samples were acquired in the last window seconds (binary search on the times)
+        """
+        count, size, times = self.count, self.size, self.times
+        available = min(count, size)
+        oldest = now - window
+        low, high = 0, available  # number of samples, counted from the newest, known to be in / out of the window
+        while low < high:
+            middle = (low + high + 1) // 2
+            if times[(count - middle) % size] >= oldest:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def count_of(self, value, n):
+        """
+        Labeled readings only, a numeric one compares its samples with a threshold instead (e.g. mean())
+        @return: In how many of the last n samples the reading had the given value
+        """
+        if self.numeric:
+            raise ValueError("count_of needs a labeled history")
+        n = min(n, len(self))
+        code = self._codes.get(value)
+        if code is None:
+            return 0
+        return sum(self.values.count(code, start, end) for start, end in self._ranges(n))
+
+    def k_of_n(self, value, k, n):
+        """
+        Labeled readings only, see count_of()
+        @return: Whether at least k of the last n samples had the given value
+        """
+        return self.count_of(value, n) >= k
+
+    def mean(self, window, default=None, now=None):
+        """
+        @param window: Seconds back from now
+        @param default: What to return when no sample was acquired in the window
+        @return: The mean of the numeric samples acquired in the window
+        """
+        n = self._within(window, self.clock.time() if now is None else now)
+        if n == 0:
+            return default
+        return sum(sum(self._view[start:end]) for start, end in self._ranges(n)) / n
+
+    def rate(self, window, now=None):
+        """
+        @param window: Seconds back from now
+        @return: The change of the numeric reading per second between the oldest and the newest sample of the window,
+        or None if there are less than two
+        """
+        n = self._within(window, self.clock.time() if now is None else now)
+        if n < 2:
+            return None
+        size, count = self.size, self.count
+        first, last = (count - n) % size, (count - 1) % size
+        elapsed = self.times[last] - self.times[first]
+        if elapsed <= 0:
+            return None
+        return (self.values[last] - self.values[first]) / elapsed
+
+
+class SensorHistory(dict):
+    """
+    {key: ReadingHistory} of the readings of a brick
+    """
+
+    def __init__(self, numeric=(), labeled=(), size=64, clock=CLOCK):
+        """
+        @param numeric: Keys of the numeric readings, e.g. ("US_F", "US_B")
+        @param labeled: Keys of the other readings, e.g. ("CS_L", "CS_M", "CS_R", "TS_L", "TS_R", "TS_B")
+        @param size: Samples kept per reading
+        """
+        dict.__init__(self)
+        for key in numeric:
+            self[key] = ReadingHistory(size, True, clock)
+        for key in labeled:
+            self[key] = ReadingHistory(size, False, clock)
+
+    def record(self, values, stamp=None):
+        """
+        Records a sample of every given reading that has a history
+        @param values: {key: value}
+        @param stamp: When they were acquired, now by default
+        @return: values
+        """
+        for key, value in values.items():
+            history = self.get(key)
+            if history is not None:
+                history.push(value, stamp)
+        return values
@@ -8,7 +8,7 @@ if DEBUG:
     from ev3devlogging import timedlog
 
 
-CONTROLLER = Controller(return_when_no_action=True)
+CONTROLLER = Controller(return_when_no_action=True, event_driven=True, readings=READINGS_DICT)
 
 
 master_mac = '00:17:E9:B4:CE:E6'
@@ -32,7 +32,9 @@ if DEBUG:
 ##### GENERATED CODE GOES HERE #####
 
 # controller.add(UpdateSlaveReadings(bluetooth_connection, readings_dict))
-CONTROLLER.add(UpdateReadings())
+SENSOR_SERVICE = start_sensor_service(notify=CONTROLLER.notify, rgb=True)  # pings=True with start_ping_scheduler()
+CONTROLLER.add(UpdateReadings(SENSOR_SERVICE))
+CONTROLLER.add(make_stale_guard())
 CONTROLLER.add(CliffAvoidanceBhv())
 CONTROLLER.add(EdgeAvoidanceBhv())
 CONTROLLER.add(LakeAvoidanceBhv())
@@ -46,7 +48,8 @@ CONTROLLER.add(RunningBhv())
 ##### GENERATED CODE GOES HERE #####
 
 
-# bluetooth_connection.start_listening(lambda data: ())
+# bluetooth_connection.start_listening(lambda data: CONTROLLER.notify())
+# start_ping_scheduler(SENSOR_SERVICE)
 CONTROLLER.start()
 
 S.speak("stop")
\ No newline at end of file
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Time slots for the ultrasonic sensors of both bricks, so they never ping at the same time and hear each other's echoes
+(the bogus cliff readings of US_B). The sensors run in single shot mode (every write of the mode sends one ping) and
+each one only pings in its own slots of a schedule shared by the bricks.
+
+The master negotiates the schedule over the bluetooth link:
+    1. a few clock sync rounds: the master sends "!SYNC,<master time>", the slave answers "!SYNC,<master time>,<slave
+       time>" right away, and the round trip with the smallest delay gives the offset between the two clocks;
+    2. the master sends "!PINGS,<start>,<slot>,<owners>", start being given on the clock of the slave, and both bricks
+       run the same schedule from there;
+    3. the clocks of the bricks drift apart (by tens of ppm), so every RESYNC_PERIOD the master syncs them again and
+       sends the same schedule with the new offset.
+
+Kept free of ev3dev2 imports so the schedules can be built and checked off the brick.
+"""
+import threading
+
+from Subs_arch import CLOCK
+
+SINGLE_SHOT_MODE = "US-SI-CM"  # every write of this mode makes the sensor ping once
+SLOT_MIN = 0.03  # seconds a ping needs: echo from up to 2.5 m and measurement by the sensor
+SETTLE = 0.8  # part of the slot waited for before reading the value of a ping
+LEAD_TIME = 0.5  # seconds between the negotiation and the start of the schedule
+RESYNC_PERIOD = 10.0  # seconds between two clock syncs, far below the drift that would eat the margin of a slot
+
+
+def make_schedule(rates, slot_min=SLOT_MIN):
+    """
+    Spreads the pings of the sensors over a frame of one second, every sensor getting as many slots as its rate and its
+    slots being as evenly spaced as possible (smooth weighted round robin)
+    @param rates: {sensor: pings per second}, e.g. {"US_B": 10, "US_F": 10}
+    @param slot_min: Shortest slot the sensors can work with
+    @return: (slot duration, [owner of every slot of the frame])
+    @raise ValueError: If a rate is not a whole number of pings, or the rates do not fit in a second with slots of
+    slot_min
+    """
+    for sensor, rate in rates.items():
+        if rate < 0 or rate != int(rate):
+            raise ValueError("The rate of {} must be a whole number of pings per second, not {}".format(sensor, rate))
+    rates = {sensor: int(rate) for sensor, rate in rates.items()}
+    total = sum(rates.values())
+    if total <= 0:
+        raise ValueError("No pings to schedule")
+    slot = 1.0 / total
+    if slot < slot_min:
+        raise ValueError("{} pings per second do not fit in slots of {} s".format(total, slot_min))
+    credits = dict.fromkeys(rates, 0)
+    owners = []
+    for _ in range(total):
+        for sensor, rate in rates.items():
+            credits[sensor] += rate
+        owner = max(sorted(credits), key=lambda sensor: credits[sensor])
+        credits[owner] -= total
+        owners.append(owner)
+    return slot, owners
+
+
+def encode_schedule(start, slot, owners):
+    """
+    @return: The payload of a "!PINGS" message
+    """
+    return "{!r},{!r},{}".format(start, slot, ";".join(owners))
+
+
+def decode_schedule(payload):
+    """
+    @return: (start, slot, owners) of the payload of a "!PINGS" message
+    """
+    start, slot, owners = payload.split(",", 2)
+    return float(start), float(slot), owners.split(";")
+
+
+class PingScheduler():
+    """
+    Runs the schedule for the sensors of this brick: in each of their slots it triggers a ping, waits for the echo and
+    publishes the value. The slots of the other brick are left silent
+    """
+
+    def __init__(self, sensors, publish, clock=CLOCK):
+        """
+        @param sensors: {key: (trigger, read)} of the ultrasonic sensors of this brick, trigger sending one ping (e.g.
+        writing SINGLE_SHOT_MODE to the mode) and read returning its value
+        @param publish: Called with (key, value) after every ping, e.g. SensorService.publish
+        @param clock: The clock the schedule start is given on
+        """
+        self.sensors = sensors
+        self.publish = publish
+        self.clock = clock
+        self.schedule = None  # (start, slot, owners), replaced as a whole
+        self.pings = dict.fromkeys(sensors, 0)
+        self.late = 0  # slots of this brick skipped because the previous ping ended too late
+        self.latest = dict.fromkeys(sensors)
+        self._changed = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def set_schedule(self, start, slot, owners):
+        """
+        @param start: When the first frame starts, on the clock of this brick
+        @param slot: Duration of a slot, in seconds
+        @param owners: Sensor of every slot of the frame
+        """
+        self.schedule = (start, slot, tuple(owners))
+        self._changed.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(name="Ping scheduler", target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._changed.set()
+
+    def _next_slot(self, schedule, now):
+        """
+        @return: (slot start, owner) of the next slot of a sensor of this brick starting at now or later
+        """
+        start, slot, owners = schedule
+        index = max(0, int((now - start) / slot))
+        if start + index * slot < now:
+            index += 1
+        for i in range(index, index + len(owners)):
+            if owners[i % len(owners)] in self.sensors:
+                return start + i * slot, owners[i % len(owners)]
+        return None, None
+
+    def _run(self):
+        clock = self.clock
+        while self._running:
+            schedule = self.schedule
+            if schedule is None:
+                self._changed.wait()
+                self._changed.clear()
+                continue
+            at, key = self._next_slot(schedule, clock.time())
+            if key is None:  # no slot for this brick
+                self._changed.wait()
+                self._changed.clear()
+                continue
+            wait = at - clock.time()
+            if wait > 0 and self._changed.wait(wait):  # new schedule meanwhile
+                self._changed.clear()
+                continue
+            if clock.time() - at > schedule[1] * (1 - SETTLE):  # too late to get the echo within the slot
+                self.late += 1
+                continue
+            trigger, read = self.sensors[key]
+            trigger()
+            clock.sleep(max(0.0, at + schedule[1] * SETTLE - clock.time()))
+            value = read()
+            self.pings[key] += 1
+            self.latest[key] = value
+            self.publish(key, value)
+
+    def stats(self):
+        """
+        @return: {"pings": {key: pings so far}, "late": slots missed, "rates": {key: scheduled pings per second}}
+        """
+        rates = {}
+        if self.schedule is not None:
+            start, slot, owners = self.schedule
+            frame = slot * len(owners)
+            rates = {key: owners.count(key) / frame for key in self.sensors}
+        return {"pings": dict(self.pings), "late": self.late, "rates": rates}
+
+
+class ClockSync():
+    """
+    Master side of the clock sync rounds: estimates the offset between the clock of the slave and the one of this
+    brick, keeping the round trip with the smallest delay
+    """
+
+    def __init__(self, clock=CLOCK):
+        self.clock = clock
+        self.offset = None  # slave clock - master clock
+        self.delay = None  # round trip of the best sample
+        self.replies = 0
+        self._replied = threading.Event()
+
+    def request(self):
+        """
+        @return: The "!SYNC" message to send to the slave
+        """
+        self._replied.clear()
+        return "!SYNC,{!r}".format(self.clock.time())
+
+    def handle_reply(self, payload):
+        """
+        Handles the answer of the slave: "<master time>,<slave time>"
+        """
+        now = self.clock.time()
+        sent, remote = (float(v) for v in payload.split(","))
+        delay = now - sent
+        if self.delay is None or delay < self.delay:
+            self.delay = delay
+            self.offset = remote - (sent + delay / 2)  # the slave read its clock half way through the round trip
+        self.replies += 1
+        self._replied.set()
+
+    def wait(self, timeout):
+        return self._replied.wait(timeout)
+
+    def reset(self):
+        """
+        Forgets the samples, before syncing again
+        """
+        self.offset = None
+        self.delay = None
+
+
+def _sync_clocks(connection, sync, rounds, timeout):
+    for _ in range(rounds):
+        connection.write(sync.request())
+        sync.wait(timeout)
+
+
+def _resync(connection, scheduler, sync, period, rounds, timeout):
+    """
+    Master side, in its own thread: syncs the clocks again every period and sends the schedule with the new offset,
+    until the scheduler stops. A failed sync keeps the previous offset
+    """
+    clock = sync.clock
+    while scheduler._running:
+        clock.sleep(period)
+        previous = (sync.offset, sync.delay)
+        sync.reset()
+        _sync_clocks(connection, sync, rounds, timeout)
+        if sync.offset is None:
+            sync.offset, sync.delay = previous
+            continue
+        start, slot, owners = scheduler.schedule
+        connection.write("!PINGS," + encode_schedule(start + sync.offset, slot, owners))
+
+
+def negotiate_pings(connection, scheduler, rates, rounds=5, timeout=1.0, resync=RESYNC_PERIOD, clock=CLOCK):
+    """
+    Master side: syncs the clocks with the slave, builds the schedule and sends it, then runs it for the sensors of this
+    brick and keeps the clocks in sync while the scheduler runs. The connection must be listening already
+    @param connection: The commons.BluetoothConnection to the slave
+    @param scheduler: The PingScheduler of this brick
+    @param rates: {sensor: pings per second} of the sensors of both bricks
+    @param rounds: Clock sync round trips
+    @param timeout: Seconds to wait for each answer
+    @param resync: Seconds between two clock syncs once the schedule runs, None to sync only once
+    @return: The ClockSync (offset and delay of the best round of the last sync)
+    @raise IOError: If the slave never answered
+    """
+    sync = ClockSync(clock)
+    connection.on("SYNC", sync.handle_reply)
+    _sync_clocks(connection, sync, rounds, timeout)
+    if sync.offset is None:
+        raise IOError("The slave did not answer the clock sync")
+    slot, owners = make_schedule(rates)
+    start = clock.time() + LEAD_TIME
+    connection.write("!PINGS," + encode_schedule(start + sync.offset, slot, owners))
+    scheduler.set_schedule(start, slot, owners)
+    if resync:
+        thread = threading.Thread(name="Ping resync", target=_resync,
+                                  args=(connection, scheduler, sync, resync, rounds, timeout))
+        thread.daemon = True
+        thread.start()
+    return sync
+
+
+def serve_pings(connection, scheduler, clock=CLOCK):
+    """
+    Slave side: answers the clock sync rounds of the master and runs the schedules it sends. Call it before the
+    connection starts listening
+    @param connection: The commons.BluetoothConnection to the master
+    @param scheduler: The PingScheduler of this brick
+    """
+    connection.on("SYNC", lambda payload: connection.write("!SYNC,{},{!r}".format(payload, clock.time())))
+    connection.on("PINGS", lambda payload: scheduler.set_schedule(*decode_schedule(payload)))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Shared sensor readings of a brick. Kept free of ev3dev2 imports so the controller and its benchmarks can use it off the
+brick too.
+"""
+from Subs_arch import CLOCK
+
+
+class Readings(dict):
+    """
+    Drop-in replacement for the plain READINGS_DICT. Keeps a version counter per key that is bumped every time the value
+    of that key changes, plus a global version bumped on every change, so the Controller can skip the checks of the
+    behaviors whose inputs did not change since their last evaluation.
+
+    It also keeps when every reading was last acquired (on the clock of the behaviors, monotonic), so the Controller can
+    tell stale readings apart (see Behavior.max_age), and the gaps between acquisitions of every reading.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.versions = dict.fromkeys(self, 0)
+        self.version = 0
+        self.clock = CLOCK
+        self.stamps = dict.fromkeys(self)  # key -> acquisition time of its value, None if never acquired
+        self._gaps = {}  # key -> [acquisitions, sum of the gaps, longest gap]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, stamp=None):
+        """
+        Stores a freshly acquired value
+        @param stamp: When it was acquired, now by default
+        """
+        if stamp is None:
+            stamp = self.clock.time()
+        previous = self.stamps.get(key)
+        if previous is not None and stamp > previous:
+            gaps = self._gaps.get(key)
+            if gaps is None:
+                gaps = self._gaps[key] = [0, 0.0, 0.0]
+            gap = stamp - previous
+            gaps[0] += 1
+            gaps[1] += gap
+            if gap > gaps[2]:
+                gaps[2] = gap
+        self.stamps[key] = stamp
+        if key not in self or dict.__getitem__(self, key) != value:
+            dict.__setitem__(self, key, value)
+            self.touch(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def touch(self, key):
+        """
+        Marks a reading as changed even if its value is the same, so the behaviors depending on it get checked again
+        @param key: The reading to mark
+        """
+        self.versions[key] = self.versions.get(key, 0) + 1
+        self.version += 1
+
+    def stamp(self, keys):
+        """
+        @param keys: The readings to look at
+        @return: A number that changes whenever one of the given readings changes
+        """
+        versions = self.versions
+        return sum([versions.get(key, 0) for key in keys])
+
+    def age(self, keys, now=None):
+        """
+        @param keys: The readings to look at
+        @param now: The current time, read from the clock by default
+        @return: Seconds since the oldest of the given readings was acquired, infinite if one never was
+        """
+        if now is None:
+            now = self.clock.time()
+        stamps = self.stamps
+        oldest = now
+        for key in keys:
+            stamp = stamps.get(key)
+            if stamp is None:
+                return float("inf")
+            if stamp < oldest:
+                oldest = stamp
+        return now - oldest
+
+    def age_report(self):
+        """
+        @return: {key: {"age", "gaps", "mean_gap", "max_gap"}}, age being None for the readings never acquired and the
+        gaps the times between two acquisitions
+        """
+        now = self.clock.time()
+        report = {}
+        for key in self:
+            stamp = self.stamps.get(key)
+            count, total, longest = self._gaps.get(key, (0, 0.0, 0.0))
+            report[key] = {"age": None if stamp is None else now - stamp, "gaps": count,
+                           "mean_gap": total / count if count else None, "max_gap": longest}
+        return report
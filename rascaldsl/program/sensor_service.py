@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Background polling of the sensors of a brick: every sensor gets its own thread reading it at its own rate, and the
+values are published in a double buffered snapshot, so the checks of the behaviors only read memory instead of waiting
+for the sysfs reads.
+
+Kept free of ev3dev2 imports, the read functions are given by the caller (e.g. commons.read_color_sensor).
+"""
+import threading
+import time
+
+from Subs_arch import CLOCK
+
+
+class SensorService():
+    """
+    Latest value of every polled sensor, in two preallocated dicts: a publish writes the back one and then flips the
+    generation, so readers always see a complete snapshot. A reader checks the generation did not move while it copied
+    (the writer only touches the buffer a reader may be copying two flips later) and copies again if it did.
+    """
+
+    def __init__(self, keys, history=None):
+        """
+        @param keys: Names of the polled readings, e.g. ("CS_L", "CS_M", "CS_R", "US_B")
+        @param history: The history.SensorHistory every published value is also recorded in, if any
+        """
+        self.keys = tuple(keys)
+        self.history = history
+        self._buffers = (dict.fromkeys(self.keys), dict.fromkeys(self.keys))
+        self._stamps = (dict.fromkeys(self.keys), dict.fromkeys(self.keys))  # acquisition times, flipped with the values
+        self.generation = 0
+        self._write_lock = threading.Lock()  # one publish at a time, the pollers run in parallel
+        self._unread = dict.fromkeys(self.keys, False)
+        self._last_generation = 0  # reader side, generation of the last refresh
+        self.pollers = []
+        self.published = dict.fromkeys(self.keys, 0)
+        self.dropped = dict.fromkeys(self.keys, 0)  # values overwritten before any refresh read them
+        self.retries = 0
+        self.listeners = []  # called after every publish, e.g. CONTROLLER.notify for an event driven Controller
+
+    def publish(self, key, value, stamp=None):
+        """
+        Writer side: stores a new value of one reading
+        @param stamp: When it was acquired (CLOCK.time()), now by default
+        """
+        if stamp is None:
+            stamp = CLOCK.time()
+        with self._write_lock:
+            generation = self.generation
+            back = self._buffers[(generation + 1) & 1]
+            back.update(self._buffers[generation & 1])
+            back[key] = value
+            stamps = self._stamps[(generation + 1) & 1]
+            stamps.update(self._stamps[generation & 1])
+            stamps[key] = stamp
+            self.generation = generation + 1
+            self.published[key] += 1
+            if self._unread[key]:
+                self.dropped[key] += 1
+            self._unread[key] = True
+            if self.history is not None:
+                self.history[key].push(value, stamp)
+        for listener in self.listeners:
+            listener()
+
+    def snapshot(self):
+        """
+        Reader side
+        @return: A consistent copy of the last values, as a new dict
+        """
+        while True:
+            generation = self.generation
+            values = dict(self._buffers[generation & 1])
+            if self.generation == generation:
+                return values
+            self.retries += 1
+
+    def refresh(self, readings):
+        """
+        Reader side: copies the last values into readings (a Readings only bumps the versions of the values that changed,
+        and gets their acquisition times)
+        @param readings: The dict to update, e.g. READINGS_DICT
+        @return: Whether something new got published since the last refresh
+        """
+        if self.generation == self._last_generation:
+            return False
+        while True:  # copy first, a copy is only stored once the generation proved it is not torn
+            generation = self.generation
+            values = dict(self._buffers[generation & 1])
+            stamps = dict(self._stamps[generation & 1])
+            if self.generation == generation:
+                break
+            self.retries += 1
+        store = getattr(readings, "set", None)
+        if store is not None:
+            for key in self.keys:
+                if stamps[key] is not None:
+                    store(key, values[key], stamps[key])
+        else:
+            for key in self.keys:
+                readings[key] = values[key]
+        self._last_generation = generation
+        unread = self._unread
+        for key in self.keys:
+            unread[key] = False
+        return True
+
+    def add(self, key, read, rate, filter=None):
+        """
+        Polls a sensor in its own thread
+        @param key: The reading to publish the values as
+        @param read: Function returning the value of the sensor, e.g. lambda: read_color_sensor(CS_L)
+        @param rate: Polls per second
+        @param filter: Called on every value before it is published, e.g. a filters.MajorityFilter
+        @return: The SensorPoller
+        """
+        poller = SensorPoller(self, key, read, rate, filter)
+        self.pollers.append(poller)
+        return poller
+
+    def start(self):
+        for poller in self.pollers:
+            poller.start()
+
+    def stop(self):
+        for poller in self.pollers:
+            poller.stop()
+
+    def stats(self):
+        """
+        @return: {key: {"rate", "published", "dropped", "missed", "prevented"}}, missed being the polls that could not be
+        done on time because the previous read took too long, and prevented the spurious activations its filter prevented
+        """
+        return {poller.key: {"rate": poller.rate, "published": self.published[poller.key],
+                             "dropped": self.dropped[poller.key], "missed": poller.missed,
+                             "prevented": poller.filter.prevented if poller.filter is not None else 0}
+                for poller in self.pollers}
+
+
+class SensorPoller():
+    """
+    Thread reading one sensor at a fixed rate and publishing what it read in a SensorService
+    """
+
+    def __init__(self, service, key, read, rate, filter=None):
+        self.service = service
+        self.key = key
+        self.read = read
+        self.rate = rate
+        self.filter = filter
+        self.missed = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(name="Sensor poller " + self.key, target=self._run, args=())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        period = 1.0 / self.rate
+        publish, read, key = self.service.publish, self.read, self.key
+        if self.filter is not None:
+            raw, filter = read, self.filter
+            read = lambda: filter(raw())
+        next_tick = time.monotonic()
+        while self._running:
+            publish(key, read())
+            next_tick += period
+            now = time.monotonic()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+            else:  # the read took longer than the period, the polls that should have happened meanwhile are lost
+                self.missed += int((now - next_tick) / period) + 1
+                next_tick = now
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Process split runtime: the sensor polling and the bluetooth link run in their own process and publish the readings in a
+shared memory block, so they do not fight over the GIL with the checker and action threads of the Controller. The
+controller side copies the block into its Readings (see SharedReadings.refresh) without any IPC round trip.
+
+Kept free of ev3dev2 imports so it can be benchmarked off the brick.
+"""
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8, e.g. the one on the brick: fall back to an anonymous shared mmap
+    shared_memory = None
+
+UNKNOWN_LABEL = "unknown"  # what readers get for a published label missing from the labels table
+
+
+class SharedBlock():
+    """
+    A block of memory shared with the processes forked after its creation
+    """
+
+    def __init__(self, size):
+        self.size = size
+        if shared_memory is not None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self.buf = self._shm.buf
+        else:
+            self._shm = None
+            self.buf = mmap.mmap(-1, size)  # MAP_SHARED | MAP_ANONYMOUS, inherited by fork()
+
+    def close(self):
+        """
+        Frees the block. Only the process that created it should call this
+        """
+        if self._shm is not None:
+            self.buf = None
+            self._shm.close()
+            self._shm.unlink()
+        else:
+            self.buf.close()
+
+
+class SharedReadings():
+    """
+    Fixed layout of readings in a SharedBlock, protected by a seqlock: the writer makes the sequence number odd, writes
+    the values, then makes it even again; a reader retries until it read the same even number before and after copying
+    the values. Readers never block the writer. The writer keeps its values in a preallocated list and packs them
+    straight into the block, so a publish builds no buffer, only the small tuples of the encoding and of the arguments.
+
+    Every reading is stored as a tag (None, bool, int, float or label), a double and its acquisition time, labels (e.g.
+    the color names) being stored as their index in the labels table given at construction. A label missing from the
+    table is published as UNKNOWN_LABEL and counted in unknown, instead of killing the writer process.
+
+    A single process writes (the sensor process), any number read. The EV3 has a single core, so the plain stores of
+    the writer are seen in order by the readers.
+    """
+
+    NONE, BOOL, INT, FLOAT, LABEL, UNKNOWN = 0, 1, 2, 3, 4, 5
+
+    _SEQ = struct.Struct("<Q")
+
+    def __init__(self, keys, labels=()):
+        """
+        @param keys: Names of the readings, e.g. list(READINGS_DICT)
+        @param labels: The non numeric values the readings can take, e.g. the color names
+        """
+        self.keys = tuple(keys)
+        self.labels = tuple(labels)
+        self._label_index = {label: i for i, label in enumerate(self.labels)}
+        # time of the publish, unknown labels so far, then (tag, value, acquisition time) per key
+        self._payload = struct.Struct("<dQ" + "Bdd" * len(self.keys))
+        self.block = SharedBlock(self._SEQ.size + self._payload.size)
+        self._values = [self.NONE, 0.0, 0.0] * len(self.keys)  # writer side copy of the payload
+        self._index = {key: 3 * i for i, key in enumerate(self.keys)}
+        self._seq = 0
+        self._last_seq = 0  # reader side, sequence number of the last refresh
+        self.stamp = None  # reader side, time of the publish read by the last refresh
+        self.retries = 0  # reader side, reads that had to be done again because of a concurrent write
+        self.unknown = 0  # values not in labels published so far, counted by the writer and read back by refresh()
+        self.changed = multiprocessing.get_context("fork").Event()  # set by every publish, see watch()
+
+    def _encode(self, value):
+        if value is None:
+            return self.NONE, 0.0
+        if value is True or value is False:
+            return self.BOOL, float(value)
+        if isinstance(value, int):
+            return self.INT, float(value)
+        if isinstance(value, float):
+            return self.FLOAT, value
+        index = self._label_index.get(value)
+        if index is None:
+            self.unknown += 1
+            return self.UNKNOWN, 0.0
+        return self.LABEL, float(index)
+
+    def _decode(self, tag, value):
+        if tag == self.INT:
+            return int(value)
+        if tag == self.LABEL:
+            return self.labels[int(value)]
+        if tag == self.BOOL:
+            return value != 0.0
+        if tag == self.FLOAT:
+            return value
+        if tag == self.UNKNOWN:
+            return UNKNOWN_LABEL
+        return None
+
+    def publish(self, values, stamp=None, stamps=None):
+        """
+        Writer side: stores the given readings (the others keep their last value)
+        @param values: {key: value} for some or all of the keys
+        @param stamp: When the values were acquired (time.monotonic()), now by default
+        @param stamps: {key: acquisition time} of the values not acquired at stamp (e.g. received earlier on the link)
+        """
+        if stamp is None:
+            stamp = time.monotonic()
+        payload = self._values
+        for key, value in values.items():
+            i = self._index[key]
+            payload[i], payload[i + 1] = self._encode(value)
+            payload[i + 2] = stamps[key] if stamps is not None and key in stamps else stamp
+
+        buf = self.block.buf
+        seq = self._seq
+        self._SEQ.pack_into(buf, 0, seq + 1)  # odd: write in progress
+        self._payload.pack_into(buf, self._SEQ.size, stamp, self.unknown, *payload)
+        self._SEQ.pack_into(buf, 0, seq + 2)
+        self._seq = seq + 2
+        self.changed.set()
+
+    def _read(self):
+        buf = self.block.buf
+        while True:
+            seq = self._SEQ.unpack_from(buf, 0)[0]
+            if not seq & 1:
+                data = self._payload.unpack_from(buf, self._SEQ.size)
+                if self._SEQ.unpack_from(buf, 0)[0] == seq:
+                    return seq, data
+            self.retries += 1
+
+    def snapshot(self):
+        """
+        Reader side
+        @return: (time of the publish, {key: value}) of the last complete publish
+        """
+        seq, data = self._read()
+        self.unknown = data[1]
+        return data[0], {key: self._decode(data[2 + 3 * i], data[3 + 3 * i]) for i, key in enumerate(self.keys)}
+
+    def refresh(self, readings):
+        """
+        Reader side: copies the last published values into readings (a Readings only bumps the versions of the values
+        that changed, and gets their acquisition times). Costs a single 8 bytes read when nothing got published since
+        the last call
+        @param readings: The dict to update, e.g. READINGS_DICT
+        @return: Whether something new got published
+        """
+        if self._SEQ.unpack_from(self.block.buf, 0)[0] == self._last_seq:
+            return False
+        seq, data = self._read()
+        self._last_seq = seq
+        self.stamp = data[0]
+        self.unknown = data[1]
+        decode = self._decode
+        store = getattr(readings, "set", None)
+        for i, key in enumerate(self.keys):
+            value = decode(data[2 + 3 * i], data[3 + 3 * i])
+            if store is None:
+                readings[key] = value
+            elif data[4 + 3 * i]:  # never published otherwise
+                store(key, value, data[4 + 3 * i])
+        return True
+
+    def watch(self, notify):
+        """
+        Reader side: calls notify from a thread of this process every time something got published, so an event driven
+        Controller runs its arbitration pass (and the refresh) right away instead of waiting for its deadline
+        @param notify: e.g. CONTROLLER.notify
+        """
+        def run():
+            while True:
+                self.changed.wait()
+                self.changed.clear()
+                notify()
+
+        thread = threading.Thread(name="Shared readings watcher", target=run, args=())
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.block.close()
+
+
+class SensorProcess():
+    """
+    Process polling the sensors (and the link) at a fixed rate and publishing what it read in a SharedReadings
+    """
+
+    def __init__(self, shared, make_poll, period=0.01):
+        """
+        @param shared: The SharedReadings to publish into
+        @param make_poll: Called once in the new process (e.g. to start the link listener there), returns the function
+        called every period that reads the sensors and returns {key: value}, or ({key: value}, {key: acquisition time})
+        when some values were acquired earlier than the poll
+        @param period: Polling period in seconds
+        """
+        self.shared = shared
+        self.make_poll = make_poll
+        self.period = period
+        context = multiprocessing.get_context("fork")  # the shared block and the devices are inherited, not pickled
+        self._stop = context.Event()
+        self.process = context.Process(name="Sensor process", target=self._run, args=())
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        self._stop.set()
+        self.process.join()
+
+    def _run(self):
+        poll = self.make_poll()
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            stamp = time.monotonic()
+            values = poll()
+            if isinstance(values, tuple):
+                self.shared.publish(values[0], stamp, values[1])
+            else:
+                self.shared.publish(values, stamp)
+            next_tick += self.period
+            now = time.monotonic()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+            else:
+                next_tick = now
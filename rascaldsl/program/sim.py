@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated ev3dev2 motors running on a VirtualClock, to run behaviors in lockstep (Controller.run_lockstep) off the
+brick, e.g. in CI. They have the interface of the ev3dev2 objects wrapped by commons.Motor and commons.ArmMotor, but
+commons and the Behaviors_* modules import ev3dev2 and open the devices when imported, so they can not be used off the
+brick: a simulation builds its own behaviors driving the simulated motors, and its own Controller:
+
+    clock = VirtualClock()
+    CLOCK.use(clock)
+    drive = SimDifferential(clock)
+    controller = Controller(return_when_no_action=True)
+    controller.add(TurnAwayBhv(drive))  # calls drive.turn_left(...) and polls drive.is_running
+    controller.start()  # runs run_lockstep(), CLOCK being virtual
+
+A move only sets the virtual time at which it will be done. Polling is_running moves the clock by one quantum, so the
+usual "while MOTOR.is_running and not self.suppressed: pass" loops of the behaviors let the time (and the arbitration)
+go on instead of spinning forever.
+"""
+
+
+def _percent(speed):
+    """
+    @param speed: A SpeedPercent or a plain number
+    """
+    return abs(float(getattr(speed, "percent", speed)))
+
+
+class SimMotor():
+    """
+    Common part of the simulated motors: a deadline on the virtual clock
+    """
+
+    def __init__(self, clock):
+        """
+        @param clock: The VirtualClock the motor runs on
+        """
+        self.clock = clock
+        self.end = None
+        self.moves = 0
+        self.stops = 0
+
+    def _start(self, duration, block):
+        self.moves += 1
+        self.end = self.clock.time() + duration
+        if block:
+            while self.end is not None and self.clock.time() < self.end:
+                self.clock.advance()
+            self.end = None
+
+    def stop(self):
+        self.stops += 1
+        self.end = None
+
+    @property
+    def is_running(self):
+        if self.end is None:
+            return False
+        self.clock.advance()
+        if self.end is not None and self.clock.time() < self.end:
+            return True
+        self.end = None
+        return False
+
+
+class SimDifferential(SimMotor):
+    """
+    Stands for the ev3dev2 MoveDifferential used by commons.Motor
+    """
+
+    def __init__(self, clock, full_speed=500.0, full_turn_speed=360.0):
+        """
+        @param full_speed: Linear speed at 100%, in mm/s
+        @param full_turn_speed: Turning speed at 100%, in degrees/s
+        """
+        SimMotor.__init__(self, clock)
+        self.full_speed = full_speed
+        self.full_turn_speed = full_turn_speed
+        self.x, self.y = 0.0, 0.0
+
+    def _drive(self, speed, distance_mm, block):
+        self._start(abs(distance_mm) / (self.full_speed * max(_percent(speed), 1) / 100.0), block)
+
+    def on_for_distance(self, speed, distance_mm, brake=True, block=True):
+        self._drive(speed, distance_mm, block)
+
+    def _turn(self, speed, degrees, block):
+        self._start(abs(degrees) / (self.full_turn_speed * max(_percent(speed), 1) / 100.0), block)
+
+    def turn_right(self, speed, degrees, brake=True, block=True):
+        self._turn(speed, degrees, block)
+
+    def turn_left(self, speed, degrees, brake=True, block=True):
+        self._turn(speed, degrees, block)
+
+    def on_to_coordinates(self, speed, x, y, brake=True, block=True):
+        distance = ((x - self.x) ** 2 + (y - self.y) ** 2) ** 0.5
+        self.x, self.y = x, y
+        self._drive(speed, distance, block)
+
+    def odometry_start(self, *args, **kwargs):
+        self.x, self.y = 0.0, 0.0
+
+    def odometry_stop(self):
+        pass
+
+
+class SimMediumMotor(SimMotor):
+    """
+    Stands for the ev3dev2 MediumMotor used by commons.ArmMotor
+    """
+
+    def __init__(self, clock, full_rps=2.5):
+        """
+        @param full_rps: Rotations per second at 100%
+        """
+        SimMotor.__init__(self, clock)
+        self.full_rps = full_rps
+
+    def on_for_rotations(self, speed, rotations, brake=True, block=True):
+        self._start(abs(rotations) / (self.full_rps * max(_percent(speed), 1) / 100.0), block)
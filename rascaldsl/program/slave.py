@@ -16,19 +16,21 @@ if DEBUG:
     from ev3devlogging import timedlog
 
 
-master_mac = '00:17:E9:B2:1E:41'
-master = False
+MASTER_MAC = '00:17:E9:B2:1E:41'
+MASTER = False
+BLUETOOTH_CONNECTION = BluetoothConnection(MASTER, MASTER_MAC, debug=DEBUG)
+start_ping_slave(BLUETOOTH_CONNECTION)
 CONTROLLER = Controller(return_when_no_action=True)
 
 
 
 
 
-CONTROLLER.add(UpdateSlaveReadingsBhv())
+CONTROLLER.add(UpdateSlaveReadingsBhv(BLUETOOTH_CONNECTION))
 
 
 
-s.speak('Start')
+S.speak('Start')
 if DEBUG:
     timedlog("Starting")
 
@@ -52,7 +54,7 @@ if DEBUG:
 
 
 
-bluetooth_connection.start_listening(lambda data: ())
-controller.start()
+BLUETOOTH_CONNECTION.start_listening(lambda data: ())
+CONTROLLER.start()
 
-s.speak("stop")
\ No newline at end of file
+S.speak("stop")
\ No newline at end of file
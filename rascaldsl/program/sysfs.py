@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Fast path to the lego-sensor sysfs attributes. The ev3dev2 attribute access formats the path, goes through a file object
+and decodes a new string at every read; here the value files are opened once and read with pread (or lseek and readv
+before Python 3.7) into a buffer allocated once, and the number is parsed from the bytes directly.
+
+The root of the tree is a parameter, so it can be pointed at a fake tree in a temporary directory (see
+make_fake_sensor) off the brick.
+"""
+import os
+
+SYSFS_ROOT = "/sys/class/lego-sensor"
+
+_preadv = getattr(os, "preadv", None)  # Python >= 3.7
+
+
+def find_sensor(address, root=SYSFS_ROOT):
+    """
+    @param address: The port of the sensor, e.g. "ev3-ports:in1"
+    @param root: The lego-sensor class directory
+    @return: The directory of the sensor plugged on that port
+    """
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        try:
+            with open(os.path.join(path, "address")) as f:
+                if f.read().strip() == address:
+                    return path
+        except (IOError, OSError):
+            continue
+    raise LookupError("No sensor on " + address)
+
+
+class SysfsSensor():
+    """
+    Keeps the value files of a sensor open and reads them without allocating new buffers
+    """
+
+    def __init__(self, path, values=1, size=16):
+        """
+        @param path: Directory of the sensor, e.g. find_sensor("ev3-ports:in1") or the _path of an ev3dev2 sensor
+        @param values: How many value<N> files to open
+        @param size: Size of the read buffer, in bytes
+        """
+        self.path = path
+        self.fds = [os.open(os.path.join(path, "value" + str(i)), os.O_RDONLY) for i in range(values)]
+        self._buffer = bytearray(size)
+        self._buffers = [self._buffer]
+        self._mode_fd = None
+
+    def set_mode(self, mode):
+        """
+        Sets the mode of the sensor (e.g. "COL-COLOR", "US-DIST-CM"). Not for the hot path
+        """
+        with open(os.path.join(self.path, "mode"), "w") as f:
+            f.write(mode)
+
+    def write_mode(self, mode):
+        """
+        Writes the mode through a file kept open, for the single shot modes (e.g. "US-SI-CM") where every write starts
+        a new measurement
+        @param mode: The mode, as bytes
+        """
+        if self._mode_fd is None:
+            self._mode_fd = os.open(os.path.join(self.path, "mode"), os.O_WRONLY)
+        os.lseek(self._mode_fd, 0, os.SEEK_SET)
+        os.write(self._mode_fd, mode)
+
+    def read(self, index=0):
+        """
+        @param index: Which value<N> to read
+        @return: Its current integer value
+        """
+        fd = self.fds[index]
+        if _preadv is not None:
+            n = _preadv(fd, self._buffers, 0)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            n = os.readv(fd, self._buffers)
+        buffer = self._buffer
+        value = 0
+        negative = False
+        i = 0
+        while i < n:
+            c = buffer[i]
+            if 48 <= c <= 57:
+                value = value * 10 + c - 48
+            elif c == 45:  # "-"
+                negative = True
+            else:  # the "\n" at the end
+                break
+            i += 1
+        return -value if negative else value
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+        if self._mode_fd is not None:
+            os.close(self._mode_fd)
+            self._mode_fd = None
+
+
+def make_fake_sensor(root, name, address, driver_name, mode, values):
+    """
+    Creates the files of a sensor in a fake lego-sensor tree, for testing and benchmarking off the brick
+    @param root: Directory standing for /sys/class/lego-sensor
+    @param name: e.g. "sensor0"
+    @param address: e.g. "ev3-ports:in1"
+    @param driver_name: e.g. "lego-ev3-color"
+    @param mode: e.g. "COL-COLOR"
+    @param values: Initial values of the value<N> files
+    @return: The directory of the sensor
+    """
+    path = os.path.join(root, name)
+    os.makedirs(path)
+    attributes = {"address": address, "driver_name": driver_name, "mode": mode}
+    for i, value in enumerate(values):
+        attributes["value" + str(i)] = value
+    for attribute, value in attributes.items():
+        with open(os.path.join(path, attribute), "w") as f:
+            f.write(str(value) + "\n")
+    return path
+
+
+def write_fake_value(path, value, index=0):
+    """
+    Changes a value<N> file of a fake sensor, the way the driver would
+    """
+    with open(os.path.join(path, "value" + str(index)), "w") as f:
+        f.write(str(value) + "\n")
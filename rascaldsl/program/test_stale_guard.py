@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+The safety behaviors are skipped while their readings are stale, the StaleGuard must keep the robot still meanwhile.
+Runs in lockstep on a VirtualClock, off the brick: python3 -m pytest test_stale_guard.py
+"""
+from Subs_arch import Behavior, CLOCK, Controller, StaleGuard, SystemClock, VirtualClock
+from readings import Readings
+from sim import SimDifferential
+
+MAX_AGE = 0.5
+SAFETY_KEYS = ("US_B", "US_F")  # a reading of the master and one the slave sends over bluetooth
+
+
+class CliffBhv(Behavior):
+    depends_on = ("US_B",)
+    max_age = MAX_AGE
+
+    def __init__(self, readings, log):
+        self.readings = readings
+        self.log = log
+        self.cliff = False
+
+    def check(self):
+        cliff = self.readings["US_B"] > 120
+        fire = cliff and not self.cliff
+        self.cliff = cliff
+        return fire
+
+    def action(self):
+        self.log.append("cliff")
+
+    def suppress(self):
+        pass
+
+
+class RunningBhv(Behavior):
+    def __init__(self, drive, clock, log):
+        self.drive = drive
+        self.clock = clock
+        self.log = log
+        self.suppressed = False
+
+    def check(self):
+        return True
+
+    def action(self):
+        self.suppressed = False
+        self.drive.on_for_distance(50, 10, block=False)
+        self.log.append(("drive", round(self.clock.time(), 2)))
+        while self.drive.is_running and not self.suppressed:
+            pass
+        return not self.suppressed
+
+    def suppress(self):
+        self.drive.stop()
+        self.suppressed = True
+
+
+def _run(feed, until, keys=("US_B",)):
+    """
+    Runs a guard, a cliff behavior and a running behavior until the given virtual time
+    @param feed: Called at every step of the clock with (readings, now), to publish the sensor values
+    @param keys: The readings the guard watches
+    @return: (log of the actions, the guard, the simulated drive)
+    """
+    clock = VirtualClock()
+    CLOCK.use(clock)
+    try:
+        readings = Readings({"US_B": 50, "US_F": 1000})
+        readings.clock = clock
+        clock.listeners.append(lambda: feed(readings, clock.time()))
+        drive = SimDifferential(clock)
+        log = []
+        guard = StaleGuard(readings, keys, MAX_AGE, lambda: log.append(("halt", round(clock.time(), 2))),
+                           clock=clock)
+        controller = Controller(return_when_no_action=True, readings=readings, clock=clock)
+        controller.add(guard)
+        controller.add(CliffBhv(readings, log))
+        controller.add(RunningBhv(drive, clock, log))
+        controller.run_lockstep(until=until)
+        return log, guard, drive
+    finally:
+        CLOCK.use(SystemClock())
+
+
+def test_no_driving_before_the_first_readings():
+    def feed(readings, now):
+        if now >= 0.3:
+            readings.set("US_B", 50, now)
+
+    log, guard, drive = _run(feed, 1.0)
+    assert log[0] == ("halt", 0.0)
+    assert all(entry[1] >= 0.3 for entry in log if entry[0] == "drive")
+    assert guard.halts == 1
+
+
+def test_stalled_readings_stop_the_robot():
+    def feed(readings, now):
+        if now < 1.0 or now >= 2.0:  # the link stalls for a second
+            readings.set("US_B", 50, now)
+
+    log, guard, drive = _run(feed, 3.0)
+    halts = [entry for entry in log if entry[0] == "halt"]
+    assert len(halts) == 2  # at startup, then once US_B went stale
+    assert abs(halts[1][1] - (1.0 + MAX_AGE)) <= 0.02  # a clock step after the last reading got too old
+    assert drive.stops >= 1  # the running behavior got suppressed
+    drives = [entry[1] for entry in log if entry[0] == "drive"]
+    assert not [t for t in drives if halts[1][1] <= t < 2.0]  # nothing drives blind
+    assert [t for t in drives if t >= 2.0]  # and it goes on once fresh readings arrive
+    assert "cliff" not in log
+
+
+def test_fresh_readings_let_the_safety_behavior_act():
+    def feed(readings, now):
+        readings.set("US_B", 200 if now >= 1.0 else 50, now)
+
+    log, guard, drive = _run(feed, 1.5)
+    assert "cliff" in log
+    assert guard.halts == 1  # only before the first reading
+
+
+def test_frozen_slave_readings_stop_the_robot():
+    def feed(readings, now):
+        readings.set("US_B", 50, now)  # the sensors of the master keep coming
+        if now < 1.0 or now >= 2.0:  # but the bluetooth link stalls for a second
+            readings.set("US_F", 1000, now)
+
+    log, guard, drive = _run(feed, 3.0, SAFETY_KEYS)
+    halts = [entry for entry in log if entry[0] == "halt"]
+    assert len(halts) == 2
+    assert abs(halts[1][1] - (1.0 + MAX_AGE)) <= 0.02
+    drives = [entry[1] for entry in log if entry[0] == "drive"]
+    assert not [t for t in drives if halts[1][1] <= t < 2.0]
+    assert [t for t in drives if t >= 2.0]
+
+
+def test_no_driving_while_the_slave_is_silent():
+    def feed(readings, now):
+        readings.set("US_B", 50, now)
+        if now >= 1.5:  # nothing from the slave before
+            readings.set("US_F", 1000, now)
+
+    log, guard, drive = _run(feed, 2.0, SAFETY_KEYS)
+    assert log[0] == ("halt", 0.0)
+    drives = [entry[1] for entry in log if entry[0] == "drive"]
+    assert drives and min(drives) >= 1.5
+    assert guard.halts == 1  # held from the start, although the readings of the master were fresh